@@ -4,20 +4,60 @@ import sys
 import time
 import csv
 import os
+import math
+import json
+import random
+import heapq
+import pickle
+import shutil
+import threading
+import multiprocessing
 import logging
 import sqlite3
 import tempfile
 import subprocess
-from itertools import chain, combinations
-from collections import defaultdict
-from .shared import UNCL, POSTERIOR, EQUAL, pretty_p, numify, memoize
-from .genealogical_coherence import GenealogicalCoherence, generate_genealogical_coherence_cache
+import numpy as np
+from itertools import combinations, islice
+from collections import defaultdict, namedtuple
+from .shared import UNCL, pretty_p, numify, memoize, coherence_fingerprint
+from .genealogical_coherence import (GenealogicalCoherence, generate_genealogical_coherence_cache,
+                                     explanation_templates, queue_genealogical_coherence,
+                                     genealogical_coherence_done)
+from .task_journal import TaskJournal
+from .telemetry import TelemetryWriter
 
 from . import mpisupport
 from builtins import int
 
 DELIM = "\t"
 
+ENGINES = ('powerset', 'exact', 'gray')
+
+# Roughly how many array elements to use when evaluating a batch of combinations
+BATCH_ELEMENTS = 2 ** 22
+MAX_BATCH_SIZE = 8192
+
+# How much memory (in MB) to use for sorting the rows before spilling them to disk
+DEFAULT_SORT_MEMORY = 512
+# How many results to write to (or read from) a spill file at once
+SPILL_CHUNK = 10000
+
+# How many ranges of the powerset to give each process, so they finish at
+# about the same time
+RANGES_PER_PROCESS = 4
+# How many combinations to give an MPI child at once
+MPI_RANGE_SIZE = 2 ** 20
+
+# How often (in seconds) to save a checkpoint, so a long run can be resumed -
+# when resume is asked for without an interval. Checkpointing is off by
+# default, since it leaves a .W1SUFFIX.combanc directory behind if the run is
+# killed.
+DEFAULT_CHECKPOINT_INTERVAL = 600
+
+# How often (in seconds) to rewrite the CSV file with the best combinations
+# found so far, when searching with a time budget
+ANYTIME_WRITE_INTERVAL = 5
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,14 +71,18 @@ logger = logging.getLogger(__name__)
 #           the descendant compared with combinations which are equal in
 #           number of ancestors.
 # vus_* = my columns listing the relevant variant units
-SCHEMA = ["""CREATE TABLE tmp (Vorf TEXT, Vorfanz INT, Stellen INT, Post INT, Fragl INT,
-                               Offen INT, Hinweis TEXT, sum_rank INT, ranks TEXT,
-                               vus_stellen TEXT, vus_post TEXT, vus_fragl TEXT, vus_offen TEXT);""",
-          "CREATE INDEX fraglidx ON tmp (Fragl);",
-          "CREATE INDEX offenidx ON tmp (Offen);",
-          "CREATE INDEX postidx ON tmp (Post);",
-          "CREATE INDEX stellenidx ON tmp (Stellen);",
-          "VACUUM;", "ANALYZE;"]
+#
+# While we're working we just keep a compact Result for each row, which sorts
+# in the order the rows go in the CSV file - best first. I.e. those with the
+# most agreement and then agreement by posterity, then with fewest errors, then
+# fewest witnesses in the combination, and finally the sum of the rank of those
+# witnesses. (Fragl is the same for every combination.) This is just to help
+# the user when they get the file.
+#
+# comb is a tuple of indexes into pot_an, and agreement and posterity are
+# bitmasks (packed into bytes) over the explainable variant units.
+Result = namedtuple('Result', ['neg_stellen', 'neg_post', 'offen', 'vorfanz', 'sum_rank',
+                               'comb', 'agreement', 'posterity'])
 
 
 @memoize
@@ -129,26 +173,14 @@ def define_columns(debug=False):
     return columns
 
 
-def combinations_of_ancestors(db_file, w1, max_comb_len, allow_incomplete=True, debug=False, suffix=''):
+def load_masks(db_file, w1, max_comb_len, prune=False):
     """
-    Prints a table of combinations of potential ancestors ordered by
-    the number required to account for all the readings in w1.
-
-    @param db_file: db file
-    @param w1: witness
-    @param max_comb_len: maximum length of combinations to check (-1 for unlimited)
-    @param allow_incomplete: show combinations that don't explain everything
+    Load the data for w1 (see load_data) and compile the explanations for
+    each of its variant units.
 
-    Always returns True - for MPI purposes.
+    @param prune: leave out the potential ancestors that others dominate (see prune_dominated)
+    @return: (ExplanationMasks, map of witness to rank, n_combs)
     """
-    output_file = "{}{}.csv".format(w1, suffix)
-    if os.path.exists(output_file):
-        logger.info("SKIPPING %s as %s already exists", w1, output_file)
-        return True
-
-    using_mpi = 'OMPI_COMM_WORLD_SIZE' in os.environ
-
-    columns = define_columns(debug)
     coh, pot_an, my_vus, n_combs = load_data(db_file, w1, max_comb_len)
 
     # We need to explain our reading for each vu in my_vus - and some might
@@ -158,179 +190,1507 @@ def combinations_of_ancestors(db_file, w1, max_comb_len, allow_incomplete=True,
 
     logger.info("Loading combinations for %s for each variant unit...", w1)
 
+    # The stemma walks are the same for every witness with the same reading
+    templates = explanation_templates(db_file)
     for (vu, reading, parent) in my_vus:
         if parent == 'UNCL':
             continue
-        coh.set_variant_unit(vu)
-        vu_combs = coh.parent_combinations(reading, parent)
+        vu_combs = templates.parent_combinations(coh, vu, reading, parent)
         # Simplify that to just a list of tuples of witnesses
         wit_combs = [set(x.parent for x in a) for a in vu_combs]
         vu_map[vu] = (vu_combs, wit_combs)
     logger.info("Loaded combinations for %s for each variant unit...", w1)
 
+    ranks = {x['W2']: x['_NR'] for x in coh.rows}
+    if prune:
+        kept, dropped = prune_dominated(pot_an, vu_map, ranks)
+        for wit, by in dropped.items():
+            logger.debug("%s: potential ancestor %s is dominated by %s", w1, wit, by)
+        logger.info("Pruned %s of the %s potential ancestors of %s, so there are 2^%s fewer combinations",
+                    len(dropped), len(pot_an), w1, len(dropped))
+        pot_an = kept
+        n_combs = 2 ** len(kept)
+
+    return ExplanationMasks(pot_an, my_vus, vu_map), ranks, n_combs
+
+
+def prune_dominated(pot_an, vu_map, ranks):
+    """
+    Find the potential ancestors that another, better ranked, potential
+    ancestor could always stand in for: Y dominates X if, for every way X
+    helps to explain a variant unit, swapping X for Y explains it at least
+    as well (by agreement, by posterity or at all).
+
+    Then any combination including X can do at least as well, with a lower
+    sum_rank, by swapping X for Y (or just dropping X, if Y is already
+    there) - so the best combinations of each size never need X.
+
+    @param pot_an: potential ancestors (in order)
+    @param vu_map: see ExplanationMasks
+    @param ranks: map of witness to rank
+    @return: (potential ancestors to keep, dict of dropped potential ancestor to the one that dominates it)
+    """
+    # Better rank first - and then the original order, for joint ranks
+    order = {x: (ranks[x], i) for i, x in enumerate(pot_an)}
+    pot_an_set = set(pot_an)
+
+    # How well each explanation explains its variant unit - agreement,
+    # posterity, or just at all - and which explanations each potential
+    # ancestor is part of
+    by_vu = defaultdict(list)
+    uses = defaultdict(list)
+    for vu, (vu_combs, wit_combs) in vu_map.items():
+        for parent_comb, wits in zip(vu_combs, wit_combs):
+            if not wits <= pot_an_set:
+                # Can never be satisfied by a combination of our potential ancestors
+                continue
+            how = min(max(x.gen for x in parent_comb), 3)
+            by_vu[vu].append((how, wits))
+            for wit in wits:
+                uses[wit].append((vu, how, wits))
+
+    def stands_in_for(y, x):
+        for vu, how, wits in uses[x]:
+            swapped = (wits - {x}) | {y}
+            if not any(h <= how and w <= swapped for h, w in by_vu[vu]):
+                return False
+        return True
+
+    dropped = {}
+    by_order = sorted(pot_an, key=order.get)
+    for x in pot_an:
+        for y in by_order:
+            if order[y] >= order[x]:
+                break
+            if stands_in_for(y, x):
+                dropped[x] = y
+                break
+
+    return [x for x in pot_an if x not in dropped], dropped
+
+
+def combinations_of_ancestors(db_file, w1, max_comb_len, allow_incomplete=True, debug=False, suffix='',
+                              engine='powerset', frontier=False, sort_memory=DEFAULT_SORT_MEMORY,
+                              processes=1, checkpoint_interval=0, resume=False,
+                              prune=False, time_budget=None):
+    """
+    Prints a table of combinations of potential ancestors ordered by
+    the number required to account for all the readings in w1.
+
+    @param db_file: db file
+    @param w1: witness
+    @param max_comb_len: maximum length of combinations to check (-1 for unlimited)
+    @param allow_incomplete: show combinations that don't explain everything
+    @param engine: 'powerset' checks every combination (up to max_comb_len
+                   of them), 'exact' searches for just the optimal ones (the
+                   Hinweis '<<' rows) and 'gray' checks every combination
+                   incrementally, in Gray code order
+    @param frontier: only output the combinations on the Pareto frontier
+                     (see ParetoFrontier)
+    @param sort_memory: roughly how much memory (in MB) to sort the rows in,
+                        before spilling them to disk (see SpillSorter)
+    @param processes: number of processes to split the powerset engine's
+                      work between (see parallel_powerset_rows)
+    @param checkpoint_interval: how often (in seconds) to save a checkpoint
+                                (in .W1SUFFIX.combanc) when checking the
+                                powerset in one process (0 for never)
+    @param resume: carry on from the last checkpoint, if there is one -
+                   otherwise it's discarded. This turns checkpointing on
+                   (every DEFAULT_CHECKPOINT_INTERVAL seconds), if
+                   checkpoint_interval doesn't.
+    @param prune: leave out the potential ancestors that others dominate
+                  (see prune_dominated)
+    @param time_budget: instead of the engine, just search for good
+                        combinations for this many seconds (see AnytimeSearch)
+
+    Returns W1's recommended optimal substemma (see SubstemmaReducer) -
+    which is never None, for MPI purposes.
+    """
+    output_file = "{}{}.csv".format(w1, suffix)
+    if os.path.exists(output_file):
+        logger.info("SKIPPING %s as %s already exists", w1, output_file)
+        return SubstemmaReducer.from_csv(output_file).substemma(w1)
+
+    columns = define_columns(debug)
+    masks, ranks, n_combs = load_masks(db_file, w1, max_comb_len, prune)
+
     if max_comb_len == -1:
         # Unlimited
         max_comb_len = n_combs
 
-    powerset = chain.from_iterable(combinations(pot_an, n)
-                                   for n in range(min(len(pot_an) + 1, max_comb_len + 1)))
-    total = min(n_combs, max_comb_len)
-    done = 0
-    start = time.time()
-    if using_mpi:
-        report = max(total // 100, 1)
-    else:
-        report = max(total // 10000, 1)
+    if time_budget:
+        reducer = anytime_search(masks, ranks, w1, output_file, columns, time_budget)
+        return reducer.substemma(w1)
+
     best_explanations = defaultdict(int)  # for working out "Hinweis"
-    ranks = {x['W2']: x['_NR'] for x in coh.rows}
-    numrows = 0
+    presorted = False
+    checkpoint = None
+    if engine == 'exact':
+        if max_comb_len != n_combs:
+            logger.info("Ignoring max-comb-len for the exact engine")
+        rows = exact_rows(masks, best_explanations, ranks)
+    elif engine == 'gray' and max_comb_len >= n_combs:
+        rows = gray_rows(masks, w1, allow_incomplete, best_explanations, ranks)
+    elif processes > 1:
+        rows = parallel_powerset_rows(masks, w1, min(n_combs, max_comb_len), allow_incomplete, best_explanations,
+                                      ranks, processes, sort_memory)
+        presorted = True
+    else:
+        if engine == 'gray':
+            # The Gray code order doesn't go smallest first, so can't be cut short
+            logger.warning("The gray engine can't be limited by max-comb-len - using the powerset engine")
+        total = min(n_combs, max_comb_len)
+        start = 0
+        on_batch = None
+        if resume and not checkpoint_interval:
+            checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        if checkpoint_interval:
+            params = {'max_comb_len': total, 'allow_incomplete': allow_incomplete, 'frontier': frontier,
+                      'prune': prune, 'db_file': db_file, 'data': coherence_fingerprint(db_file)}
+            checkpoint = Checkpoint(work_dir(w1, suffix), params, best_explanations, checkpoint_interval)
+            start = checkpoint.restore() if resume else checkpoint.discard()
+            on_batch = checkpoint.batch_done
+        rows = powerset_rows(masks, w1, total, allow_incomplete, best_explanations, ranks,
+                             start=start, on_batch=on_batch)
+
+    reducer = write_results(rows, masks, ranks, output_file, columns, best_explanations,
+                            presorted=presorted, frontier=frontier, sort_memory=sort_memory, checkpoint=checkpoint)
+    if checkpoint is not None:
+        checkpoint.discard()
+    return reducer.substemma(w1)
+
+
+def work_dir(w1, suffix):
+    """
+    The directory for W1's checkpoints and MPI ranges - next to the output
+    file, so it's somewhere all the MPI children can get to.
+    """
+    return ".{}{}.combanc".format(w1, suffix)
 
-    with tempfile.NamedTemporaryFile() as tmp_file:
-        # set up a temporary SQL database - which we can use for sorting the data etc. later
-        # without consuming all the RAM on the machine
-        logger.info("Using temporary database %s", tmp_file.name)
-        conn = sqlite3.connect(tmp_file.name)
-        c = conn.cursor()
-        for s in SCHEMA:
-            c.execute(s)
-
-        for combination in powerset:
-            if done >= total:
-                break
-            done += 1
-            if done % report == 0:
-                so_far = time.time() - start
-                perc = done * 100.0 / total
-                rem = (so_far * 100 / perc) - so_far
-                msg = "{}/{} ({:.2f}%) {} (Time taken: {}, remaining {}) - found {}     ".format(
-                    done, total, perc, w1, time_fmt(so_far), time_fmt(rem), numrows)
-                if using_mpi:
-                    logger.debug(msg)
-                else:
-                    sys.stdout.write("\r{}".format(msg))
-                    sys.stdout.flush()
-            if not combination:
-                # The empty set
-                continue
 
-            row = check_combination(combination, my_vus, vu_map, allow_incomplete, best_explanations, ranks)
-            if row is not None:
-                sql = ("INSERT INTO tmp ({}) VALUES ({})".format(
-                    ', '.join(columns),
-                    ', '.join('\"{}\"'.format(row.get(x, '')) for x in columns)))
-                c.execute(sql)
-                # csv_writer.writerow([row.get(x, '') for x in columns])
+class Checkpoint(object):
+    """
+    Periodically save how far a powerset_rows run has got - the position in
+    the powerset, best_explanations, the number of rows and the rows
+    themselves (as SpillSorter runs, or the Pareto frontier) - so that it can
+    be resumed if it's killed.
+    """
+    def __init__(self, directory, params, best_explanations, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        """
+        @param directory: where to keep the checkpoint
+        @param params: anything that must match for the checkpoint to be resumed
+        @param best_explanations: the dict powerset_rows updates
+        @param interval: how often to save the checkpoint (in seconds)
+        """
+        self.directory = directory
+        self.state_file = os.path.join(directory, 'checkpoint.json')
+        self.params = params
+        self.best_explanations = best_explanations
+        self.interval = interval
+        self.last_saved = time.time()
+        self.numrows = 0
+        self.runs = []
+        self.collector = None
+
+    def restore(self):
+        """
+        Load the checkpoint, if there is one that matches our params.
+
+        @return: the position in the powerset to carry on from
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            logger.info("No checkpoint found in %s - starting from the beginning", self.directory)
+            return self.discard()
+
+        if state['params'] != self.params:
+            logger.warning("Checkpoint in %s is for different parameters or data - starting from the beginning",
+                           self.directory)
+            return self.discard()
+
+        for size, stellen in state['best_explanations'].items():
+            self.best_explanations[int(size)] = stellen
+        self.numrows = state['numrows']
+        self.runs = [os.path.join(self.directory, x) for x in state['runs']]
+        logger.info("Resuming from checkpoint in %s at combination %s, with %s rows",
+                    self.directory, state['position'], self.numrows)
+        return state['position']
+
+    def discard(self):
+        """
+        Remove any checkpoint
+
+        @return: 0 (the position to start from)
+        """
+        if os.path.exists(self.directory):
+            logger.info("Removing checkpoint in %s", self.directory)
+            shutil.rmtree(self.directory)
+        self.numrows = 0
+        self.runs = []
+        return 0
+
+    def attach(self, collector):
+        """
+        Give the checkpoint the SpillSorter or ParetoFrontier the rows go
+        into, and restore the saved rows into it.
+
+        @return: the number of rows so far
+        """
+        self.collector = collector
+        if isinstance(collector, SpillSorter):
+            for run_file in self.runs:
+                collector.runs.append(run_file)
+        else:
+            for run_file in self.runs:
+                for result in read_run(run_file):
+                    collector.add(result)
+        return self.numrows
+
+    def batch_done(self, position, numrows):
+        """
+        Called by powerset_rows between batches, when all the rows up to
+        position have been added to the collector.
+
+        @param numrows: the number of rows found since we started (or resumed)
+        """
+        if time.time() - self.last_saved < self.interval:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        if isinstance(self.collector, SpillSorter):
+            if self.collector.results:
+                self.collector.spill()
+            runs = self.collector.runs
+        else:
+            runs = [os.path.join(self.directory, 'frontier')]
+            write_run(self.collector.sorted_results(), runs[0] + '.tmp')
+            os.replace(runs[0] + '.tmp', runs[0])
+
+        state = {'params': self.params, 'position': position, 'numrows': self.numrows + numrows,
+                 'best_explanations': self.best_explanations, 'runs': [os.path.basename(x) for x in runs]}
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+        logger.info("Saved checkpoint in %s at combination %s", self.directory, position)
+        self.last_saved = time.time()
+
+
+def write_results(results, masks, ranks, output_file, columns, best_explanations, *,
+                  presorted=False, frontier=False, sort_memory=DEFAULT_SORT_MEMORY, checkpoint=None):
+    """
+    Sort the Results (unless they're presorted) and write them to the CSV file
+
+    See combinations_of_ancestors for a description of the arguments.
+
+    Returns a SubstemmaReducer that has seen all the rows.
+    """
+    if frontier:
+        # Only keep the rows that aren't dominated - which is few enough to keep in memory
+        pareto = ParetoFrontier()
+        numrows = checkpoint.attach(pareto) if checkpoint else 0
+        for result in results:
+            pareto.add(result)
+            numrows += 1
+        logger.info("Created %s rows, of which %s are on the Pareto frontier", numrows, len(pareto))
+        reducer = write_csv((masks.make_row(x, ranks) for x in pareto.sorted_results()),
+                            output_file, columns, best_explanations)
+    elif presorted:
+        reducer = write_csv((masks.make_row(x, ranks) for x in results), output_file, columns, best_explanations)
+    else:
+        # The runs go with the checkpoint, if there is one
+        with SpillSorter(sort_memory, checkpoint.directory if checkpoint else None) as sorter:
+            numrows = checkpoint.attach(sorter) if checkpoint else 0
+            for result in results:
+                sorter.add(result)
                 numrows += 1
 
-        if not using_mpi:
+            logger.info("Created %s rows (sorted in %s runs)", numrows, sorter.n_runs)
+            reducer = write_csv((masks.make_row(x, ranks) for x in sorter.sorted_results()),
+                                output_file, columns, best_explanations)
+
+    logger.info("Wrote %s - HINT: look at the rows with << in Hinweis", output_file)
+    return reducer
+
+
+def dominance_key(result):
+    """
+    The things that make a row better than another - every element is
+    "smaller is better".
+
+    Post isn't included, as Stellen + Post + Offen is the same for every row:
+    more Stellen and fewer Offen is better, whatever that does to Post. (And
+    Fragl is the same for every row.)
+    """
+    return (result.neg_stellen, result.offen, result.vorfanz, result.sum_rank)
+
+
+class SpillSorter(object):
+    """
+    Sort Results in bounded memory: they're kept in a list until that gets to
+    roughly memory_mb, then it's sorted and spilled to a temporary file as a
+    run. At the end, the runs are merged.
+
+    Use as a context manager, so the temporary files get removed.
+    """
+    def __init__(self, memory_mb=DEFAULT_SORT_MEMORY, directory=None):
+        """
+        @param directory: where to put the runs - they're left there when
+                          we're done (default: a temporary directory)
+        """
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.results = []
+        self.memory = 0
+        self.runs = []
+        self.directory = directory
+        self.tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def n_runs(self):
+        return len(self.runs) + (1 if self.results else 0)
+
+    def add(self, result):
+        self.results.append(result)
+        # The tuple and the pointer to it, plus what isn't shared with other results
+        self.memory += (sys.getsizeof(result) + 8 + sys.getsizeof(result.comb) +
+                        sys.getsizeof(result.agreement) + sys.getsizeof(result.posterity))
+        if self.memory >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort the results we have, and write them out as a run
+        """
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+        elif self.tmpdir is None:
+            self.tmpdir = tempfile.TemporaryDirectory(prefix='combanc')
+            logger.info("Spilling sorted runs to %s", self.tmpdir.name)
+
+        self.results.sort()
+        directory = self.directory if self.directory is not None else self.tmpdir.name
+        run_file = os.path.join(directory, 'run{}'.format(len(self.runs)))
+        write_run(self.results, run_file)
+        logger.debug("Spilled %s results to %s", len(self.results), run_file)
+        self.runs.append(run_file)
+        self.results = []
+        self.memory = 0
+
+    def sorted_results(self):
+        """
+        Yield all the results, in order
+        """
+        self.results.sort()
+        if not self.runs:
+            yield from self.results
+            return
+
+        yield from heapq.merge(self.results, *[read_run(x) for x in self.runs])
+
+    def close(self):
+        self.results = []
+        self.runs = []
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
+
+
+def write_run(results, run_file):
+    """
+    Write (sorted) Results to a run file, a chunk at a time
+    """
+    results = iter(results)
+    with open(run_file, 'wb') as f:
+        while True:
+            chunk = list(islice(results, SPILL_CHUNK))
+            if not chunk:
+                return
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(run_file):
+    """
+    Yield the Results from a run file
+    """
+    with open(run_file, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+
+
+class ParetoFrontier(object):
+    """
+    Streaming filter that keeps only the rows that aren't dominated by another
+    row - where one row dominates another if it's at least as good on every
+    element of dominance_key, and better on at least one.
+
+    Rows that are equal on all of them are all kept.
+    """
+    def __init__(self):
+        self.rows_by_key = {}
+
+    def __len__(self):
+        return sum(len(x) for x in self.rows_by_key.values())
+
+    def add(self, result):
+        """
+        Add a Result, if it isn't dominated - and drop any it dominates.
+
+        @return: True if the result was kept
+        """
+        key = dominance_key(result)
+        if key in self.rows_by_key:
+            self.rows_by_key[key].append(result)
+            return True
+
+        for other in self.rows_by_key:
+            if all(x <= y for x, y in zip(other, key)):
+                # Dominated
+                return False
+
+        for other in [x for x in self.rows_by_key if all(y <= z for y, z in zip(key, x))]:
+            del self.rows_by_key[other]
+
+        self.rows_by_key[key] = [result]
+        return True
+
+    def sorted_results(self):
+        """
+        All the results on the frontier, in CSV order
+        """
+        return sorted(x for results in self.rows_by_key.values() for x in results)
+
+
+class Progress(object):
+    """
+    Report progress through the combinations - on the terminal, or in the
+    log if we're using MPI.
+    """
+    def __init__(self, w1, total, quiet=False):
+        """
+        @param quiet: just log the progress (e.g. from a worker process)
+        """
+        self.w1 = w1
+        self.total = total
+        self.using_mpi = quiet or 'OMPI_COMM_WORLD_SIZE' in os.environ
+        if self.using_mpi:
+            self.report = max(total // 100, 1)
+        else:
+            self.report = max(total // 10000, 1)
+        self.start = time.time()
+        self.done = 0
+
+    def update(self, done, found):
+        """
+        @param done: the number of combinations checked so far
+        @param found: the number of rows found so far
+        """
+        prev_done = self.done
+        self.done = done
+        if done // self.report == prev_done // self.report:
+            return
+
+        so_far = time.time() - self.start
+        perc = done * 100.0 / self.total
+        rem = (so_far * 100 / perc) - so_far
+        msg = "{}/{} ({:.2f}%) {} (Time taken: {}, remaining {}) - found {}     ".format(
+            done, self.total, perc, self.w1, time_fmt(so_far), time_fmt(rem), found)
+        if self.using_mpi:
+            logger.debug(msg)
+        else:
+            sys.stdout.write("\r{}".format(msg))
+            sys.stdout.flush()
+
+    def finish(self):
+        if not self.using_mpi:
             print()
 
+
+def powerset_rows(masks, w1, total, allow_incomplete, best_explanations, ranks, start=0, quiet=False,
+                  on_batch=None):
+    """
+    Check every combination in the powerset of W1's potential ancestors
+    (smallest first, from the start'th up to total combinations) and yield
+    the rows for those we want.
+
+    @param masks: ExplanationMasks for W1
+    @param best_explanations: dict of size to best Stellen of complete combinations - updated as we go
+    @param on_batch: called with (position in the powerset, number of rows
+                     so far) after the rows for each batch have been used
+                     (see Checkpoint)
+    """
+    progress = Progress(w1, total - start, quiet)
+    done = 0
+    numrows = 0
+
+    for comb_idx in combination_batches(len(masks.pot_an), total, masks.batch_size, start):
+        done += len(comb_idx)
+        progress.update(done, numrows)
+        size = comb_idx.shape[1]
+        if not size:
+            # The empty set
+            continue
+
+        equal, post, explained = masks.evaluate(masks.combination_masks(comb_idx))
+        stellen = equal.sum(axis=1)
+        offen = masks.n_vus - stellen - post.sum(axis=1)
+
+        complete = offen == 0
+        if complete.any():
+            # Look for the best - which must explain everything
+            best_explanations[size] = max(best_explanations[size], int(stellen[complete].max()))
+
+        if allow_incomplete:
+            ok = np.arange(len(comb_idx))
+        else:
+            ok = np.flatnonzero(explained.all(axis=1))
+
+        for i in ok:
+            yield masks.result(comb_idx[i], equal[i], post[i], ranks)
+            numrows += 1
+
+        if on_batch is not None:
+            on_batch(start + done, numrows)
+
+    progress.finish()
+
+
+def parallel_powerset_rows(masks, w1, total, allow_incomplete, best_explanations, ranks, processes,
+                           sort_memory=DEFAULT_SORT_MEMORY):
+    """
+    Like powerset_rows, but with the powerset split into ranges (see
+    powerset_ranges) that are checked and sorted by a pool of processes.
+    This yields the merged rows, already sorted.
+    """
+    ranges = powerset_ranges(total, processes * RANGES_PER_PROCESS)
+    logger.info("Splitting %s combinations for %s into %s ranges for %s processes",
+                total, w1, len(ranges), processes)
+    with tempfile.TemporaryDirectory(prefix='combanc') as tmpdir:
+        run_files = [os.path.join(tmpdir, 'range{}'.format(i)) for i in range(len(ranges))]
+        args = [(masks, ranks, w1, start, stop, allow_incomplete, run_file, sort_memory / processes)
+                for (start, stop), run_file in zip(ranges, run_files)]
+        numrows = 0
+        with multiprocessing.Pool(processes) as pool:
+            for i, (n, best) in enumerate(pool.imap(combanc_range_star, args)):
+                numrows += n
+                for size, stellen in best.items():
+                    best_explanations[size] = max(best_explanations[size], stellen)
+                logger.info("%s: range %s of %s done", w1, i + 1, len(ranges))
+
         logger.info("Created %s rows", numrows)
-        write_csv(c, output_file, columns, best_explanations)
-        logger.info("Wrote %s - HINT: look at the rows with << in Hinweis", output_file)
+        yield from heapq.merge(*[read_run(x) for x in run_files])
 
-    return True
 
+def combanc_range(masks, ranks, w1, start, stop, allow_incomplete, run_file, sort_memory=DEFAULT_SORT_MEMORY):
+    """
+    Check the combinations from start to stop in the powerset of W1's
+    potential ancestors, and write the sorted rows to run_file.
+
+    @return: (number of rows, dict of size to best Stellen of complete combinations)
+    """
+    best_explanations = defaultdict(int)
+    numrows = 0
+    with SpillSorter(sort_memory) as sorter:
+        for result in powerset_rows(masks, w1, stop, allow_incomplete, best_explanations, ranks,
+                                    start=start, quiet=True):
+            sorter.add(result)
+            numrows += 1
+        write_run(sorter.sorted_results(), run_file)
+
+    return numrows, dict(best_explanations)
 
-def check_combination(combination, my_vus, vu_map, allow_incomplete, best_explanations, ranks):
-    ok = True
-    comb_s = set(combination)
-    explanation = [None for x in my_vus]
-    for idx, (vu, _, _) in enumerate(my_vus):
-        if vu not in vu_map:
-            explanation[idx] = UNCL
+
+def combanc_range_star(args):
+    return combanc_range(*args)
+
+
+def powerset_ranges(total, n_ranges):
+    """
+    Split the first total combinations in the powerset into (up to) n_ranges
+    (start, stop) ranges of about the same size.
+    """
+    n_ranges = max(1, min(n_ranges, total))
+    bounds = [total * i // n_ranges for i in range(n_ranges + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def unrank_combination(n, size, rank):
+    """
+    Return the rank'th combination of size items from range(n), in the order
+    itertools.combinations gives them.
+    """
+    comb = []
+    x = 0
+    for i in range(size):
+        while True:
+            # The number of combinations with x next
+            count = math.comb(n - x - 1, size - i - 1)
+            if rank < count:
+                break
+            rank -= count
+            x += 1
+        comb.append(x)
+        x += 1
+    return tuple(comb)
+
+
+def combinations_from(n, first):
+    """
+    Yield the combinations of range(n) of the same size as first, in the
+    order itertools.combinations gives them - starting with first.
+    """
+    size = len(first)
+    yield tuple(first)
+    for j in range(size - 1, -1, -1):
+        prefix = tuple(first[:j])
+        for x in range(first[j] + 1, n - (size - j - 1)):
+            for rest in combinations(range(x + 1, n), size - j - 1):
+                yield prefix + (x,) + rest
+
+
+def gray_rows(masks, w1, allow_incomplete, best_explanations, ranks):
+    """
+    Check every combination in the powerset of W1's potential ancestors, and
+    yield the rows for those we want.
+
+    The combinations are visited in Gray code order, so each one differs from
+    the last by adding or removing a single potential ancestor. We keep count
+    of how many of each variant unit's explanations are satisfied, and only
+    update the explanations that include that potential ancestor - rather than
+    checking everything again. The variant units explained by agreement and
+    by posterity are kept as bitsets (Python ints, see
+    ExplanationMasks.packed_result), flipping just the bits whose count
+    changes to or from zero.
+
+    @param masks: ExplanationMasks for W1
+    @param best_explanations: dict of size to best Stellen of complete combinations - updated as we go
+    """
+    n = len(masks.pot_an)
+    total = 2 ** n
+    progress = Progress(w1, total)
+
+    # The explanations each potential ancestor is part of
+    containing = [[] for _ in range(n)]
+    missing = []  # number of members of each explanation not in the combination
+    for k, (_, _, wits) in enumerate(masks.explanations):
+        missing.append(len(wits))
+        for wit in wits:
+            containing[masks.index[wit]].append(k)
+
+    # Number of satisfied explanations for each variant unit - by agreement,
+    # by agreement or posterity, and at all
+    n_agree = [0] * masks.n_vus
+    n_le2 = [0] * masks.n_vus
+    n_any = [0] * masks.n_vus
+    # Number of variant units with any of those
+    counts = {'agree': 0, 'le2': 0, 'any': 0}
+    # Bitsets of the variant units with any agreement or le2 explanations
+    bits = {'agree': 0, 'le2': 0}
+    vu_bits = [masks.vu_bit(col) for col in range(masks.n_vus)]
+
+    def satisfied(k, delta):
+        col, gen, _ = masks.explanations[k]
+        for key, per_vu, applies in (('agree', n_agree, gen == 1),
+                                     ('le2', n_le2, gen <= 2),
+                                     ('any', n_any, True)):
+            if not applies:
+                continue
+            before = per_vu[col]
+            per_vu[col] += delta
+            if not before or not per_vu[col]:
+                # 0 -> 1 or 1 -> 0
+                counts[key] += delta
+                if key in bits:
+                    bits[key] ^= vu_bits[col]
+
+    comb_mask = 0  # bit i set if pot_an[i] is in the combination
+    size = 0
+    sum_rank = 0
+    pot_an_ranks = [ranks[x] for x in masks.pot_an]
+    numrows = 0
+    for step in range(1, total):
+        if not step % 1024:
+            progress.update(step, numrows)
+
+        # The bit to flip is the lowest set bit of the step number
+        i = (step & -step).bit_length() - 1
+        comb_mask ^= 1 << i
+        if comb_mask >> i & 1:
+            size += 1
+            sum_rank += pot_an_ranks[i]
+            for k in containing[i]:
+                missing[k] -= 1
+                if not missing[k]:
+                    satisfied(k, 1)
+        else:
+            size -= 1
+            sum_rank -= pot_an_ranks[i]
+            for k in containing[i]:
+                if not missing[k]:
+                    satisfied(k, -1)
+                missing[k] += 1
+
+        if not size:
+            # The empty set
             continue
 
-        vu_combs, wit_combs = vu_map[vu]
-        best_gen = None
-        for i, c in enumerate(wit_combs):
-            if c <= comb_s:
-                # This one is catered for
-                gen = max(x.gen for x in vu_combs[i])
-                if best_gen is None or gen < best_gen:
-                    best_gen = gen
-
-        if best_gen is None and not allow_incomplete:
-            # This combination doesn't work
-            ok = False
-            break
-
-        rel = EQUAL
-        if best_gen is None:
-            # This doesn't explain everything
-            rel = None
-        elif best_gen == 2:
-            # Direct parent
-            rel = POSTERIOR
-        elif best_gen > 2:
-            # Too distant a relative. Ancestors in optimal substemmata
-            # must read the same or the direct parent reading.
-            rel = None
-        explanation[idx] = rel
-
-    if not ok:
-        return None
-
-    unexplained = len([x for x in explanation if x is None])
-    ex_by_agreement = len([x for x in explanation if x == EQUAL])
-    size = len(combination)
-    if not unexplained:
-        # Look for the best - which must explain everything
-        best_explanations[size] = max(best_explanations[size], ex_by_agreement)
-
-    row = {
-        'Vorf': ', '.join([pretty_p(x) for x in combination]),
-        'Vorfanz': size,
-        'Stellen': ex_by_agreement,
-        'vus_stellen': ', '.join([my_vus[i][0] for i, x in enumerate(explanation) if x == EQUAL]),
-        'Post': len([x for x in explanation if x == POSTERIOR]),
-        'vus_post': ', '.join([my_vus[i][0] for i, x in enumerate(explanation) if x == POSTERIOR]),
-        'Fragl': len([x for x in explanation if x == UNCL]),
-        'vus_fragl': ', '.join([my_vus[i][0] for i, x in enumerate(explanation) if x == UNCL]),
-        'Offen': unexplained,
-        'vus_offen': ', '.join([my_vus[i][0] for i, x in enumerate(explanation) if x is None]),
-        'sum_rank': sum(ranks[x] for x in combination),
-        'ranks': ", ".join(str(ranks[x]) for x in combination),
-    }
-
-    return row
-
-
-def ResultIter(cursor, arraysize=1000):
-    '''
-    An iterator that uses fetchmany to keep memory usage down
-    From http://code.activestate.com/recipes/137270-use-generators-for-fetching-large-db-record-sets/
-    '''
-    while True:
-        results = cursor.fetchmany(arraysize)
-        if not results:
-            break
+        if counts['le2'] == masks.n_vus:
+            # Complete - so see if it's the best of its size
+            best_explanations[size] = max(best_explanations[size], counts['agree'])
+
+        if allow_incomplete or counts['any'] == masks.n_vus:
+            yield masks.packed_result(comb_mask, size, sum_rank, counts['agree'],
+                                      counts['le2'] - counts['agree'],
+                                      bits['agree'], bits['le2'] & ~bits['agree'])
+            numrows += 1
+
+    progress.finish()
+
+
+def exact_rows(masks, best_explanations, ranks):
+    """
+    Yield the rows for the best complete combinations of each size - I.e.
+    those that get a Hinweis '<<' - from the smallest complete combination up
+    to the smallest combination with the most agreement possible.
+
+    This uses a branch and bound search for each size, rather than checking
+    every combination, so it's practical for witnesses with lots of potential
+    ancestors.
+
+    @param masks: ExplanationMasks for W1
+    @param best_explanations: dict of size to best Stellen of complete combinations - updated as we go
+    """
+    everyone = np.ones(len(masks.pot_an), dtype=bool)
+    agreement, posterity = masks.possible(everyone, everyone, 0)
+    if not (agreement | posterity).all():
+        logger.warning("No combination of potential ancestors explains all the variant units")
+        return
+
+    # Nothing can do better than all the potential ancestors together
+    max_stellen = int(agreement.sum())
+    floor = 0
+    for size in range(1, len(masks.pot_an) + 1):
+        stellen, found, visited = masks.best_complete(size, floor)
+        logger.info("Size %s: found %s optimal combinations with Stellen=%s (searched %s nodes)",
+                    size, len(found), stellen, visited)
+        if not found:
+            # Nothing this small is complete
+            continue
+
+        best_explanations[size] = stellen
+        for comb in found:
+            chosen = np.zeros(len(masks.pot_an), dtype=bool)
+            chosen[list(comb)] = True
+            agreement, posterity = masks.possible(chosen, chosen, 0)
+            yield masks.result(comb, agreement, posterity & ~agreement, ranks)
+
+        if stellen == max_stellen:
+            logger.info("Combinations of size %s have the most agreement possible (%s)", size, stellen)
+            return
+
+        # A bigger combination can always do at least as well, by adding anyone
+        floor = stellen
+
+
+def anytime_search(masks, ranks, w1, output_file, columns, time_budget):
+    """
+    Search for good combinations until the time budget runs out (see
+    AnytimeSearch), rewriting the CSV file with the best found so far as we
+    go.
+
+    The CSV file gets an extra Gap column: how much more agreement (Stellen)
+    a combination of that size could possibly have. So 0 means it's optimal.
+
+    Returns the SubstemmaReducer from the last write.
+    """
+    columns = columns + ['Gap']
+    last_written = [0]
+    reducer = [None]
+
+    def write(force=False):
+        if not force and time.time() - last_written[0] < ANYTIME_WRITE_INTERVAL:
+            return
+        results = sorted(search.best.values())
+        best_explanations = defaultdict(int)
+        for result in results:
+            if not result.offen:
+                best_explanations[result.vorfanz] = max(best_explanations[result.vorfanz], -result.neg_stellen)
+        rows = []
         for result in results:
-            yield result
+            row = masks.make_row(result, ranks)
+            row['Gap'] = search.gap(result)
+            rows.append(row)
+        reducer[0] = write_csv(rows, output_file, columns, best_explanations)
+        last_written[0] = time.time()
+
+    search = AnytimeSearch(masks, ranks, time_budget, on_improve=write)
+    search.run()
+    write(force=True)
+    proven = [size for size, result in search.best.items() if not result.offen and not search.gap(result)]
+    logger.info("Wrote the best combinations found for %s of each size (%s of %s proven optimal) to %s",
+                w1, len(proven), len(search.best), output_file)
+    return reducer[0]
+
+
+class AnytimeSearch(object):
+    """
+    Look for the best combination of each size - I.e. most agreement (Stellen)
+    with nothing unexplained (Offen), then lowest sum_rank - in a fixed time,
+    for when there are too many potential ancestors to check them all.
+
+    This starts with a greedy set cover (keep adding whichever potential
+    ancestor explains the most that's still unexplained), then improves that
+    by local search - swapping one member for another, and dropping or adding
+    one to move between sizes - with random restarts until time runs out or
+    every size found is as good as it could possibly be.
+    """
+    def __init__(self, masks, ranks, time_budget, on_improve=None, seed=0):
+        """
+        @param masks: ExplanationMasks for W1
+        @param ranks: map of witness to rank
+        @param time_budget: seconds to search for
+        @param on_improve: called whenever the best of a size improves
+        """
+        self.masks = masks
+        self.ranks = ranks
+        self.rank_of = [ranks[x] for x in masks.pot_an]
+        self.deadline = time.time() + time_budget
+        self.on_improve = on_improve
+        self.random = random.Random(seed)
+        self.n = len(masks.pot_an)
+        self.best = {}  # size -> Result
+
+        # The most agreement possible for each size: every variant unit with
+        # an explanation by agreement that small
+        nobody = np.zeros(self.n, dtype=bool)
+        everyone = np.ones(self.n, dtype=bool)
+        self.bounds = [int(masks.possible(nobody, everyone, size)[0].sum()) for size in range(self.n + 1)]
+
+    def timed_out(self):
+        return time.time() >= self.deadline
+
+    def gap(self, result):
+        """
+        How much more agreement a combination the size of this one could have
+        """
+        return self.bounds[result.vorfanz] + result.neg_stellen
+
+    def proven(self):
+        """
+        Is the best of each size found so far as good as it could be?
+        """
+        return bool(self.best) and all(not x.offen and not self.gap(x) for x in self.best.values())
+
+    def score(self, result):
+        """
+        Bigger is better
+        """
+        return (-result.offen, -result.neg_stellen, -result.sum_rank)
+
+    def evaluate(self, combs):
+        """
+        Evaluate a list of combinations (tuples of indexes into pot_an) of the
+        same size, recording any that are the best of their size.
+
+        @return: the best of them, as (score, combination)
+        """
+        best = None
+        for i in range(0, len(combs), self.masks.batch_size):
+            batch = combs[i:i + self.masks.batch_size]
+            comb_idx = np.array(batch, dtype=np.intp).reshape(len(batch), len(batch[0]))
+            agreement, posterity, _ = self.masks.evaluate(self.masks.combination_masks(comb_idx))
+            for j, comb in enumerate(batch):
+                result = self.masks.result(comb, agreement[j], posterity[j], self.ranks)
+                score = self.score(result)
+                if best is None or score > best[0]:
+                    best = (score, comb)
+                existing = self.best.get(result.vorfanz)
+                if existing is None or score > self.score(existing):
+                    self.best[result.vorfanz] = result
+                    if self.on_improve is not None:
+                        self.on_improve()
+        return best
+
+    def add_one(self, comb):
+        """
+        @return: the best (score, combination) with one more member, or None
+        """
+        others = [x for x in range(self.n) if x not in comb]
+        if not others:
+            return None
+        return self.evaluate([tuple(sorted(comb + (x,))) for x in others])
+
+    def drop_one(self, comb):
+        """
+        @return: the best (score, combination) with one fewer member, or None
+        """
+        if len(comb) < 2:
+            return None
+        return self.evaluate([comb[:i] + comb[i + 1:] for i in range(len(comb))])
 
+    def local_search(self, comb):
+        """
+        Keep making the best swap of one member for a non-member, while that
+        improves things.
 
-def write_csv(cursor, csv_file, columns, best_explanations):
+        @return: the (score, combination) we end up with
+        """
+        current = self.evaluate([comb])
+        while not self.timed_out():
+            others = [x for x in range(self.n) if x not in current[1]]
+            swaps = [tuple(sorted(current[1][:i] + current[1][i + 1:] + (x,)))
+                     for i in range(len(current[1])) for x in others]
+            if not swaps:
+                break
+            best = self.evaluate(swaps)
+            if best[0] <= current[0]:
+                break
+            current = best
+        return current
+
+    def run(self):
+        """
+        Search until the time runs out, or everything's proven optimal
+        """
+        if not self.n:
+            return
+
+        # Greedy set cover, until everything's explained (or nothing more helps)
+        current = self.add_one(())
+        while not self.timed_out():
+            bigger = self.add_one(current[1])
+            if bigger is None or current[0][0] == 0 or bigger[0][:2] <= current[0][:2]:
+                break
+            current = bigger
+        start = self.local_search(current[1])
+
+        # Then see how small we can go...
+        current = start
+        while not self.timed_out():
+            smaller = self.drop_one(current[1])
+            if smaller is None or smaller[0][0] < 0:
+                # Not complete
+                break
+            current = self.local_search(smaller[1])
+
+        # ... and how much agreement we can get with more
+        current = start
+        while not self.timed_out() and -self.best[len(current[1])].neg_stellen < self.bounds[self.n]:
+            bigger = self.add_one(current[1])
+            if bigger is None:
+                break
+            current = self.local_search(bigger[1])
+
+        # Then random restarts from the best of each size, with a couple of
+        # members swapped at random
+        while not self.timed_out() and not self.proven():
+            comb = list(self.random.choice(list(self.best.values())).comb)
+            others = [x for x in range(self.n) if x not in comb]
+            if not others:
+                break
+            for _ in range(min(2, len(comb), len(others))):
+                i = self.random.randrange(len(comb))
+                j = self.random.randrange(len(others))
+                comb[i], others[j] = others[j], comb[i]
+            self.local_search(tuple(sorted(comb)))
+
+
+def combination_batches(n_pot_an, total, batch_size, start=0):
     """
-    Take the tmp database, and create a sorted CSV file with the Hinweis '<<' entries
+    Yield batches of combinations of potential ancestors, in the same order as
+    the powerset (smallest first), from the start'th up to total combinations
+    (including the empty set).
+
+    Each batch is a 2D array of indexes into pot_an - one row per combination,
+    so all the combinations in a batch are the same size.
     """
+    remaining = total - start
+    for size in range(n_pot_an + 1):
+        n_of_size = math.comb(n_pot_an, size)
+        if start >= n_of_size:
+            # All before the start
+            start -= n_of_size
+            continue
+        elif start:
+            all_of_size = combinations_from(n_pot_an, unrank_combination(n_pot_an, size, start))
+            start = 0
+        else:
+            all_of_size = combinations(range(n_pot_an), size)
+
+        while remaining > 0:
+            batch = list(islice(all_of_size, min(batch_size, remaining)))
+            if not batch:
+                break
+            remaining -= len(batch)
+            yield np.array(batch, dtype=np.intp).reshape(len(batch), size)
+
+        if remaining <= 0:
+            return
+
+
+class ExplanationMasks(object):
+    """
+    The explanations for each of W1's variant units, compiled into bitmasks
+    over W1's potential ancestors - so that we can check whole batches of
+    combinations at once.
+
+    A combination is an array of uint64 words with bit i set if it includes
+    pot_an[i]. It explains a variant unit (in a particular way) if it is a
+    superset of one of that variant unit's explanations: (comb & mask) == mask.
+    """
+    def __init__(self, pot_an, my_vus, vu_map):
+        """
+        @param pot_an: W1's potential ancestors
+        @param my_vus: W1's variant units (see load_data)
+        @param vu_map: map of variant unit to (parent combinations, sets of witnesses in them),
+                       for each variant unit that doesn't have an UNCL parent
+        """
+        self.pot_an = pot_an
+        self.index = {x: i for i, x in enumerate(pot_an)}
+        self.n_words = max(1, (len(pot_an) + 63) // 64)
+
+        # Variant units with unclear parents can't be explained (Fragl)
+        self.vus = [vu for (vu, _, _) in my_vus if vu in vu_map]
+        self.vus_fragl = [vu for (vu, _, _) in my_vus if vu not in vu_map]
+        self.n_vus = len(self.vus)
+        self.n_bytes = (self.n_vus + 7) // 8
+
+        # Split the explanations up by the generation they explain things at:
+        # gen 1 means agreement (Stellen) and gen 2 means posterity (Post).
+        # Anything further away doesn't count, but does still make a
+        # combination "complete".
+        by_agreement, by_posterity, by_any = [], [], []
+        self.explanations = []  # (column, generation, witness set)
+        for col, vu in enumerate(self.vus):
+            vu_combs, wit_combs = vu_map[vu]
+            for parent_comb, wits in zip(vu_combs, wit_combs):
+                if not wits <= self.index.keys():
+                    # Can never be satisfied by a combination of our potential ancestors
+                    continue
+                gen = max(x.gen for x in parent_comb)
+                if gen == 1:
+                    by_agreement.append((col, wits))
+                elif gen == 2:
+                    by_posterity.append((col, wits))
+                by_any.append((col, wits))
+                self.explanations.append((col, gen, wits))
+
+        self._agreement = self._compile(by_agreement)
+        self._posterity = self._compile(by_posterity)
+        self._any = self._compile(by_any)
+
+        # Keep the (batch x explanations x words) arrays a sensible size
+        self.batch_size = max(1, min(MAX_BATCH_SIZE, BATCH_ELEMENTS // max(1, len(by_any) * self.n_words)))
+
+    def _compile(self, explanations):
+        """
+        Turn a list of (column, witness set) into an array of bitmasks, plus
+        the start of each column's group and the column numbers - ready for
+        reduceat - and a 0/1 membership matrix.
+        """
+        masks = np.zeros((len(explanations), self.n_words), dtype=np.uint64)
+        for k, (_, wits) in enumerate(explanations):
+            for wit in wits:
+                i = self.index[wit]
+                masks[k, i // 64] |= np.uint64(1) << np.uint64(i % 64)
+
+        # Which potential ancestors are in each explanation - for the exact search
+        members = np.zeros((len(explanations), len(self.pot_an)), dtype=np.int32)
+        for k, (_, wits) in enumerate(explanations):
+            members[k, [self.index[x] for x in wits]] = 1
+
+        cols = [col for col, _ in explanations]
+        starts = [k for k in range(len(cols)) if k == 0 or cols[k] != cols[k - 1]]
+        return (masks, np.array(starts, dtype=np.intp), np.array([cols[k] for k in starts], dtype=np.intp),
+                members)
+
+    def combination_masks(self, comb_idx):
+        """
+        Convert a batch of combinations (see combination_batches) into bitmasks
+        """
+        ret = np.zeros((len(comb_idx), self.n_words), dtype=np.uint64)
+        rows = np.arange(len(comb_idx))
+        for j in range(comb_idx.shape[1]):
+            ret[rows, comb_idx[:, j] // 64] |= np.left_shift(np.uint64(1), (comb_idx[:, j] % 64).astype(np.uint64))
+        return ret
+
+    def _covered(self, comb_masks, compiled):
+        """
+        Return a (combinations x variant units) boolean array showing where
+        each combination satisfies one of the compiled explanations
+        """
+        masks, starts, cols, _ = compiled
+        ret = np.zeros((len(comb_masks), self.n_vus), dtype=bool)
+        if len(masks):
+            hit = ((comb_masks[:, None, :] & masks[None, :, :]) == masks[None, :, :]).all(axis=2)
+            ret[:, cols] = np.logical_or.reduceat(hit, starts, axis=1)
+        return ret
+
+    def evaluate(self, comb_masks):
+        """
+        Evaluate a batch of combinations.
+
+        @return: three (combinations x variant units) boolean arrays - showing
+                 which variant units are explained by agreement, by posterity
+                 (and not agreement) and at all.
+        """
+        agreement = self._covered(comb_masks, self._agreement)
+        posterity = self._covered(comb_masks, self._posterity) & ~agreement
+        explained = self._covered(comb_masks, self._any)
+        return agreement, posterity, explained
+
+    def _possible(self, compiled, chosen, allowed, slots):
+        """
+        Return a boolean array over the variant units showing which could be
+        explained by one of the compiled explanations, by adding at most slots
+        more of the allowed potential ancestors to the chosen ones.
+        """
+        _, starts, cols, members = compiled
+        ret = np.zeros(self.n_vus, dtype=bool)
+        if len(members):
+            missing = members @ (~chosen).astype(np.int32)
+            blocked = members @ (~allowed).astype(np.int32)
+            ret[cols] = np.logical_or.reduceat((blocked == 0) & (missing <= slots), starts)
+        return ret
+
+    def possible(self, chosen, allowed, slots):
+        """
+        Which variant units could be explained by agreement, and which by
+        posterity, by adding at most slots more of the allowed potential
+        ancestors to the chosen ones? With slots=0 this is exact.
+
+        @param chosen: boolean array over pot_an
+        @param allowed: boolean array over pot_an (including the chosen ones)
+        @return: two boolean arrays over the variant units
+        """
+        return (self._possible(self._agreement, chosen, allowed, slots),
+                self._possible(self._posterity, chosen, allowed, slots))
+
+    def best_complete(self, size, floor=0):
+        """
+        Branch and bound search for the complete combinations of this size
+        with the most agreement (Stellen).
+
+        A branch (the combinations starting with some chosen potential
+        ancestors, and continuing with later ones) is pruned if it can't
+        explain every variant unit, or if it can't explain as many by
+        agreement as the best so far - or floor, which must be achievable.
+
+        @return: (best Stellen, list of optimal combinations as tuples of
+                  indexes into pot_an, number of search nodes visited)
+        """
+        n = len(self.pot_an)
+        chosen = np.zeros(n, dtype=bool)
+        comb = []
+        best = {'stellen': floor, 'found': [], 'visited': 0}
+
+        def search(next_idx):
+            best['visited'] += 1
+            slots = size - len(comb)
+            allowed = chosen.copy()
+            allowed[next_idx:] = True
+            agreement, posterity = self.possible(chosen, allowed, slots)
+            if not (agreement | posterity).all():
+                # Can't be complete
+                return
+
+            upper = int(agreement.sum())
+            if upper < best['stellen']:
+                # Can't be optimal
+                return
+
+            if not slots:
+                # A whole combination - so upper is its actual Stellen
+                if upper > best['stellen']:
+                    best['stellen'] = upper
+                    best['found'] = []
+                best['found'].append(tuple(comb))
+                return
+
+            for i in range(next_idx, n - slots + 1):
+                chosen[i] = True
+                comb.append(i)
+                search(i + 1)
+                chosen[i] = False
+                comb.pop()
+
+        search(0)
+        return best['stellen'], best['found'], best['visited']
+
+    def result(self, comb, agreement, posterity, ranks):
+        """
+        Make the compact Result for one combination
+
+        @param comb: the combination (indexes into pot_an)
+        @param agreement: boolean array of variant units explained by agreement
+        @param posterity: boolean array of variant units explained by posterity
+        @param ranks: map of witness to rank
+        """
+        stellen = int(agreement.sum())
+        post = int(posterity.sum())
+        return Result(-stellen, -post, self.n_vus - stellen - post, len(comb),
+                      sum(ranks[self.pot_an[i]] for i in comb), tuple(int(x) for x in comb),
+                      np.packbits(agreement).tobytes(), np.packbits(posterity).tobytes())
+
+    def vu_bit(self, col):
+        """
+        The bit for the col'th variant unit in a bitset for packed_result
+        """
+        return 1 << (8 * self.n_bytes - 1 - col)
+
+    def packed_result(self, comb_mask, size, sum_rank, stellen, post, agreement, posterity):
+        """
+        Make the compact Result for one combination, from bitsets that are
+        already laid out like np.packbits (see vu_bit) - without going via
+        arrays.
+
+        @param comb_mask: int with bit i set if the combination includes pot_an[i]
+        @param size: number of potential ancestors in the combination
+        @param sum_rank: sum of their ranks
+        @param stellen: number of variant units explained by agreement
+        @param post: number of variant units explained by posterity
+        @param agreement: bitset of variant units explained by agreement
+        @param posterity: bitset of variant units explained by posterity
+        """
+        comb = []
+        while comb_mask:
+            low = comb_mask & -comb_mask
+            comb.append(low.bit_length() - 1)
+            comb_mask ^= low
+        return Result(-stellen, -post, self.n_vus - stellen - post, size, sum_rank, tuple(comb),
+                      agreement.to_bytes(self.n_bytes, 'big'), posterity.to_bytes(self.n_bytes, 'big'))
+
+    def make_row(self, result, ranks):
+        """
+        Make the output row for a Result
+        """
+        combination = [self.pot_an[i] for i in result.comb]
+        agreement = self._unpack(result.agreement)
+        posterity = self._unpack(result.posterity)
+        offen = ~(agreement | posterity)
+        return {
+            'Vorf': ', '.join([pretty_p(x) for x in combination]),
+            'Vorfanz': len(combination),
+            'Stellen': int(agreement.sum()),
+            'vus_stellen': ', '.join([self.vus[i] for i in np.flatnonzero(agreement)]),
+            'Post': int(posterity.sum()),
+            'vus_post': ', '.join([self.vus[i] for i in np.flatnonzero(posterity)]),
+            'Fragl': len(self.vus_fragl),
+            'vus_fragl': ', '.join(self.vus_fragl),
+            'Offen': int(offen.sum()),
+            'vus_offen': ', '.join([self.vus[i] for i in np.flatnonzero(offen)]),
+            'sum_rank': sum(ranks[x] for x in combination),
+            'ranks': ", ".join(str(ranks[x]) for x in combination),
+        }
+
+    def _unpack(self, packed):
+        return np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=self.n_vus).astype(bool)
+
+
+def write_csv(rows, csv_file, columns, best_explanations):
+    """
+    Write the rows (dicts, already sorted) to a CSV file, adding the Hinweis '<<' entries
+
+    Returns a SubstemmaReducer that has seen all the rows.
+    """
+    reducer = SubstemmaReducer()
     # Column headers: Vorf,Vorfanz,Stellen,Post,Fragl,Offen,Hinweis,sum_rank,ranks,vus_stellen,vus_post,vus_fragl,vus_offen
-    # Sort the CSV file to make the "best" combinations appear at the top - I.e. those with the most agreement
-    # and then agreement by posterity, then with fewest errors, then fewest unknown sources, then fewest witnesses
-    # in the combination, and finally the sum of the rank of those witnesses. This is just to help the user when
-    # they get the file.
-    sql = "SELECT {} FROM tmp ORDER BY Stellen DESC, Post DESC, Offen ASC, Fragl ASC, Vorfanz ASC, sum_rank ASC".format(
-        ', '.join(columns))
-    cursor.execute(sql)
-    with open(csv_file, 'w', newline='') as fd:
-        csv_obj = csv.DictWriter(fd, columns)
+    # Write it under another name first - as if it exists, we'll skip this witness next time
+    with open(csv_file + '.tmp', 'w', newline='') as fd:
+        csv_obj = csv.DictWriter(fd, columns, extrasaction='ignore')
         csv_obj.writeheader()
-        for result in ResultIter(cursor):
-            row = {col: result[i] for i, col in enumerate(columns)}
+        for row in rows:
             if row['Stellen'] == best_explanations[row['Vorfanz']]:
                 # Add the magic "<<" entries that make these files easy to use
                 row['Hinweis'] = '<<'
 
             csv_obj.writerow(row)
+            reducer.add(row)
+    os.replace(csv_file + '.tmp', csv_file)
+    return reducer
+
+
+def vorf_str_to_set(vorf):
+    """
+    Convert a Vorf string into a Python set with the Vorf values in it,
+    appropriately quoted.
+    """
+    bits = [x.strip() for x in vorf.split(',')]
+    bits_str = ["'{}'".format(x) for x in bits]
+    return "{%s}" % ', '.join(bits_str)
+
+
+Substemma = namedtuple('Substemma', ['witness', 'alternatives', 'note'])
+Substemma.__doc__ = """
+The recommended optimal substemma for a witness. The alternatives are Vorf
+strings - just one, unless human thought is required (when the note is
+'UNKNOWN') or none at all, if no combinations could be considered.
+"""
+
+
+class SubstemmaReducer(object):
+    """
+    Pick the recommended optimal substemma from a witness's combanc rows, one
+    row at a time (in CSV order), so they don't all have to be kept:
+
+     1. Use the Hinweis '<<' rows, if there are any
+     2. ... with the minimum Offen (of all the rows)
+     3. Take the best of each size (lowest Post, then lowest sum_rank)
+     4. Keep the smallest of those for each Post
+     5. If there's more than one left, consider those within
+        max_by_posterity of the lowest Post
+
+    The rows can be dicts from the CSV file (strings) or as they're written
+    (numbers).
+    """
+    def __init__(self):
+        self.numrows = 0
+        self.has_hinweis = False
+        self.min_offen = None
+        # The Hinweis '<<' rows, and all rows: [min Offen, rows with it, best row of each size with it]
+        self.tracks = {True: [None, 0, {}], False: [None, 0, {}]}
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        """
+        Make a SubstemmaReducer from an existing CSV file
+        """
+        reducer = cls()
+        with open(csv_file, newline='') as f:
+            for row in csv.DictReader(f):
+                reducer.add(row)
+        return reducer
+
+    def add(self, row):
+        """
+        Add the next row
+        """
+        self.numrows += 1
+        offen = int(row['Offen'])
+        if self.min_offen is None or offen < self.min_offen:
+            self.min_offen = offen
+        hinweis = row.get('Hinweis') == '<<'
+        self.has_hinweis = self.has_hinweis or hinweis
+
+        for track in ((True, False) if hinweis else (False, )):
+            best = self.tracks[track]
+            if best[0] is None or offen < best[0]:
+                best[:] = [offen, 0, {}]
+            if offen != best[0]:
+                continue
+            best[1] += 1
+            best_by_size = best[2]
+            existing = best_by_size.get(int(row['Vorfanz']))
+            if (not existing
+                    or int(row['Post']) < int(existing['Post'])
+                    or (int(row['Post']) == int(existing['Post'])
+                        and int(row['sum_rank']) < int(existing['sum_rank']))):
+                # It's the first of this size, or it explains fewer by posterity, or
+                # it has lower sum_rank while explaining the same number by posterity
+                best_by_size[int(row['Vorfanz'])] = row
+
+    def best_rows(self):
+        """
+        Return the number of rows left after steps 1 and 2, and the best of
+        each size of them
+        """
+        min_offen, count, best_by_size = self.tracks[self.has_hinweis]
+        if min_offen != self.min_offen:
+            # None of the Hinweis rows have the minimum Offen
+            return 0, {}
+        return count, best_by_size
+
+    def substemma(self, witness, max_by_posterity=10, log=logger.debug):
+        """
+        Return the Substemma for this witness
+
+        @param log: function to describe the reasoning with
+        """
+        count, best_by_size = self.best_rows()
+        log("Loaded %s rows", self.numrows)
+        if self.has_hinweis:
+            log("Restricting search to Hinweis '<<' rows")
+        log("Min 'Offen' is %s", self.min_offen)
+        log('%s rows have Offen=%s', count, self.min_offen)
+        log("Restricted to the best of each combination size: %s combinations left", len(best_by_size))
+
+        # Find combinations that are as good but with fewer members
+        best_by_post = {}
+        for row in best_by_size.values():
+            existing = best_by_post.get(int(row['Post']))
+            if not existing or int(row['Vorfanz']) < int(existing['Vorfanz']):
+                best_by_post[int(row['Post'])] = row
+
+        log("Excluded rows with more combinations but no better results: %s combinations left", len(best_by_post))
+
+        if len(best_by_post) == 1:
+            comb = list(best_by_post.values())[0]['Vorf']
+            log("Only one combination left: %s", comb)
+            return Substemma(witness, [comb], 'simple')
+
+        log("Human thought required (probably)...")
+        considered = []
+        best_post = min(best_by_post.keys(), default=0)
+        for k in sorted(best_by_post.keys()):
+            row = best_by_post[k]
+            if k - best_post > max_by_posterity:
+                # That's too many to consider by posterity
+                log("Too large a difference by posterity (%s), skipping combination %s",
+                    k - best_post, vorf_str_to_set(row['Vorf']))
+                continue
+
+            if considered:
+                last_row = considered[-1]
+                my_post_vus = set([x.strip() for x in row['vus_post'].split(',')])
+                his_post_vus = set([x.strip() for x in last_row['vus_post'].split(',')])
+                log("Combination %s explains the following by posterity (compared to %s): %s",
+                    vorf_str_to_set(row['Vorf']), vorf_str_to_set(last_row['Vorf']), my_post_vus - his_post_vus)
+                if not his_post_vus.issubset(my_post_vus):
+                    log("... and the other way round: %s", his_post_vus - my_post_vus)
+            else:
+                log("Combination %s explains the most by agreement", vorf_str_to_set(row['Vorf']))
+            considered.append(row)
+
+        if len(considered) == 1:
+            return Substemma(witness, [considered[0]['Vorf']], 'simple, in the end')
+        if not considered:
+            log("WARNING: No combinations considered!")
+            return Substemma(witness, [], None)
+        return Substemma(witness, [x['Vorf'] for x in considered], 'UNKNOWN')
+
+
+def write_optimal_substemmata(substemmata, output_file):
+    """
+    Write the Substemmas to a Python file, as the optimal_substemmata input
+    for the global stemma (see global_stemma.load). Those that need human
+    thought list all the alternatives, and those with no combinations are
+    commented out.
+    """
+    with open(output_file + '.tmp', 'w') as f:
+        f.write("# Recommended optimal substemmata, from the combinations of ancestors\n")
+        f.write("optimal_substemmata = {\n")
+        for sub in substemmata:
+            if not sub.alternatives:
+                f.write("    # '{}': [],  # no combinations considered\n".format(sub.witness))
+            elif sub.note == 'UNKNOWN':
+                f.write("    '{}': [{}],  # UNKNOWN - human thought required\n".format(
+                    sub.witness, ', '.join(vorf_str_to_set(x) for x in sub.alternatives)))
+            else:
+                f.write("    '{}': [{}],  # {}\n".format(sub.witness, vorf_str_to_set(sub.alternatives[0]),
+                                                       sub.note))
+        f.write("}\n")
+    os.replace(output_file + '.tmp', output_file)
+    logger.info("Wrote the optimal substemmata for %s witnesses to %s", len(substemmata), output_file)
 
 
 def mpi_child_wrapper(*args):
@@ -342,13 +1702,131 @@ def mpi_child_wrapper(*args):
         return (key, generate_genealogical_coherence_cache(*args[1:]))
     elif key == "COMBANC":
         return (key, combinations_of_ancestors(*args[1:]))
+    elif key == "COMBANC_RANGE":
+        return (key, mpi_combanc_range(*args[1:]))
     else:
         raise KeyError("Unknown MPI child key: {}".format(key))
 
 
+# The masks for the witness this MPI child last worked on - as it's likely to
+# be given another range for the same witness
+_range_masks = {}
+
+
+def mpi_combanc_range(db_file, w1, max_comb_len, prune, start, stop, allow_incomplete, run_file, sort_memory):
+    """
+    MPI child: check a range of W1's combinations (see combanc_range)
+    """
+    key = (db_file, w1, max_comb_len, prune)
+    if key not in _range_masks:
+        _range_masks.clear()
+        _range_masks[key] = load_masks(*key)
+    masks, ranks, _ = _range_masks[key]
+    ret = combanc_range(masks, ranks, w1, start, stop, allow_incomplete, run_file, sort_memory)
+
+    # Record that this range is done, in case we have to resume
+    with open(run_file + '.json.tmp', 'w') as f:
+        json.dump(ret, f)
+    os.replace(run_file + '.json.tmp', run_file + '.json')
+    return ret
+
+
 class MpiHandler(mpisupport.MpiParent):
     mpi_child_timeout = 3600 * 4  # 4 hours
 
+    def __init__(self, processes=None, journal=None, telemetry=None):
+        super().__init__(child_function=mpi_child_wrapper, processes=processes, journal=journal,
+                         telemetry=telemetry)
+        # Witnesses split into ranges: w1 -> dict of the details and the
+        # ranges still to do.
+        self.split_witnesses = {}
+        # mpi_handle_result is called from the child manager threads
+        self.lock = threading.Lock()
+        # w1 -> recommended optimal substemma
+        self.substemmata = {}
+        # w1 -> number of combinations to check (see mpi_task_size)
+        self.task_sizes = {}
+
+    def mpi_task_size(self, args):
+        """
+        How many combinations a COMBANC or COMBANC_RANGE task has to check
+        """
+        key = args[0]
+        if key == "COMBANC":
+            return self.task_sizes.get(args[2], 1)
+        elif key == "COMBANC_RANGE":
+            start, stop = args[5:7]
+            return stop - start
+        return 1
+
+    def mpi_replayable(self, args, ret):
+        """
+        The journal's results are no good without the files the children
+        wrote - a range's run file (which goes once they're merged), or a
+        witness's CSV file
+        """
+        key = args[0]
+        if key == "COMBANC":
+            w1, suffix = args[2], args[6]
+            return os.path.exists("{}{}.csv".format(w1, suffix))
+        elif key == "COMBANC_RANGE":
+            return os.path.exists(args[8])
+        return True
+
+    def queue_ranges(self, db_file, w1, max_comb_len, total, *, allow_incomplete, debug, suffix, frontier,
+                     sort_memory, resume=False, prune=False):
+        """
+        Queue up W1's combinations, split into ranges of MPI_RANGE_SIZE.
+
+        The run files go in a directory next to the output file, as the
+        children might be on different machines.
+
+        @param resume: don't queue the ranges that were done last time
+        """
+        run_dir = work_dir(w1, suffix)
+        params = {'max_comb_len': max_comb_len, 'allow_incomplete': allow_incomplete, 'total': total,
+                  'prune': prune,
+                  'range_size': MPI_RANGE_SIZE, 'db_file': db_file, 'data': coherence_fingerprint(db_file)}
+        params_file = os.path.join(run_dir, 'ranges.json')
+        if resume and os.path.exists(params_file):
+            with open(params_file) as f:
+                if json.load(f) != params:
+                    logger.warning("Ranges in %s are for different parameters or data - starting again", run_dir)
+                    resume = False
+        if not resume and os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir, exist_ok=True)
+        with open(params_file, 'w') as f:
+            json.dump(params, f)
+
+        ranges = powerset_ranges(total, (total + MPI_RANGE_SIZE - 1) // MPI_RANGE_SIZE)
+        logger.info("Splitting %s combinations for %s into %s ranges", total, w1, len(ranges))
+        with self.lock:
+            self.split_witnesses[w1] = {
+                'db_file': db_file, 'max_comb_len': max_comb_len, 'prune': prune, 'debug': debug, 'suffix': suffix,
+                'frontier': frontier, 'sort_memory': sort_memory, 'run_dir': run_dir,
+                'run_files': [], 'remaining': len(ranges), 'numrows': 0,
+                'best_explanations': defaultdict(int)}
+
+        to_do = []
+        for i, (start, stop) in enumerate(ranges):
+            run_file = os.path.join(run_dir, 'range{}'.format(i))
+            with self.lock:
+                self.split_witnesses[w1]['run_files'].append(run_file)
+            if os.path.exists(run_file + '.json'):
+                # Done last time
+                with open(run_file + '.json') as f:
+                    self.range_done(w1, json.load(f))
+            else:
+                to_do.append(("COMBANC_RANGE", db_file, w1, max_comb_len, prune, start, stop, allow_incomplete,
+                              run_file, sort_memory))
+
+        if len(to_do) < len(ranges):
+            logger.info("Resuming %s - %s of %s ranges were already done", w1, len(ranges) - len(to_do),
+                        len(ranges))
+        for args in to_do:
+            self.mpi_queue.put(args)
+
     def mpi_handle_result(self, args, ret):
         """
         Handle an MPI result
@@ -356,29 +1834,89 @@ class MpiHandler(mpisupport.MpiParent):
         @param ret: response from the child
         """
         key = ret[0]
-        if key in ("GENCOH", "COMBANC"):
-            # There's nothing to do for genealogical coherence, since the point
-            # is just to store it in a cache - and the child did that.
-            # Likewise for combanc, the child has written out the data.
-            assert ret[1] is True, ret
+        if key == "GENCOH":
+            genealogical_coherence_done(self, args, ret[1])
+        elif key == "COMBANC":
+            # The child has written out the data, so there's just the substemma
+            assert ret[1], ret
+            with self.lock:
+                self.substemmata[args[2]] = ret[1]
+        elif key == "COMBANC_RANGE":
+            self.range_done(args[2], ret[1])
         else:
             raise KeyError("Unknown MPI child key: {}".format(key))
 
+    def range_done(self, w1, ret):
+        """
+        A range for W1 is done - and if it was the last one, merge them all
+        into the CSV file
 
-def combanc_for_all_witnesses_mpi(db_file, max_comb_len, *, allow_incomplete=True, debug=False, suffix=''):
+        @param ret: what combanc_range returned
+        """
+        numrows, best = ret
+        with self.lock:
+            details = self.split_witnesses[w1]
+            details['numrows'] += numrows
+            for size, stellen in best.items():
+                # (The keys are strings if they've been through JSON)
+                details['best_explanations'][int(size)] = max(details['best_explanations'][int(size)], stellen)
+            details['remaining'] -= 1
+            if details['remaining']:
+                return
+            del self.split_witnesses[w1]
+
+        self.merge_ranges(w1, details)
+
+    def merge_ranges(self, w1, details):
+        """
+        Merge the sorted ranges for W1 into its CSV file
+        """
+        logger.info("Created %s rows for %s - merging %s ranges", details['numrows'], w1,
+                    len(details['run_files']))
+        masks, ranks, _ = load_masks(details['db_file'], w1, details['max_comb_len'], details['prune'])
+        results = heapq.merge(*[read_run(x) for x in details['run_files']])
+        reducer = write_results(results, masks, ranks, "{}{}.csv".format(w1, details['suffix']),
+                                define_columns(details['debug']), details['best_explanations'], presorted=True,
+                                frontier=details['frontier'], sort_memory=details['sort_memory'])
+        shutil.rmtree(details['run_dir'])
+        with self.lock:
+            self.substemmata[w1] = reducer.substemma(w1)
+
+
+def combanc_for_all_witnesses_mpi(db_file, max_comb_len, *, allow_incomplete=True, debug=False, suffix='',
+                                  engine='powerset', frontier=False, sort_memory=DEFAULT_SORT_MEMORY,
+                                  checkpoint_interval=0, resume=False, prune=False,
+                                  time_budget=None, optsub_file=None, processes=None, journal_file=None,
+                                  telemetry_file=None):
     """
-    Generate combination of ancestor info for all witnesses, using MPI.
+    Generate combination of ancestor info for all witnesses, using MPI - or
+    local processes, if we're not run under MPI.
+
+    Witnesses with more than MPI_RANGE_SIZE combinations to check with the
+    powerset engine are split into ranges, so that they're shared between
+    the children too.
 
     See combinations_of_ancestors for description of arguments.
-    """
-    if 'OMPI_COMM_WORLD_SIZE' not in os.environ:
-        raise IOError("This must be run with MPI support (e.g. mpirun)")
 
-    # We have been run with mpiexec
+    @param optsub_file: write the recommended optimal substemmata to this
+                        file (see write_optimal_substemmata)
+    @param processes: how many local processes to use, if we're not run
+                      under MPI (default mpisupport.local_processes())
+    @param journal_file: record the tasks and their results in this file,
+                         so that if this is interrupted and run again, only
+                         the unfinished tasks are done again (see
+                         task_journal.TaskJournal)
+    @param telemetry_file: record the performance of each task in this file
+                           (see telemetry.py)
+    """
     mpi_parent = mpisupport.is_parent()
 
     if mpi_parent:
-        mpihandler = MpiHandler()
+        journal = None
+        if journal_file:
+            journal = TaskJournal(journal_file, context=coherence_fingerprint(db_file))
+        telemetry = TelemetryWriter(telemetry_file) if telemetry_file else None
+        mpihandler = MpiHandler(processes, journal=journal, telemetry=telemetry)
     else:
         # MPI child
         mpisupport.mpi_child(mpi_child_wrapper)
@@ -389,8 +1927,7 @@ def combanc_for_all_witnesses_mpi(db_file, max_comb_len, *, allow_incomplete=Tru
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
     witnesses = [x[0] for x in list(cursor.execute(sql))]
-    for w1 in witnesses:
-        mpihandler.mpi_queue.put(("GENCOH", w1, db_file))
+    queue_genealogical_coherence(mpihandler, db_file, witnesses)
 
     # Wait for the queue, but leave the remote children running
     mpihandler.mpi_wait(stop=False)
@@ -399,8 +1936,38 @@ def combanc_for_all_witnesses_mpi(db_file, max_comb_len, *, allow_incomplete=Tru
     if mpi_parent:
         for i, w1 in enumerate(witnesses):
             logger.debug("Queueing for witness %s (%s of %s)", w1, i + 1, len(witnesses))
-            mpihandler.mpi_queue.put(("COMBANC", db_file, w1, max_comb_len, allow_incomplete, debug, suffix))
-        return mpihandler.mpi_wait(stop=True)
+            output_exists = os.path.exists("{}{}.csv".format(w1, suffix))
+            can_split = engine == 'powerset' and not time_budget and not output_exists
+            if output_exists:
+                # There's just the optimal substemma to read from it
+                total = 1
+            elif can_split and prune:
+                # We have to work out what's left
+                total = load_masks(db_file, w1, max_comb_len, prune)[2]
+            else:
+                # The coherence is cached now, so this is quick
+                coh = GenealogicalCoherence(db_file, w1, pretty_p=False, use_cache=True)
+                total = 2 ** len(coh.potential_ancestors())
+            if max_comb_len != -1:
+                total = min(total, max_comb_len)
+            if can_split and total > MPI_RANGE_SIZE:
+                mpihandler.queue_ranges(db_file, w1, max_comb_len, total, allow_incomplete=allow_incomplete,
+                                        debug=debug, suffix=suffix, frontier=frontier,
+                                        sort_memory=sort_memory, prune=prune,
+                                        # The journal's results need the run files that are done
+                                        resume=resume or journal is not None)
+                continue
+
+            # So the biggest go first
+            mpihandler.task_sizes[w1] = total
+            mpihandler.mpi_queue.put(("COMBANC", db_file, w1, max_comb_len, allow_incomplete, debug, suffix,
+                                      engine, frontier, sort_memory, 1, checkpoint_interval, resume, prune,
+                                      time_budget))
+        ret = mpihandler.mpi_wait(stop=True)
+        if optsub_file:
+            write_optimal_substemmata([mpihandler.substemmata[x] for x in witnesses
+                                       if x in mpihandler.substemmata], optsub_file)
+        return ret
     else:
         # MPI child - nothing to do as the children are already running
         pass
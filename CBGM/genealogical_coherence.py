@@ -4,9 +4,10 @@ from collections import defaultdict, namedtuple
 from itertools import product, chain
 from toposort import toposort
 import logging
+import os
 
-from .shared import PRIOR, POSTERIOR, NOREL, EQUAL, INIT, OL_PARENT, UNCL, LAC
-from .pre_genealogical_coherence import Coherence
+from .shared import PRIOR, POSTERIOR, NOREL, EQUAL, INIT, OL_PARENT, UNCL, LAC, memoize
+from .pre_genealogical_coherence import Coherence, share_attestations, share_coherence, connect
 logger = logging.getLogger(__name__)
 
 
@@ -326,6 +327,12 @@ class GenealogicalCoherence(Coherence):
 
         return True
 
+    def get_parent_reading(self, reading):
+        """
+        Get the parent reading for this reading in our variant unit
+        """
+        return ReadingRelationship(self.variant_unit, reading, self.cursor).get_parent_reading(reading)
+
     def potential_ancestors(self):
         """
         Return a list of potential ancestors. This respects the work done in self.add_D above.
@@ -441,12 +448,8 @@ class GenealogicalCoherence(Coherence):
 
             # We need to recurse, and find out what combinations explain our
             # (partial) parent.
-            reading_obj = ReadingRelationship(self.variant_unit,
-                                              partial_parent,
-                                              self.cursor)
-
             next_reading = partial_parent
-            next_parent = reading_obj.get_parent_reading(partial_parent)
+            next_parent = self.get_parent_reading(partial_parent)
 
             if next_reading == reading and next_parent == parent_reading:
                 # No point recursing just warn the user...
@@ -474,16 +477,188 @@ class GenealogicalCoherence(Coherence):
             return combined
 
 
+class ExplanationTemplates(object):
+    """
+    The part of GenealogicalCoherence.parent_combinations that doesn't depend
+    on W1 - worked out once for the whole corpus.
+
+    For each (variant unit, reading, parent reading) this is a list of
+    templates: tuples of (reading, generation) slots. A template stands for
+    every combination that fills each slot with one of W1's potential
+    ancestors that attests that reading - so the stemma only needs walking
+    once, however many witnesses have the reading.
+    """
+    def __init__(self, db_file):
+        conn = connect(db_file)
+        # variant unit -> witness -> reading
+        self.attestations = defaultdict(dict)
+        # (variant unit, reading) -> parent reading
+        self.parents = {}
+        for witness, vu, label, parent in conn.execute("SELECT witness, variant_unit, label, parent FROM cbgm"):
+            self.attestations[vu][witness] = label
+            self.parents.setdefault((vu, label), parent)
+        conn.close()
+
+        self._templates = {}
+        self._parent_search = set()
+
+    def get_parent_reading(self, vu, reading):
+        """
+        See ReadingRelationship.get_parent_reading
+        """
+        parent = self.parents.get((vu, reading))
+        if parent is None:
+            logger.warning("No parent reading found for %s reading %s - returning UNCL", vu, reading)
+            return UNCL
+        return parent
+
+    def templates(self, vu, reading, parent_reading):
+        """
+        The templates for this reading in this variant unit
+        """
+        key = (vu, reading, parent_reading)
+        if key not in self._templates:
+            self._templates[key] = self._build(vu, reading, parent_reading, 1)
+        return self._templates[key]
+
+    def _build(self, vu, reading, parent_reading, my_gen):
+        """
+        This follows GenealogicalCoherence.parent_combinations step by step
+        """
+        if my_gen == 1:
+            # top level
+            self._parent_search = set()
+
+        # Things that explain it by themselves
+        ret = [((reading, my_gen),)]
+
+        if parent_reading in (INIT, OL_PARENT, UNCL, None):
+            # No parents - nothing further to do
+            return ret
+
+        # Now the parent reading
+        partial_explanations = []
+        bits = [x.strip() for x in parent_reading.split('&')]
+        if len(bits) == 1:
+            next_gen = my_gen + 1
+        else:
+            next_gen = my_gen
+
+        for partial_parent in bits:
+            if partial_parent in self._parent_search:
+                # Already been here - must be looping...
+                continue
+
+            self._parent_search.add(partial_parent)
+
+            if partial_parent in (INIT, OL_PARENT):
+                partial_explanations.append(self._build(vu, partial_parent, None, my_gen + 1))
+                continue
+
+            next_parent = self.get_parent_reading(vu, partial_parent)
+            if partial_parent == reading and next_parent == parent_reading:
+                logger.warning("Would recurse infinitely... vu=%s, reading=%s, parent=%s, partial_parent=%s",
+                               vu, reading, parent_reading, partial_parent)
+            else:
+                partial_explanations.append(self._build(vu, partial_parent, next_parent, next_gen))
+
+        if not partial_explanations:
+            # We couldn't find anything
+            return []
+
+        if len(partial_explanations) == 1:
+            # We've got a single parent - simple
+            return ret + partial_explanations[0]
+
+        # Every combination of one template for each part
+        return [tuple(chain(*x)) for x in product(*partial_explanations)]
+
+    def parent_combinations(self, coh, vu, reading, parent_reading):
+        """
+        The same as coh.parent_combinations(reading, parent_reading) (with the
+        default arguments) for this variant unit - but without having to call
+        coh.set_variant_unit, or walk the stemma again.
+
+        The order of the combinations (and the witnesses in them) can differ.
+
+        @param coh: GenealogicalCoherence object for W1
+        """
+        rows = {x['W2']: x for x in coh.rows}
+        attestations = self.attestations[vu]
+        # W1's potential ancestors attesting each reading, in order
+        by_reading = defaultdict(list)
+        for w2 in coh.potential_ancestors():
+            by_reading[attestations.get(w2)].append(w2)
+
+        ret = []
+        for template in self.templates(vu, reading, parent_reading):
+            fills = [[ParentCombination(w2, rows[w2]['_NR'], rows[w2]['PERC1'], gen,
+                                        rows[w2]['W1<W2'], rows[w2]['W1>W2'])
+                      for w2 in by_reading[slot_reading]]
+                     for slot_reading, gen in template]
+            if len(fills) == 1:
+                ret.extend([x] for x in fills[0])
+            else:
+                ret.extend(list(set(x)) for x in product(*fills))
+        return ret
+
+
+@memoize
+def explanation_templates(db_file):
+    """
+    The ExplanationTemplates for this database - shared by everything in
+    this process
+    """
+    return ExplanationTemplates(db_file)
+
+
 def generate_genealogical_coherence_cache(w1, db_file, min_strength=None):
     """
     Generate genealogical coherence (variant unit independent)
     and store a cached copy.
+
+    Return the rows, so that an MPI parent can share them (see
+    queue_genealogical_coherence).
     """
     coh = GenealogicalCoherence(db_file, w1, pretty_p=False, use_cache=True, min_strength=min_strength)
     coh.generate()
+    return coh.rows
 
-    # A return of None is interpreted as abort, so just return True
-    return True
+
+def queue_genealogical_coherence(mpihandler, db_file, witnesses, min_strength=None):
+    """
+    Share the attestations, and the genealogical coherence of any of these
+    witnesses that's in our cache, with the MPI children - and queue GENCOH
+    tasks to generate the rest. Their results should be handed to
+    genealogical_coherence_done.
+
+    @param mpihandler: an mpisupport.MpiParent
+    """
+    share_attestations(mpihandler, db_file)
+    for w1 in witnesses:
+        coh = GenealogicalCoherence(db_file, w1, pretty_p=False, use_cache=True, min_strength=min_strength)
+        if coh._check_cache():
+            coh.generate()
+            share_coherence(mpihandler, coh)
+        else:
+            mpihandler.mpi_queue.put(("GENCOH", w1, db_file, min_strength))
+
+
+def genealogical_coherence_done(mpihandler, args, rows):
+    """
+    A GENCOH task is done: share its rows with all the MPI children, and
+    store them in our cache too if the child's cache wasn't ours.
+
+    @param args: the GENCOH task's args
+    @param rows: what generate_genealogical_coherence_cache returned
+    """
+    _, w1, db_file, min_strength = args
+    coh = GenealogicalCoherence(db_file, w1, pretty_p=False, use_cache=True, min_strength=min_strength)
+    coh.rows = rows
+    coh._already_generated = True
+    if not os.path.exists(coh._cache_key):
+        coh._store_cache()
+    share_coherence(mpihandler, coh)
 
 
 def gen_coherence(db_file, w1, variant_unit=None, *, pretty_p=False, debug=False, use_cache=False, min_strength=None):
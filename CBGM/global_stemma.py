@@ -5,7 +5,7 @@
 import importlib
 import sys
 import networkx
-from tempfile import NamedTemporaryFile
+import pygraphviz
 import subprocess
 from . import populate_db
 
@@ -80,23 +80,25 @@ def optimal_substemma(inputfile, w1, suffix=''):
         raise ValueError("Can't draw a single optimal substemma")
 
     nodes, edges = nodes_and_edges(w1, comb_anc[0], optsub)
-    G = networkx.DiGraph()
-    G.add_nodes_from(nodes)
-    for pri, post in edges:
+    G = pygraphviz.AGraph(strict=True, directed=True, name='G')
+    G.add_nodes_from(sorted(nodes))
+    for pri, post in sorted(edges):
         G.add_edge(pri, post)
 
     print("Creating graph with {} nodes and {} edges".format(G.number_of_nodes(),
                                                              G.number_of_edges()))
-    with NamedTemporaryFile() as dotfile:
-        networkx.write_dot(G, dotfile.name)
-        subprocess.check_call(['dot', '-Tsvg', dotfile.name, '-o', output_file])
+    # Lay out and render in-process - no temporary dot file or subprocess required
+    G.draw(output_file, format='svg', prog='dot')
 
     print("Written diagram to {}".format(output_file))
 
 
-def global_stemma(inputfile, suffix='', hide_initial_text=False):
+def global_stemma(inputfile, suffix='', hide_initial_text=False, graph_writer=None):
     """
     Make the global stemma
+
+    If graph_writer (a graph_data.GraphDataWriter) is supplied then the graph
+    is written to that instead of as DOT and SVG files.
     """
     output_file = 'global_stemma{}.svg'.format(suffix)
     dot_file = 'global_stemma{}.dot'.format(suffix)
@@ -137,6 +139,13 @@ def global_stemma(inputfile, suffix='', hide_initial_text=False):
 
     print("Creating graph with {} nodes and {} edges".format(G.number_of_nodes(),
                                                              G.number_of_edges()))
+    if graph_writer is not None:
+        node_data = [{'id': n} for n in G.nodes()]
+        edge_data = [{'source': a, 'target': b, 'style': attrs.get('style', 'solid')}
+                     for a, b, attrs in G.edges(data=True)]
+        graph_writer.add_graph('global_stemma', node_data, edge_data, suffix=suffix)
+        return
+
     with open(dot_file, 'w') as dotfile:
         networkx.write_dot(G, dotfile)
 
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+"""
+Structured graph output (JSON, JSON lines or GraphML) for textual flow
+diagrams, local stemmata and global stemmata.
+
+This lets a front end lay out the graphs itself (lazily), and means large
+runs don't need to call Graphviz at all.
+"""
+
+import json
+import logging
+import os
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('json', 'jsonl', 'graphml')
+
+
+def format_from_filename(filename):
+    """
+    Work out the output format from the file extension - defaulting to json.
+    """
+    ext = os.path.splitext(filename)[1].lstrip('.').lower()
+    if ext in FORMATS:
+        return ext
+    return 'json'
+
+
+class GraphDataWriter(object):
+    """
+    Collects graphs and writes them to a single file.
+
+    Each graph is a dict like this:
+        {'type': 'textual_flow',
+         'variant_unit': '21/2', 'connectivity': '499', 'reading': None,
+         'nodes': [{'id': '01', 'reading': 'b', ...}, ...],
+         'edges': [{'source': 'A', 'target': '01', 'rank': 1, ...}, ...]}
+
+    In 'jsonl' mode each graph is streamed to the file as soon as it is added,
+    one JSON document per line. The 'json' and 'graphml' modes produce a
+    single document for the whole corpus, which is written on close().
+    """
+    def __init__(self, filename, fmt=None):
+        """
+        @param filename: output file
+        @param fmt: one of FORMATS (default: work it out from the filename)
+        """
+        self.filename = filename
+        self.format = fmt or format_from_filename(filename)
+        assert self.format in FORMATS, "Unknown graph data format {}".format(self.format)
+        self.graphs = []
+        self._fh = None
+        self.count = 0
+        if self.format == 'jsonl':
+            self._fh = open(filename, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_graph(self, graph_type, nodes, edges, **metadata):
+        """
+        Add a graph to the output.
+
+        @param graph_type: e.g. 'textual_flow', 'local_stemma', 'global_stemma'
+        @param nodes: list of node dicts (each must have an 'id')
+        @param edges: list of edge dicts (each must have 'source' and 'target')
+        @param metadata: anything else identifying the graph (variant unit etc.)
+        """
+        graph = {'type': graph_type}
+        graph.update(metadata)
+        graph['nodes'] = nodes
+        graph['edges'] = edges
+        self.count += 1
+
+        if self._fh:
+            self._fh.write(json.dumps(graph, ensure_ascii=False, sort_keys=True))
+            self._fh.write('\n')
+            self._fh.flush()
+        else:
+            self.graphs.append(graph)
+
+    def close(self):
+        """
+        Write out any remaining data
+        """
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        elif self.format == 'json':
+            with open(self.filename, 'w') as f:
+                json.dump({'graphs': self.graphs}, f, ensure_ascii=False, sort_keys=True, indent=1)
+        elif self.format == 'graphml':
+            self._write_graphml()
+
+        logger.info("Written %s graphs to %s", self.count, self.filename)
+
+    def _write_graphml(self):
+        """
+        Write all our graphs into a single GraphML document
+        """
+        ns = 'http://graphml.graphdrawing.org/xmlns'
+        root = ElementTree.Element('graphml', xmlns=ns)
+
+        def attr_type(value):
+            if isinstance(value, bool):
+                return 'boolean'
+            if isinstance(value, int):
+                return 'int'
+            if isinstance(value, float):
+                return 'double'
+            return 'string'
+
+        # GraphML needs all attribute keys declared up front. Node ids must be
+        # unique across the whole document, so we prefix them with the graph
+        # id and store the original as 'name'.
+        keys = {('node', 'name'): 'string'}
+        for domain, items, skip in (('graph', self.graphs, ('nodes', 'edges')),
+                                    ('node', [n for g in self.graphs for n in g['nodes']], ('id',)),
+                                    ('edge', [e for g in self.graphs for e in g['edges']], ('source', 'target'))):
+            for item in items:
+                for k, v in item.items():
+                    if k in skip or v is None or (domain, k) in keys:
+                        continue
+                    keys[(domain, k)] = attr_type(v)
+
+        for (domain, name), typ in sorted(keys.items()):
+            ElementTree.SubElement(root, 'key', {'id': '{}_{}'.format(domain, name), 'for': domain,
+                                                 'attr.name': name, 'attr.type': typ})
+
+        def add_data(elem, domain, item, skip):
+            for k, v in sorted(item.items()):
+                if k in skip or v is None:
+                    continue
+                data = ElementTree.SubElement(elem, 'data', key='{}_{}'.format(domain, k))
+                data.text = str(v).lower() if isinstance(v, bool) else str(v)
+
+        for i, graph in enumerate(self.graphs):
+            g_elem = ElementTree.SubElement(root, 'graph', id='g{}'.format(i), edgedefault='directed')
+            add_data(g_elem, 'graph', graph, ('nodes', 'edges'))
+            prefix = 'g{}:'.format(i)
+            for node in graph['nodes']:
+                n_elem = ElementTree.SubElement(g_elem, 'node', id=prefix + str(node['id']))
+                add_data(n_elem, 'node', dict(node, name=node['id']), ('id',))
+            for edge in graph['edges']:
+                e_elem = ElementTree.SubElement(g_elem, 'edge', source=prefix + str(edge['source']),
+                                                target=prefix + str(edge['target']))
+                add_data(e_elem, 'edge', edge, ('source', 'target'))
+
+        ElementTree.ElementTree(root).write(self.filename, encoding='utf-8', xml_declaration=True)
@@ -0,0 +1,332 @@
+# encoding: utf-8
+
+"""
+Evaluate hypotheses about the local stemma of a single variant unit - e.g.
+each way of resolving its UNCL relationships (see
+bin/cbgm_hypotheses_on_unclear).
+
+Genealogical coherence depends on the local stemmata of all the variant
+units, but a hypothesis only changes one of them. So HypothesisEngine counts
+the relationships between every pair of witnesses in all the other variant
+units once, and for each hypothesis just adds the relationships in its own
+variant unit - rather than building a new database and generating the
+genealogical coherence of every witness again.
+"""
+
+import sqlite3
+import logging
+import numpy as np
+from collections import defaultdict
+from toposort import toposort
+
+from .shared import PRIOR, POSTERIOR, UNCL, LAC, INIT
+from .genealogical_coherence import GenealogicalCoherence, ReadingRelationship, CyclicDependency
+from .pre_genealogical_coherence import load_attestations
+from .textual_flow import TextualFlow, best_parents
+
+logger = logging.getLogger(__name__)
+
+# The relationships counted in the genealogical coherence table (NOREL is
+# whatever's left)
+COUNTED = (PRIOR, POSTERIOR, UNCL)
+
+# The witness that reads the INIT reading (see populate_db.Reading)
+INIT_WITNESS = 'A'
+
+# How many pairs of readings to count at once, when counting the
+# relationships in all the variant units
+PAIR_CHUNK = 2 ** 14
+
+
+class KnownParents(ReadingRelationship):
+    """
+    A ReadingRelationship that gets the parent readings from a dict rather
+    than the database
+    """
+    def __init__(self, variant_unit, reading, parent_of):
+        """
+        @param parent_of: dict of reading label to parent reading
+        """
+        super().__init__(variant_unit, reading, None)
+        self.parent_of = parent_of
+
+    def get_parent_reading(self, reading):
+        if reading not in self.parent_of:
+            logger.warning("No parent reading found for %s reading %s - returning UNCL", self.variant_unit, reading)
+            return UNCL
+        return self.parent_of[reading]
+
+
+class DeltaCoherence(GenealogicalCoherence):
+    """
+    Genealogical coherence for W1 at the engine's variant unit - with the rows
+    supplied by the HypothesisEngine for each hypothesis, rather than
+    generated from the database.
+    """
+    def __init__(self, engine, w1):
+        super().__init__(engine.db_file, w1, pretty_p=False, min_strength=engine.min_strength)
+        self.engine = engine
+        self._all_attestations = engine.attestations
+        self.variant_unit = engine.variant_unit
+        self.columns.extend(['READING', 'TEXT'])
+        # The engine checks each hypothesis for loops
+        self._done_cycle_check = True
+        self._already_generated = True
+        self._potential_ancestors = set()
+        self.parent_of = {}
+
+    def set_hypothesis(self, rows, parent_of):
+        """
+        Use these (unsorted) rows, and this local stemma for our variant unit
+        """
+        self.rows = rows
+        self.parent_of = parent_of
+        self._sort()
+        for row in self.rows:
+            row['READING'] = self.get_attestation(row['W2'], self.variant_unit)
+            row['TEXT'] = self.engine.texts.get(row['READING'])
+        self._potential_ancestors = set(x['W2'] for x in self.rows if x['NR'] != 0)
+
+    def get_parent_reading(self, reading):
+        return KnownParents(self.variant_unit, reading, self.parent_of).get_parent_reading(reading)
+
+    def potential_ancestors(self):
+        """
+        As a set, as parent_combinations looks things up in it for every row
+        """
+        return self._potential_ancestors
+
+
+class HypothesisEngine(object):
+    """
+    Evaluates hypotheses about the local stemma of one variant unit. Each
+    hypothesis is a dict of reading label to parent reading, for the readings
+    whose parents differ from those in the database.
+
+    A hypothesis can change what A reads (the INIT reading) as well as the
+    relationships between the readings - so A is always one of the witnesses.
+    """
+    def __init__(self, db_file, variant_unit, *, min_strength=None):
+        """
+        @param db_file: database file
+        @param variant_unit: the variant unit the hypotheses are about
+        @param min_strength: minimum strength for genealogical coherence relationships (see GenealogicalCoherence)
+        """
+        self.db_file = db_file
+        self.variant_unit = variant_unit
+        self.min_strength = min_strength
+        self._coherence = {}
+
+        conn = sqlite3.connect(db_file)
+        cursor = conn.cursor()
+        self.witnesses = [x[0] for x in cursor.execute('SELECT DISTINCT witness FROM cbgm')]
+        if INIT_WITNESS not in self.witnesses:
+            self.witnesses.append(INIT_WITNESS)
+        self.index = {w: i for i, w in enumerate(self.witnesses)}
+        self.attestations = load_attestations(cursor)
+
+        # variant unit -> reading -> parent reading
+        stemmata = defaultdict(dict)
+        # (variant unit, reading) -> indexes of the witnesses that read it
+        readers = defaultdict(list)
+        for witness, vu, label, parent in cursor.execute("SELECT witness, variant_unit, label, parent FROM cbgm"):
+            stemmata[vu].setdefault(label, parent)
+            if vu == variant_unit and witness == INIT_WITNESS:
+                # That depends on the hypothesis
+                continue
+            readers[(vu, label)].append(self.index[witness])
+
+        sql = "SELECT witness, label, text FROM cbgm WHERE variant_unit = ? AND witness != ?"
+        rows = list(cursor.execute(sql, (variant_unit, INIT_WITNESS)))
+        conn.close()
+        self.readers = [(w, label) for w, label, _ in rows]
+        self.texts = {label: text for _, label, text in rows}
+        self.parents = stemmata.pop(variant_unit, {})
+        self.labels = list(self.parents)
+        n = len(self.witnesses)
+
+        # Our variant unit's readers, apart from A
+        self.members = np.zeros((n, len(self.labels)))
+        for k, label in enumerate(self.labels):
+            self.members[readers.pop((variant_unit, label), []), k] = 1
+
+        # Everything else doesn't depend on the hypothesis. A column for
+        # each reading of who reads it...
+        keys = list(readers)
+        column = {key: k for k, key in enumerate(keys)}
+        members = np.zeros((n, len(keys)))
+        for k, key in enumerate(keys):
+            members[readers[key], k] = 1
+
+        # ... and for each variant unit of who's extant
+        extant = np.zeros((n, len(stemmata)))
+        for j, vu in enumerate(stemmata):
+            for label in stemmata[vu]:
+                extant[readers[(vu, label)], j] = 1
+        self.base_passages = extant @ extant.T
+        self.base_agreements = members @ members.T
+
+        # Count the relationships
+        pairs = {rel: ([], []) for rel in COUNTED}
+        for vu, parent_of in stemmata.items():
+            for (a, b), rel in self._relationships(vu, parent_of):
+                pairs[rel][0].append(column[(vu, a)])
+                pairs[rel][1].append(column[(vu, b)])
+
+        self.base_counts = {}
+        for rel, (cols1, cols2) in pairs.items():
+            counts = np.zeros((n, n))
+            for start in range(0, len(cols1), PAIR_CHUNK):
+                counts += (members[:, cols1[start:start + PAIR_CHUNK]] @
+                           members[:, cols2[start:start + PAIR_CHUNK]].T)
+            self.base_counts[rel] = counts
+
+        logger.debug("Hypothesis engine ready for %s (%s witnesses, %s other variant units)",
+                     variant_unit, n, len(stemmata))
+
+    @staticmethod
+    def _relationships(vu, parent_of):
+        """
+        Yield ((reading 1, reading 2), relationship) for the pairs of readings
+        in this variant unit whose relationship is counted - see
+        GenealogicalCoherence._calculate_reading_relationships
+        """
+        for a in parent_of:
+            reading = KnownParents(vu, a, parent_of)
+            for b in parent_of:
+                if a == b or b == LAC:
+                    continue
+                rel = reading.identify_relationship(b)
+                if rel in COUNTED:
+                    yield (a, b), rel
+
+    def local_stemma(self, parents):
+        """
+        Return our variant unit's local stemma with this hypothesis - a dict
+        of reading to parent reading. Raises CyclicDependency if it has a
+        loop, or ValueError if it has more than one INIT reading.
+
+        @param parents: dict of reading label to parent reading
+        """
+        parent_of = dict(self.parents)
+        parent_of.update(parents)
+        try:
+            list(toposort({label: {parent} for label, parent in parent_of.items()}))
+        except ValueError:
+            raise CyclicDependency
+        if len([x for x in parent_of.values() if x == INIT]) > 1:
+            raise ValueError("More than one INIT reading in {}: {}".format(self.variant_unit, parent_of))
+        return parent_of
+
+    def reading_data(self, parent_of):
+        """
+        (witness, reading, parent) for each witness in our variant unit, with
+        this local stemma - see TextualFlow
+        """
+        ret = [(w, label, parent_of[label]) for w, label in self.readers]
+        ret.extend((INIT_WITNESS, label, INIT) for label in self.labels if parent_of[label] == INIT)
+        return ret
+
+    def counts(self, parent_of):
+        """
+        Return (passages, agreements, {relationship: counts}) - arrays of how
+        many variant units each pair of witnesses are both extant in, agree
+        in, and have each relationship in (from the first witness's point of
+        view) - with this local stemma for our variant unit
+        """
+        members = self.members.copy()
+        for k, label in enumerate(self.labels):
+            if parent_of[label] == INIT:
+                members[self.index[INIT_WITNESS], k] = 1
+        extant = members.sum(axis=1)
+
+        passages = self.base_passages + np.outer(extant, extant)
+        agreements = self.base_agreements + members @ members.T
+        counts = {rel: base.copy() for rel, base in self.base_counts.items()}
+        index = {label: k for k, label in enumerate(self.labels)}
+        for (a, b), rel in self._relationships(self.variant_unit, parent_of):
+            counts[rel] += np.outer(members[:, index[a]], members[:, index[b]])
+        return passages, agreements, counts
+
+    def coherence(self, w1):
+        """
+        The DeltaCoherence object for this witness - made once
+        """
+        if w1 not in self._coherence:
+            self._coherence[w1] = DeltaCoherence(self, w1)
+        return self._coherence[w1]
+
+    def _rows(self, coh, passages, agreements, counts):
+        """
+        The genealogical coherence rows for coh's W1 - see
+        GenealogicalCoherence.generate
+        """
+        i = self.index[coh.w1]
+        rows = []
+        for j, w2 in enumerate(self.witnesses):
+            if i == j:
+                continue
+            prior = int(counts[PRIOR][i, j])
+            posterior = int(counts[POSTERIOR][i, j])
+            if prior > posterior:
+                # W1 has more prior variants than W2 - so W2 isn't a
+                # potential ancestor
+                continue
+            passages_ij = int(passages[i, j])
+            eq = int(agreements[i, j])
+            uncl = int(counts[UNCL][i, j])
+            row = {'W2': w2, 'NR': None,
+                   'PERC1': 100.0 * eq / passages_ij if passages_ij else 0.0,
+                   'EQ': eq, 'PASS': passages_ij,
+                   'W1<W2': posterior, 'W1>W2': prior, 'UNCL': uncl,
+                   'NOREL': passages_ij - eq - uncl - prior - posterior}
+            coh._add_D(w2, row)
+            rows.append(row)
+        return rows
+
+    def evaluate(self, parents, connectivity, *, include_undirected=False):
+        """
+        Return the best parents of each witness in our variant unit with this
+        hypothesis: {witness: {connectivity value: [ParentCombination, ...]}}
+        (see get_parents). Raises CyclicDependency if the local stemma would
+        have a loop.
+
+        @param parents: dict of reading label to parent reading
+        @param connectivity: list of connectivity values (strings)
+        """
+        parent_of = self.local_stemma(parents)
+        passages, agreements, counts = self.counts(parent_of)
+
+        # What A reads here depends on the hypothesis
+        init_readings = [label for label in self.labels if parent_of[label] == INIT]
+        if init_readings:
+            self.attestations[INIT_WITNESS][self.variant_unit] = init_readings[0]
+        else:
+            self.attestations[INIT_WITNESS].pop(self.variant_unit, None)
+
+        parent_maps = {}
+        for w1, w1_reading, w1_parent in self.reading_data(parent_of):
+            coh = self.coherence(w1)
+            coh.set_hypothesis(self._rows(coh, passages, agreements, counts), parent_of)
+            parent_maps[w1] = best_parents(coh, w1_reading, w1_parent, connectivity,
+                                           self.min_strength, include_undirected)
+        return parent_maps
+
+    def textual_flow(self, parents, connectivity, **kwargs):
+        """
+        Make the textual flow diagram(s) for our variant unit with this
+        hypothesis, and return the output files dict (see textual_flow).
+        Raises CyclicDependency if the local stemma would have a loop.
+
+        @param parents: dict of reading label to parent reading
+        @param connectivity: list of connectivity values (strings)
+        @param kwargs: any other arguments for TextualFlow
+        """
+        parent_of = self.local_stemma(parents)
+        tf = TextualFlow(self.db_file, variant_unit=self.variant_unit, connectivity=connectivity,
+                         min_strength=self.min_strength, reading_data=self.reading_data(parent_of), **kwargs)
+        if tf.output_files:
+            tf.parent_maps = self.evaluate(parents, tf.connectivity,
+                                           include_undirected=bool(kwargs.get('include_undirected')))
+            tf.draw_diagrams()
+        return tf.output_files
@@ -1,68 +1,59 @@
 # encoding: utf-8
 
-import networkx
+import pygraphviz
 import sqlite3
-import subprocess
 import logging
-import re
 import os
-from tempfile import NamedTemporaryFile
 from .shared import INIT, OL_PARENT, UNCL, sort_mss
 logger = logging.getLogger(__name__)
 
+# Styling for a prettier local stemma
+NODE_ATTRS = {'shape': 'plaintext', 'fontsize': 12, 'height': 0.4, 'width': 0.4, 'fixedsize': True}
+EDGE_ATTRS = {'arrowsize': 0.5}
 
-def _post_process_dot(dotfile):
-    """
-    Post-process a dot file created by networkx to make it create a prettier
-    local stemma.
-    """
-    re_node = re.compile("[^ ]+;")
-    re_edge = re.compile("[^ ]+ -> [^ ]+;")
-
-    output = []
-    with open(dotfile) as df:
-        for line in df:
-            if re_node.match(line.strip()):
-                line = line.replace(';', ' [shape=plaintext; fontsize=12; height=0.4; width=0.4; fixedsize=true];')
-            elif re_edge.match(line.strip()):
-                line = line.replace(';', ' [arrowsize=0.5];')
-            output.append(line)
-
-    with open(dotfile, 'w') as w:
-        w.write(''.join(output))
 
-
-def local_stemma(db_file, variant_units, suffix='', path='.'):
+def local_stemma(db_file, variant_units, suffix='', path='.', graph_writer=None):
     """
     Create a local stemma for the specified variant units (list).
+
+    If graph_writer (a graph_data.GraphDataWriter) is supplied then the graphs
+    are written to that instead of as SVG files.
     """
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    all_mss = set([x[0] for x in cursor.execute('SELECT DISTINCT witness FROM cbgm WHERE witness != "A"')])
+
     ret = ""
     for i, vu in enumerate(variant_units):
         logger.debug("Running for variant unit {} ({} of {})"
                      .format(vu, i + 1, len(variant_units)))
-        ret += _one_local_stemma(db_file, vu, suffix=suffix, path=path)
+        ret += _one_local_stemma(cursor, all_mss, vu, suffix=suffix, path=path, graph_writer=graph_writer)
 
+    conn.close()
     return ret
 
 
-def _one_local_stemma(db_file, variant_unit, suffix='', path='.'):
+def _one_local_stemma(cursor, all_mss, variant_unit, suffix='', path='.', graph_writer=None):
     """
     Create a local stemma for the specified variant unit.
+
+    @param cursor: cursor on the database (shared for a whole batch of variant units)
+    @param all_mss: set of all witnesses in the database (excluding 'A')
+    @param graph_writer: optional graph_data.GraphDataWriter
     """
     output_file = os.path.join(path, "{}{}.svg".format(variant_unit.replace('/', '_'), suffix))
 
-    G = networkx.DiGraph()
+    G = pygraphviz.AGraph(strict=True, directed=True, name='G')
 
     sql = """SELECT label, parent
              FROM cbgm
              WHERE variant_unit = ?
              """
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
     data = list(cursor.execute(sql, (variant_unit, )))
     labels = [x[0] for x in data]
 
-    G.add_nodes_from(labels)
+    for label in labels:
+        G.add_node(label, **NODE_ATTRS)
 
     added_uncl = False
     for label, parent in data:
@@ -71,27 +62,30 @@ def _one_local_stemma(db_file, variant_unit, suffix='', path='.'):
             pass
         elif parent == UNCL:
             if not added_uncl:
-                G.add_node('?')
+                G.add_node('?', **NODE_ATTRS)
                 added_uncl = True
-            G.add_edge('?', label)
+            G.add_edge('?', label, **EDGE_ATTRS)
         elif parent:
             for p in parent.split('&'):
                 # multiple parents are separated by '&'
-                G.add_edge(p.strip(), label)
+                G.add_node(p.strip(), **NODE_ATTRS)
+                G.add_edge(p.strip(), label, **EDGE_ATTRS)
         else:
             print("WANRNING - {} has no parents".format(label))
             continue
 
     print("Creating graph with {} nodes and {} edges".format(G.number_of_nodes(),
                                                              G.number_of_edges()))
-    with NamedTemporaryFile() as dotfile:
-        networkx.write_dot(G, dotfile.name)
-        _post_process_dot(dotfile.name)
-        subprocess.check_call(['dot', '-Tsvg', dotfile.name, '-o', output_file])
-
-    print("Written diagram to {}".format(output_file))
-
-    all_mss = set([x[0] for x in cursor.execute('SELECT DISTINCT witness FROM cbgm WHERE witness != "A"')])
+    if graph_writer is not None:
+        texts = dict(cursor.execute("SELECT DISTINCT label, text FROM cbgm WHERE variant_unit = ?",
+                                    (variant_unit, )))
+        node_data = [{'id': n, 'reading': n, 'text': texts.get(n)} for n in G.nodes()]
+        edge_data = [{'source': a, 'target': b} for a, b in G.edges()]
+        graph_writer.add_graph('local_stemma', node_data, edge_data, variant_unit=variant_unit)
+    else:
+        # Lay out and render in-process - no temporary dot file or subprocess required
+        G.draw(output_file, format='svg', prog='dot')
+        print("Written diagram to {}".format(output_file))
 
     sql = """SELECT label, text, GROUP_CONCAT(witness)
              FROM cbgm
@@ -1,12 +1,19 @@
 """
-OpenMPI support wrapper
+OpenMPI support wrapper - or, when not run under MPI, the same with local
+processes (see LocalComm)
 """
 
+import os
+import sys
+import pickle
 import threading
 import queue
 import logging
 import time
 import resource
+import multiprocessing
+import heapq
+import itertools
 
 
 logger = logging.getLogger()
@@ -17,30 +24,259 @@ except ImportError:
     logger.warning("MPI support unavailable")
 
 
+# Read-only data the parent has shared with this process (see
+# MpiParent.mpi_share) - look it up here before loading it yourself
+shared_data = {}
+
+
+def mpi_launched():
+    """
+    Have we been run under MPI (e.g. with mpirun)?
+    """
+    return 'OMPI_COMM_WORLD_SIZE' in os.environ
+
+
+def local_processes():
+    """
+    How many local processes to use when we're not run under MPI:
+    $CBGM_PROCESSES, or the number of CPUs
+    """
+    return int(os.environ.get('CBGM_PROCESSES') or os.cpu_count() or 1)
+
+
 def is_parent():
-    return MPI.COMM_WORLD.Get_rank() == 0
+    return not mpi_launched() or MPI.COMM_WORLD.Get_rank() == 0
+
+
+# Set once this process is running mpi_child
+_in_child = False
+
+
+def in_child():
+    """
+    Is this process an MPI child (or one of the local processes)?
+    """
+    return _in_child
+
+
+def task_kind(args):
+    """
+    The kind of a task is its first argument, if that's a string
+    """
+    return args[0] if args and isinstance(args[0], str) else None
+
+
+class MpiFailure(Exception):
+    pass
+
+
+class TaskQueue(queue.Queue):
+    """
+    A queue that hands out the most expensive tasks first - going by the cost
+    function (which the MpiParent sets) - so the long ones don't hold things
+    up at the end. Tasks of the same cost come out in the order they went in,
+    and None (the call to quit) comes out last.
+
+    If there's a journal (a task_journal.TaskJournal) each task is recorded
+    in it as it's queued.
+
+    get_timed also says when the task was queued.
+
+    If the work can't be finished (see fail), join returns anyway, and the
+    error is left in error.
+    """
+    def __init__(self):
+        super().__init__()
+        self.cost = None
+        self.journal = None
+        self.counter = itertools.count()
+        self.error = None
+
+    def put(self, item, block=True, timeout=None):
+        # Work out the cost first - not while holding the queue's lock
+        if item is None:
+            priority = float('inf')
+        else:
+            priority = -self.cost(item) if self.cost else 0
+            if self.journal is not None:
+                self.journal.queued(item)
+        super().put((priority, next(self.counter), time.time(), item), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return self.get_timed(block, timeout)[0]
+
+    def get_timed(self, block=True, timeout=None):
+        """
+        Return the next item, and when it was queued
+        """
+        return super().get(block, timeout)
+
+    def fail(self, error):
+        """
+        Give up on the work - waking anyone waiting in join
+        """
+        with self.all_tasks_done:
+            self.error = error
+            self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks and self.error is None:
+                self.all_tasks_done.wait()
+
+    def all_done(self):
+        """
+        Has task_done been called for every task put in the queue?
+        """
+        with self.mutex:
+            return not self.unfinished_tasks
+
+    def reset(self):
+        """
+        Forget the tasks left, and any error
+        """
+        with self.mutex:
+            self.queue.clear()
+            self.unfinished_tasks = 0
+            self.error = None
 
+    def _init(self, maxsize):
+        self.queue = []
 
-CHILD_RETRY_HELLO = 60
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, item)
+
+    def _get(self):
+        _, _, queued, item = heapq.heappop(self.queue)
+        return item, queued
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process, in bytes. (ru_maxrss is in
+    KiB, except on macOS where it's in bytes.)
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# Messages from the children (other than results, which are (rets, durations, peak_rss) tuples)
+CHILD_READY = True
+CHILD_EXITING = False
+CHILD_FAILED = None
+
+# Roughly how long (in seconds) a chunk of tasks sent to a child should take
+CHUNK_TIME = 0.5
+MAX_CHUNK_SIZE = 1000
+# How often (in seconds) the receiver checks for messages, if it can't wait
+# for them in MPI while the dispatcher sends (see MpiParent)
+POLL_INTERVAL = 0.01
+# How much each task's duration (per unit of size) counts towards the running average for its kind
+TASK_TIME_WEIGHT = 0.2
 
 
 class MpiParent(object):
+    """
+    Hands out the work in mpi_queue to the MPI children, and gives their
+    results to mpi_handle_result.
+
+    There are just two threads, and neither polls: the dispatcher waits for
+    an idle child and then for some work to send it, and the receiver waits
+    (with a matched probe) for a message from any child. A child is idle
+    once it's said it's ready, or sent back its last result.
+
+    That needs MPI_THREAD_MULTIPLE, as the receiver is waiting in MPI while
+    the dispatcher sends. With MPI_THREAD_SERIALIZED, the threads take turns
+    to call MPI instead, and the receiver polls (every POLL_INTERVAL) for
+    messages.
+
+    The queue hands out the tasks expected to take longest first. That's
+    their size (see mpi_task_size) times how long that kind of task (see
+    task_kind) has taken per unit of size so far.
+
+    Tasks are sent in chunks, big enough to take about CHUNK_TIME going by
+    the same estimates. But each result is still handled separately.
+
+    With a journal, the tasks and their results are recorded as they go, and
+    tasks that were done last time aren't sent again - their results are
+    just handled again (see mpi_replay).
+
+    With a telemetry writer, there's a record of how long each task waited
+    and took, and so on (see telemetry.py).
+
+    If either thread fails (say mpi_handle_result raises an exception), or a
+    local process does, the local processes are stopped and mpi_wait raises
+    a MpiFailure - closing the journal and telemetry first - rather than
+    waiting for work that will never be done.
+    """
     mpicomm = None
-    mpi_queue = queue.Queue()
+    mpi_queue = TaskQueue()
     mpi_child_threads = []
     mpi_child_status = {}
     mpi_child_meminfo = {}
     mpi_child_timeout = 3600
-    mpi_child_ready_timeout = 30
     mpi_parent_status = ""
 
+    # For the local processes (see LocalComm): the function they run, and how
+    # many of them there are
+    mpi_child_function = None
+    mpi_processes = None
+
+    # Children waiting for work
+    mpi_idle = queue.Queue()
+    # Children working: child -> (chunk, time sent, how long each task was queued)
+    mpi_busy = {}
+    # Average duration per unit of size of each kind of task
+    mpi_task_rates = {}
+    # Children that took too long to return, so their work was given to another
+    mpi_lost = set()
+    # Children that haven't exited yet
+    mpi_running = set()
+    mpi_lock = threading.Lock()
+    # Data shared with the children (see mpi_share), in the order it was
+    # shared, and how much of it each child has been sent
+    mpi_shared = []
+    mpi_child_shared = {}
+    # The task_journal.TaskJournal, if any, and how many results have been
+    # taken from it rather than the children
+    mpi_journal = None
+    mpi_replayed = 0
+    # The telemetry.TelemetryWriter, if any
+    mpi_telemetry = None
+    # So results are handled one at a time, whichever thread they're from
+    mpi_result_lock = threading.Lock()
+    # If the threads have to take turns to call MPI, the lock for a turn
+    mpi_turn_lock = None
+
     # WARNING - this operates as a singleton class - always using the
     # latest instance created.
     latest_instance = None
 
-    def __init__(self):
+    def __init__(self, child_function=None, processes=None, journal=None, telemetry=None):
+        """
+        @param child_function: the function the children run (as given to
+                               mpi_child), for when we're not run under MPI
+        @param processes: how many local processes to use when we're not run
+                          under MPI (default local_processes())
+        @param journal: a task_journal.TaskJournal to record the tasks in, and
+                        take the results of those already done from. It's
+                        closed by mpi_wait(stop=True).
+        @param telemetry: a telemetry.TelemetryWriter to record each task's
+                          performance in. It's closed by mpi_wait(stop=True)
+                          too.
+        """
         logger.debug("Initialising MpiParent")
         self.__class__.latest_instance = self
+        self.__class__.mpi_child_function = child_function
+        self.__class__.mpi_processes = processes
+        self.__class__.mpi_journal = journal
+        self.__class__.mpi_replayed = 0
+        self.__class__.mpi_telemetry = telemetry
+        self.mpi_queue.cost = self.task_cost
+        self.mpi_queue.journal = journal
         self.mpi_run()
 
     @classmethod
@@ -59,36 +295,85 @@ class MpiParent(object):
         # When the queue is done, we can continue.
         cls.update_parent_stats("Waiting for work to finish")
         # This waits for an empty queue AND task_done to have been called
-        # for each item.
+        # for each item - or for one of the threads to fail.
         cls.mpi_queue.join()
+        if cls.mpi_queue.error is not None:
+            cls.mpi_abandon()
 
         if not stop:
             # Nothing more to do for now
             return
 
+        # The dispatcher tells each child to exit as it becomes idle, and the
+        # receiver waits for them all to say they're exiting.
         cls.update_parent_stats("Telling children to exit")
-        for _ in cls.mpi_child_threads:
-            cls.mpi_queue.put(None)
-
-        # Clean up the threads, in case we run out
-        cls.update_parent_stats("Waiting for threads to exit")
-        running_threads = [t for t in cls.mpi_child_threads]
-        while running_threads:
-            t = running_threads.pop(0)
-            t.join(0.1)
-            if t.is_alive():
-                running_threads.append(t)
-            else:
-                cls.update_parent_stats("Thread {} joined - waiting for {} more"
-                                    .format(t, len(running_threads)))
+        cls.mpi_queue.put(None)
+        for t in cls.mpi_child_threads:
+            t.join()
+        cls.mpi_cleanup()
+        cls.update_parent_stats("Work done")
 
-        # Set the list as empty, so it'll be re-made if more work is required.
-        cls.mpi_child_threads = []
+    @classmethod
+    def mpi_abandon(cls):
+        """
+        One of the threads has failed: stop the local processes and the
+        dispatcher, forget the work left, and raise a MpiFailure
+        """
+        error = cls.mpi_queue.error
+        cls.update_parent_stats("Abandoning the work left")
+        with cls.mpi_lock:
+            # So the dispatcher doesn't wait to tell anyone to exit
+            cls.mpi_running.clear()
+        if isinstance(cls.mpicomm, LocalComm):
+            cls.mpicomm.terminate()
+        # Wake the dispatcher, wherever it's waiting. (Under MPI, the receiver
+        # might be left waiting for the children - but we're giving up on
+        # them anyway.)
+        cls.mpi_idle.put(None)
+        cls.mpi_queue.put(None)
+        threads = cls.mpi_child_threads[:1]
+        if isinstance(cls.mpicomm, LocalComm):
+            # And the receiver
+            cls.mpicomm.send(CHILD_EXITING, dest=0)
+            threads = cls.mpi_child_threads
+        for t in threads:
+            t.join()
+        cls.mpi_queue.reset()
+        with cls.mpi_idle.mutex:
+            cls.mpi_idle.queue.clear()
+        with cls.mpi_lock:
+            cls.mpi_busy.clear()
+            cls.mpi_lost.clear()
+        cls.mpi_cleanup()
+        cls.update_parent_stats("Work abandoned")
+        raise MpiFailure("The MPI parent failed: {!r}".format(error)) from error
 
-        cls.update_parent_stats("Work done")
-        # We need to let threads, remote MPI processes etc. all clean up
-        # properly - and a second seems to be ample time for this.
-        time.sleep(1)
+    @classmethod
+    def mpi_cleanup(cls):
+        """
+        Forget the threads and shared data, and close the journal and
+        telemetry - ready to start again if more work is required
+        """
+        # Set the list as empty, so it'll be re-made if more work is required.
+        # (Emptied rather than replaced, as it might be shared with other
+        # subclasses.)
+        del cls.mpi_child_threads[:]
+        del cls.mpi_shared[:]
+        shared_data.clear()
+        if cls.mpi_journal is not None:
+            logger.info("Task journal: %s (%s results were from the journal)", cls.mpi_journal.counts(),
+                        cls.mpi_replayed)
+            cls.mpi_queue.journal = None
+            cls.mpi_journal.close()
+            cls.mpi_journal = None
+        if cls.mpi_telemetry is not None:
+            logger.info("Telemetry written to %s", cls.mpi_telemetry.filename)
+            cls.mpi_telemetry.close()
+            cls.mpi_telemetry = None
+        if isinstance(cls.mpicomm, LocalComm):
+            # Local processes can be started again
+            cls.mpicomm.join()
+            cls.mpicomm = None
 
     @classmethod
     def show_stats(cls):
@@ -104,89 +389,307 @@ class MpiParent(object):
         cls.mpi_parent_status = msg
 
     @classmethod
-    def mpi_manage_child(cls, child):
+    def stat(cls, child, status, meminfo=None):
+        cls.mpi_child_status[child] = "[{}]: {}".format(time.ctime(), status)
+        if meminfo:
+            cls.mpi_child_meminfo[child] = meminfo
+        logger.debug("Child {}: {}".format(child, status))
+
+    @classmethod
+    def mpi_share(cls, key, value):
         """
-        Manage communications with the specified MPI child
+        Share some read-only data with the children, so that their tasks can
+        find it in shared_data rather than each loading it again. Each child
+        is sent it once, along with its next chunk of tasks. (Local processes
+        already have whatever was shared before they were started.)
+
+        It's in shared_data here too.
         """
-        logger.info("Child manager {} starting".format(child))
+        with cls.mpi_lock:
+            shared_data[key] = value
+            cls.mpi_shared.append((key, value))
 
-        def stat(child, status, meminfo=None):
-            cls.mpi_child_status[child] = "[{}]: {}".format(time.ctime(), status)
-            if meminfo:
-                cls.mpi_child_meminfo[child] = meminfo
-            logger.debug("Child {}: {}".format(child, status))
+    def mpi_task_size(self, args):
+        """
+        How big a task is - in any units, as long as the time the tasks of
+        each kind take is roughly proportional to it. Override this if the
+        tasks aren't all the same size.
 
-        waiting_for_results = False
+        @param args: the args to send to the child
+        """
+        return 1
 
-        while True:
-            # Wait for the child to be ready
-            start = time.time()
-            abort = False
-            while not cls.mpicomm.Iprobe(source=child):
-                time.sleep(0.1)
-                if time.time() - start > cls.mpi_child_ready_timeout:
-                    logger.error("Child {} took too long to be ready. Aborting.".format(child))
-                    stat(child, "child not ready")
-                    abort = True
-                    break
+    @classmethod
+    def task_size(cls, args):
+        return cls.latest_instance.mpi_task_size(args) if cls.latest_instance else 1
+
+    @classmethod
+    def task_time(cls, args, default=CHUNK_TIME):
+        """
+        How long we expect this task to take - or default if we've no idea
+        """
+        rate = cls.mpi_task_rates.get(task_kind(args))
+        if rate is None:
+            return default
+        return rate * cls.task_size(args)
 
-            if not abort:
-                ready = cls.mpicomm.recv(source=child)
-                if ready is not True:
-                    stat(child, "unexpected response ({}...)".format(str(ready[:30])))
-                    abort = True
+    @classmethod
+    def task_cost(cls, args):
+        """
+        The task's priority in the queue: how long we expect it to take, or
+        just its size if we've no idea yet
+        """
+        expected = cls.task_time(args, default=None)
+        return cls.task_size(args) if expected is None else expected
 
-            if abort:
-                time.sleep(5)
-                continue
+    @classmethod
+    def record_task_time(cls, args, duration):
+        kind = task_kind(args)
+        rate = duration / max(cls.task_size(args), 1)
+        average = cls.mpi_task_rates.get(kind)
+        if average is None:
+            cls.mpi_task_rates[kind] = rate
+        else:
+            cls.mpi_task_rates[kind] = average + TASK_TIME_WEIGHT * (rate - average)
 
-            # wait for something to do
-            stat(child, "waiting for queue")
-            args = cls.mpi_queue.get()
+    @classmethod
+    def mpi_replay(cls, args):
+        """
+        If the journal has the result of this task (and it can still be used
+        - see mpi_replayable), hand it to mpi_handle_result (again) and
+        return True - rather than sending the task to a child
+        """
+        if cls.mpi_journal is None:
+            return False
+        done, ret = cls.mpi_journal.result(args)
+        if not done or not cls.latest_instance.mpi_replayable(args, ret):
+            return False
+        with cls.mpi_result_lock:
+            cls.latest_instance.mpi_handle_result(args, ret)
+        cls.mpi_replayed += 1
+        cls.mpi_queue.task_done()
+        return True
 
-            # send it to the remote child
-            stat(child, "sending data to child")
-            cls.mpicomm.send(args, dest=child)
+    @classmethod
+    def mpi_next_task(cls, block=True):
+        """
+        The next task from the queue that needs doing (or None, the call to
+        quit), and how long it was queued - replaying any that have been done
+        already
+        """
+        while True:
+            args, queued = cls.mpi_queue.get_timed(block)
+            if args is None or not cls.mpi_replay(args):
+                return args, time.time() - queued
 
+    @classmethod
+    def mpi_dispatch(cls):
+        """
+        Send the work in the queue to the children in chunks as they become
+        idle, then tell them all to exit
+        """
+        logger.info("MPI dispatcher starting")
+        stop = False
+        while not stop:
+            child = cls.mpi_idle.get()
+            if child is None:
+                # We've given up (see mpi_abandon)
+                break
+            cls.stat(child, "waiting for queue")
+            args, wait = cls.mpi_next_task()
             if args is None:
                 # That's the call to quit
-                stat(child, "quitting")
-                return
+                cls.mpi_queue.task_done()
+                cls.mpi_idle.put(child)
+                break
 
-            stat(child, "waiting for results ({})".format(args))
+            # Add what's already queued, up to this child's share of it
+            with cls.mpi_lock:
+                n_children = max(1, len(cls.mpi_running - cls.mpi_lost))
+            limit = min(MAX_CHUNK_SIZE, max(1, (cls.mpi_queue.qsize() + 1) // n_children))
+            chunk = [args]
+            waits = [wait]
+            expected = cls.task_time(args)
+            while len(chunk) < limit and expected < CHUNK_TIME:
+                try:
+                    args, wait = cls.mpi_next_task(block=False)
+                except queue.Empty:
+                    break
+                if args is None:
+                    # Send this chunk, and then quit
+                    cls.mpi_queue.task_done()
+                    stop = True
+                    break
+                chunk.append(args)
+                waits.append(wait)
+                expected += cls.task_time(args)
+
+            with cls.mpi_lock:
+                cls.mpi_busy[child] = (chunk, time.time(), waits)
+                # Whatever's been shared since this child was last sent anything
+                shared = cls.mpi_shared[cls.mpi_child_shared.get(child, 0):]
+                cls.mpi_child_shared[child] = len(cls.mpi_shared)
+            cls.stat(child, "waiting for results ({}{})".format(
+                chunk[0], " and {} more".format(len(chunk) - 1) if len(chunk) > 1 else ""))
+            cls.mpi_send((shared, chunk), child)
+            if cls.mpi_journal is not None:
+                cls.mpi_journal.dispatched(chunk)
+
+        # Tell each child to quit, once it's finished what it's doing -
+        # except the lost ones, which we can't wait for.
+        while True:
+            with cls.mpi_lock:
+                remaining = cls.mpi_running - cls.mpi_lost
+                if not remaining:
+                    break
+            child = cls.mpi_idle.get()
+            if child is None:
+                break
+            cls.stat(child, "quitting")
+            cls.mpi_send(None, child)
+            with cls.mpi_lock:
+                cls.mpi_running.discard(child)
+        logger.info("MPI dispatcher exiting")
 
-            # get the results back
-            start = time.time()
-            while True:
-                while not cls.mpicomm.Iprobe(source=child):
-                    time.sleep(1)
-                    if time.time() - start > cls.mpi_child_timeout:
-                        logger.error("Child {} took too long to return. Aborting.".format(child))
-                        stat(child, "timeout - task returned to the queue")
-                        # Put it back on the queue for someone else to do
-                        cls.mpi_queue.put(args)
+    @classmethod
+    def mpi_thread(cls, target):
+        """
+        Run one of the threads - and if it fails, tell mpi_wait, rather than
+        leaving it waiting
+        """
+        try:
+            target()
+        except BaseException as e:
+            logger.exception("MPI %s thread failed", target.__name__)
+            cls.mpi_queue.fail(e)
+
+    @classmethod
+    def mpi_receive(cls):
+        """
+        Receive the messages from the children, handing the results to the
+        latest_instance's mpi_handle_result method.
+        """
+        logger.info("MPI receiver starting")
+        # Children that haven't said they're exiting
+        to_hear_from = set(cls.mpi_running)
+        while True:
+            with cls.mpi_lock:
+                if not to_hear_from - cls.mpi_lost:
+                    break
+            child, data = cls.mpi_recv_any()
+            if cls.mpi_queue.error is not None:
+                # We've given up (see mpi_abandon)
+                break
+
+            if data is CHILD_FAILED:
+                # mpi_thread passes this on to mpi_wait, which gives up
+                raise MpiFailure("Child {} failed".format(child))
+
+            if data is CHILD_EXITING:
+                to_hear_from.discard(child)
+                cls.stat(child, "exited")
+                continue
+
+            if data is not CHILD_READY:
+                rets, durations, rss = data
+                meminfo = "{:.2f} MB".format(rss / 1024 ** 2) if rss else None
+                with cls.mpi_lock:
+                    chunk, sent, waits = cls.mpi_busy.pop(child, (None, None, None))
+                    late = child in cls.mpi_lost
+                    cls.mpi_lost.discard(child)
+                if late:
+                    # Someone else has done it already
+                    cls.stat(child, "late results discarded", meminfo)
+                elif rets is None:
+                    logger.error("Child {} didn't receive its tasks - returning them to the queue".format(child))
+                    with cls.mpi_lock:
+                        # Nor what was shared with them
+                        cls.mpi_child_shared[child] = 0
+                    cls.requeue(chunk)
+                else:
+                    cls.stat(child, "sent results back", meminfo)
+                    start = sent
+                    for args, ret, duration, wait in zip(chunk, rets, durations, waits):
+                        cls.record_task_time(args, duration)
+                        if cls.mpi_telemetry is not None:
+                            cls.mpi_telemetry.record(time=time.time(), start=start, rank=child,
+                                                     kind=task_kind(args), task=repr(args), chunk=len(chunk),
+                                                     queue_wait=wait, run_time=duration,
+                                                     result_bytes=len(pickle.dumps(ret)), peak_rss=rss)
+                            start += duration
+                        if cls.mpi_journal is not None and ret is not None:
+                            # (None means the child aborted the task, so it isn't done)
+                            cls.mpi_journal.done(args, ret)
+                        with cls.mpi_result_lock:
+                            cls.latest_instance.mpi_handle_result(args, ret)
                         cls.mpi_queue.task_done()
-                        time.sleep(5)
-                        return
+                    cls.stat(child, "task done")
 
-                data = cls.mpicomm.recv(source=child)
-                if data is True:
-                    # This is just a "hello"
-                    stat(child, "recv hello ({})".format(time.ctime()))
-                    continue
+            cls.mpi_idle.put(child)
+        logger.info("MPI receiver exiting")
 
-                # This must be real data back...
-                break
+    @classmethod
+    def mpi_recv_any(cls):
+        """
+        Wait for a message from any child, and return the child and the data
+        """
+        if isinstance(cls.mpicomm, LocalComm):
+            return cls.mpicomm.recv_any()
+        status = MPI.Status()
+        if cls.mpi_turn_lock is None:
+            message = cls.mpicomm.mprobe(source=MPI.ANY_SOURCE, status=status)
+            return status.Get_source(), message.recv()
+        while True:
+            with cls.mpi_turn_lock:
+                message = cls.mpicomm.improbe(source=MPI.ANY_SOURCE, status=status)
+                if message is not None:
+                    return status.Get_source(), message.recv()
+            time.sleep(POLL_INTERVAL)
 
-            ret, meminfo = data
-            stat(child, "sent results back", meminfo)
+    @classmethod
+    def mpi_send(cls, data, child):
+        """
+        Send a message to a child - taking our turn, if we have to
+        """
+        if cls.mpi_turn_lock is None:
+            cls.mpicomm.send(data, dest=child)
+        else:
+            with cls.mpi_turn_lock:
+                cls.mpicomm.send(data, dest=child)
 
-            # process the result by handing it to the latest_instance's
-            # mpi_handle_result method.
-            cls.latest_instance.mpi_handle_result(args, ret)
+    @classmethod
+    def check_timeouts(cls):
+        """
+        Give the work of any child that's taken too long to another child
+        """
+        now = time.time()
+        with cls.mpi_lock:
+            for child, (chunk, sent, _) in list(cls.mpi_busy.items()):
+                if now - sent > cls.mpi_child_timeout * len(chunk) and child not in cls.mpi_lost:
+                    logger.error("Child {} took too long to return. Tasks returned to the queue.".format(child))
+                    cls.mpi_lost.add(child)
+                    del cls.mpi_busy[child]
+                    cls.requeue(chunk)
+                    cls.mpi_child_status[child] = "[{}]: timeout - tasks returned to the queue".format(time.ctime())
 
+    @classmethod
+    def requeue(cls, chunk):
+        """
+        Put the tasks back on the queue for someone else to do
+        """
+        for args in chunk:
+            cls.mpi_queue.put(args)
             cls.mpi_queue.task_done()
-            stat(child, "task done")
+
+    def mpi_replayable(self, args, ret):
+        """
+        Can this result from the journal still be used? Override this if the
+        results depend on files that might have gone since.
+
+        @param args: the args to send to the child
+        @param ret: the journal's result
+        """
+        return True
 
     def mpi_handle_result(self, args, ret):
         """
@@ -206,23 +709,40 @@ class MpiParent(object):
     @classmethod
     def _mpi_init(cls):
         """
-        Start up the MPI management threads etc.
+        Start up the MPI management threads etc. - and the local processes,
+        if we're not run under MPI
         """
-        cls.mpicomm = MPI.COMM_WORLD
-        rank = cls.mpicomm.Get_rank()
-        assert rank == 0
         # parent
         if cls.mpi_child_threads:
             logger.debug("We've already got child processes - so just using them")
             return
 
-        logger.info("MPI-enabled version with {} processors available"
-                    .format(cls.mpicomm.size))
-        assert cls.mpicomm.size > 1, "Please run this under MPI with more than one processor"
-        for child in range(1, cls.mpicomm.size):
-            t = threading.Thread(target=cls.mpi_manage_child,
-                                 args=(child,),
-                                 daemon=True)
+        if mpi_launched():
+            cls.mpicomm = MPI.COMM_WORLD
+            rank = cls.mpicomm.Get_rank()
+            assert rank == 0
+            logger.info("MPI-enabled version with {} processors available"
+                        .format(cls.mpicomm.size))
+            assert cls.mpicomm.size > 1, "Please run this under MPI with more than one processor"
+            # The dispatcher and receiver both call MPI
+            thread_level = MPI.Query_thread()
+            assert thread_level >= MPI.THREAD_SERIALIZED, \
+                "MPI must allow calls from more than one thread (MPI_THREAD_SERIALIZED or better)"
+            if thread_level < MPI.THREAD_MULTIPLE:
+                logger.warning("MPI only allows calls from one thread at a time - so the receiver will poll")
+                cls.mpi_turn_lock = threading.Lock()
+            else:
+                cls.mpi_turn_lock = None
+        else:
+            assert cls.mpi_child_function, "Not run under MPI, and there's no function for local processes"
+            cls.mpicomm = LocalComm(cls.mpi_processes or local_processes(), cls.mpi_child_function)
+            logger.info("Not run under MPI - using {} local processes".format(cls.mpicomm.size - 1))
+        cls.mpi_running = set(range(1, cls.mpicomm.size))
+        # Forked children start with a copy of our shared_data
+        already_shared = len(cls.mpi_shared) if isinstance(cls.mpicomm, LocalComm) else 0
+        cls.mpi_child_shared = {child: already_shared for child in cls.mpi_running}
+        for target in (cls.mpi_dispatch, cls.mpi_receive):
+            t = threading.Thread(target=cls.mpi_thread, args=(target, ), daemon=True)
             t.start()
             cls.mpi_child_threads.append(t)
 
@@ -234,24 +754,87 @@ class MpiParent(object):
     def stats_thread(cls):
         while True:
             cls.show_stats()
+            cls.check_timeouts()
+            if cls.mpi_telemetry is not None:
+                cls.mpi_telemetry.flush()
             time.sleep(60)
 
 
-def mpi_child(fn):
+class LocalComm(object):
+    """
+    Stands in for MPI.COMM_WORLD (with just what MpiParent and mpi_child
+    need) when we're not run under MPI. Rank 0 is this process, and the
+    others are forked processes running fn with mpi_child. Each rank has a
+    queue for the messages sent to it.
+    """
+    def __init__(self, processes, fn):
+        context = multiprocessing.get_context('fork')
+        self.size = processes + 1
+        self.rank = 0
+        self.queues = [context.Queue() for _ in range(self.size)]
+        self.processes = []
+        for rank in range(1, self.size):
+            process = context.Process(target=self._child, args=(rank, fn), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def _child(self, rank, fn):
+        self.rank = rank
+        try:
+            mpi_child(fn, self)
+        except BaseException:
+            logger.exception("Child {} (local) failed".format(rank))
+            self.send(CHILD_FAILED, dest=0)
+
+    def Get_rank(self):
+        return self.rank
+
+    def send(self, obj, dest):
+        self.queues[dest].put((self.rank, obj))
+
+    def recv(self, source=0):
+        # Only the parent sends to the children
+        return self.queues[self.rank].get()[1]
+
+    def recv_any(self):
+        """
+        Return the sender and data of the next message for the parent
+        """
+        return self.queues[0].get()
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+        self.join()
+
+
+def mpi_child(fn, comm=None):
     """
     An MPI child wrapper that will call the supplied function in a child
-    context - reading its arguments from mpicomm.recv(source=0).
+    context - reading chunks of arguments from mpicomm.recv(source=0), each
+    with any data the parent has shared since the last (see
+    MpiParent.mpi_share).
+
+    It says it's ready once, and then each chunk of results it sends back
+    means it's ready for the next - until it's sent None.
+
+    @param comm: the communicator (default MPI.COMM_WORLD)
     """
-    rank = MPI.COMM_WORLD.Get_rank()
+    global _in_child
+    _in_child = True
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
     logger.debug("Child {} (remote) starting".format(rank))
     while True:
-        # A little sleep to let everything start...
-        time.sleep(3)
-
         # Send ready
         logger.debug("Child {} (remote) sending hello".format(rank))
         try:
-            MPI.COMM_WORLD.send(True, dest=0)
+            comm.send(CHILD_READY, dest=0)
         except Exception:
             # Sometimes we see messages like this:
             # [bb2a3c26][[4455,1],95][btl_tcp_endpoint.c:818:mca_btl_tcp_endpoint_complete_connect] connect() to 169.254.95.120 failed: Connection refused (111)
@@ -261,46 +844,41 @@ def mpi_child(fn):
             continue
         else:
             logger.debug("Child {} (remote) sent hello".format(rank))
+            break
 
-        start = time.time()
-        retry = False
-        # child - wait to be given a data structure
-        while not MPI.COMM_WORLD.Iprobe(source=0):
-            if time.time() - start > CHILD_RETRY_HELLO:
-                retry = True
-                break
-            time.sleep(1)
-
-        if retry:
-            logger.debug("Child {} (remote) heard nothing from parent - will send another hello".format(rank))
-            continue
-
+    while True:
+        # child - wait to be given a chunk of data structures
         try:
-            args = MPI.COMM_WORLD.recv(source=0)
+            message = comm.recv(source=0)
         except EOFError:
             logger.exception("Child {} error receiving instructions - carrying on".format(rank))
+            # The parent is waiting for results
+            comm.send((None, None, None), dest=0)
             continue
 
-        if args is None:
+        if message is None:
             logger.info("Child {} (remote) exiting - no args received".format(rank))
+            comm.send(CHILD_EXITING, dest=0)
             break
 
-        logger.debug("Child {} (remote) received data".format(rank))
-        ret = fn(*args)
-
-        mem_raw = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        mem_size = resource.getpagesize()
-        mem_bytes = mem_raw * mem_size
-        meminfo = "{:.2f} MB".format(mem_bytes / 1024 ** 2)
+        shared, chunk = message
+        shared_data.update(shared)
 
-        if ret is None:
-            # Nothing was generated
-            MPI.COMM_WORLD.send((None, meminfo), dest=0)
-            logger.info("Child {} (remote) aborted job".format(rank))
-        else:
-            logger.debug("Child {} (remote) sending results back".format(rank))
-            MPI.COMM_WORLD.send((ret, meminfo), dest=0)
-            logger.debug("Child {} (remote) completed job".format(rank))
+        logger.debug("Child {} (remote) received {} tasks".format(rank, len(chunk)))
+        rets = []
+        durations = []
+        for args in chunk:
+            start = time.time()
+            ret = fn(*args)
+            durations.append(time.time() - start)
+            rets.append(ret)
+            if ret is None:
+                # Nothing was generated
+                logger.info("Child {} (remote) aborted job".format(rank))
+
+        logger.debug("Child {} (remote) sending results back".format(rank))
+        comm.send((rets, durations, peak_rss()), dest=0)
+        logger.debug("Child {} (remote) completed {} tasks".format(rank, len(chunk)))
 
         # Show leaking objects... uncomment this to track them...
         # tracker.print_diff()
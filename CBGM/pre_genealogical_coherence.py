@@ -5,9 +5,38 @@ import logging
 import os
 import json
 from collections import defaultdict
-from .shared import pretty_p
+from .shared import pretty_p, coherence_fingerprint
+from . import mpisupport
 logger = logging.getLogger(__name__)
 
+# db_file -> (URI, connection) of the in-memory copy of its shared cbgm table
+# (see connect) - the connection keeps it open
+_db_copies = {}
+
+
+def connect(db_file):
+    """
+    Connect to the database - or, in an MPI child, to an in-memory copy of its
+    cbgm table, if the parent has shared it (see share_attestations). So the
+    children don't need the database file.
+    """
+    table = mpisupport.shared_data.get(('cbgm', db_file))
+    if table is None or not mpisupport.in_child():
+        return sqlite3.connect(db_file)
+
+    if db_file not in _db_copies:
+        logger.debug("Copying the shared cbgm table for %s into memory", db_file)
+        uri = "file:cbgm{}?mode=memory&cache=shared".format(len(_db_copies))
+        schema, rows = table
+        conn = sqlite3.connect(uri, uri=True)
+        for sql in schema:
+            conn.execute(sql)
+        if rows:
+            conn.executemany("INSERT INTO cbgm VALUES ({})".format(', '.join('?' * len(rows[0]))), rows)
+        conn.commit()
+        _db_copies[db_file] = (uri, conn)
+    return sqlite3.connect(_db_copies[db_file][0], uri=True)
+
 
 class Coherence(object):
     CACHE_BASEDIR = os.getcwd()
@@ -24,8 +53,9 @@ class Coherence(object):
         @param debug: show more columns for debugging
         @param use_cache: use the file cache for this db to speed things up
         """
-        self.conn = sqlite3.connect(db_file)
+        self.conn = connect(db_file)
         self.cursor = self.conn.cursor()
+        self.db_file = db_file
         self.w1 = w1
         self.rows = []
         self.columns = ['W2', 'NR', 'PERC1', 'EQ', 'PASS']
@@ -42,7 +72,9 @@ class Coherence(object):
 
         # Special formatters for the data (if required)
         self.formatters = {'PERC1': '{:.3f}'}
-        self.all_mss = [x[0] for x in self.cursor.execute('SELECT DISTINCT witness FROM cbgm')]
+        self.all_mss = mpisupport.shared_data.get(('witnesses', db_file))
+        if self.all_mss is None:
+            self.all_mss = [x[0] for x in self.cursor.execute('SELECT DISTINCT witness FROM cbgm')]
 
     def set_variant_unit(self, variant_unit):
         """
@@ -67,11 +99,19 @@ class Coherence(object):
             for col in ['READING', 'TEXT']:
                 self._add_item(row['W2'], col, row)
 
+    def _shared_key(self):
+        """
+        The key for these rows in mpisupport.shared_data - which doesn't
+        depend on where the (parent's) cache is
+        """
+        return ('coherence', os.path.relpath(self._cache_key, self.CACHE_BASEDIR))
+
     def _check_cache(self):
         """
-        Does a cache entry exist for this?
+        Does a cache entry exist for this? (Or have the rows been shared with
+        us - see share_coherence.)
         """
-        return os.path.exists(self._cache_key)
+        return self._shared_key() in mpisupport.shared_data or os.path.exists(self._cache_key)
 
     def _store_cache(self):
         """
@@ -105,6 +145,14 @@ class Coherence(object):
         logger.debug("Loading coherence data for %s from cache", self.w1)
 
         assert self.variant_unit is None, "Cannot load from cache once variant_unit has been set"
+        shared = mpisupport.shared_data.get(self._shared_key())
+        if shared is not None:
+            # Our own copy, as set_variant_unit changes the rows
+            self.rows = [dict(row) for row in shared]
+            self._already_generated = True
+            logger.debug("Loaded {} shared rows".format(len(self.rows)))
+            return
+
         with open(self._cache_key) as f:
             self.rows = json.load(f)
 
@@ -256,10 +304,9 @@ class Coherence(object):
         if self._all_attestations:
             return self._all_attestations
 
-        ret = defaultdict(defaultdict)
-        for row in self.cursor.execute("""SELECT witness, variant_unit, label FROM cbgm"""):
-            witness, vu, label = row
-            ret[witness][vu] = label
+        ret = mpisupport.shared_data.get(('attestations', self.db_file))
+        if ret is None:
+            ret = load_attestations(self.cursor)
 
         self._all_attestations = ret
 
@@ -322,6 +369,54 @@ class Coherence(object):
         return "{}\n{}".format(header, '\n'.join(lines))
 
 
+def load_attestations(cursor):
+    """
+    What each witness reads in each variant unit: {witness: {vu: label}}
+    """
+    ret = defaultdict(defaultdict)
+    for row in cursor.execute("""SELECT witness, variant_unit, label FROM cbgm"""):
+        witness, vu, label = row
+        ret[witness][vu] = label
+    return ret
+
+
+def share_attestations(mpihandler, db_file):
+    """
+    Share the witnesses, and what they all read, with the MPI children - so
+    that their Coherence objects don't have to load them for every task.
+
+    The whole cbgm table and its fingerprint are shared too, so the children
+    don't need the database file at all (see connect).
+
+    @param mpihandler: an mpisupport.MpiParent
+    """
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    mpihandler.mpi_share(('witnesses', db_file),
+                         [x[0] for x in cursor.execute('SELECT DISTINCT witness FROM cbgm')])
+    mpihandler.mpi_share(('attestations', db_file), load_attestations(cursor))
+    # (The table before its indexes)
+    schema = [x[0] for x in cursor.execute("""SELECT sql FROM sqlite_master
+                                              WHERE tbl_name = 'cbgm' AND sql IS NOT NULL
+                                              ORDER BY type DESC""")]
+    mpihandler.mpi_share(('cbgm', db_file), (schema, list(cursor.execute('SELECT * FROM cbgm'))))
+    mpihandler.mpi_share(('coherence_fingerprint', db_file), coherence_fingerprint(db_file))
+    conn.close()
+
+
+def share_coherence(mpihandler, coh):
+    """
+    Share the (generated) rows of this coherence object with the MPI
+    children - which then use them rather than their file cache, which might
+    not be on the same filesystem as ours.
+
+    @param mpihandler: an mpisupport.MpiParent
+    """
+    assert coh._already_generated, "Must generate before sharing"
+    assert coh.variant_unit is None, "Cannot share once variant_unit has been set"
+    mpihandler.mpi_share(coh._shared_key(), coh.rows)
+
+
 def pre_gen_coherence(db_file, w1, variant_unit=None, *, pretty_p=False, debug=False, use_cache=False):
     """
     Show a table of pre-genealogical coherence of all witnesses compared to w1.
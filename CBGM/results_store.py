@@ -0,0 +1,174 @@
+# encoding: utf-8
+
+"""
+A single-file (SQLite) store for textual flow results.
+
+Rather than writing a .dot and .svg file per diagram into cNNN/ directories,
+everything goes into one database file - with an index so the "already
+done?" checks are cheap. The old directory layout can be recreated with
+ResultsStore.export (see bin/cbgm_export_results).
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+# reading is '' for a diagram of the whole variant unit (I.e. not --box-readings)
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS results (variant_unit TEXT, connectivity TEXT, reading TEXT,
+                                             suffix TEXT, name TEXT, dot TEXT, svg TEXT,
+                                             metadata TEXT, created REAL, input_hash TEXT,
+                                             PRIMARY KEY (variant_unit, connectivity, reading, suffix));""",
+          "CREATE INDEX IF NOT EXISTS connidx ON results (connectivity);",
+          "CREATE INDEX IF NOT EXISTS nameidx ON results (connectivity, name);"]
+
+
+def conn_dirname(conn_value):
+    """
+    The name of the directory used for a connectivity value in the old
+    directory layout - e.g. c499 or c85perc.
+    """
+    return "c{}".format(conn_value.replace('%', 'perc'))
+
+
+class ResultsStore(object):
+    """
+    Class representing a results store file. It's safe to re-open the same
+    file as many times as you like - new results are added to it.
+    """
+    def __init__(self, filename):
+        """
+        @param filename: the SQLite file to use (created if required)
+        """
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.cursor = self.conn.cursor()
+        for s in SCHEMA:
+            self.cursor.execute(s)
+
+        # Stores made before input hashes were recorded
+        columns = [x[1] for x in self.cursor.execute("PRAGMA table_info(results)")]
+        if 'input_hash' not in columns:
+            self.cursor.execute("ALTER TABLE results ADD COLUMN input_hash TEXT")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def has(self, variant_unit, connectivity, reading=None, suffix=''):
+        """
+        Is there already a result for this?
+        """
+        sql = """SELECT 1 FROM results
+                 WHERE variant_unit = ? AND connectivity = ? AND reading = ? AND suffix = ?"""
+        self.cursor.execute(sql, (variant_unit, connectivity, reading or '', suffix))
+        return self.cursor.fetchone() is not None
+
+    def input_hashes(self, variant_unit, connectivity, suffix=''):
+        """
+        Return a dict of reading (None for the whole variant unit) to the
+        input hash of the stored result.
+        """
+        sql = """SELECT reading, input_hash FROM results
+                 WHERE variant_unit = ? AND connectivity = ? AND suffix = ?"""
+        return {x[0] or None: x[1] for x in self.cursor.execute(sql, (variant_unit, connectivity, suffix))}
+
+    def put(self, variant_unit, connectivity, name, dot, svg, *, reading=None, suffix='', metadata=None,
+            input_hash=None):
+        """
+        Store a result - replacing any existing one.
+
+        @param name: the base filename (no extension) for the old directory layout
+        @param dot: DOT source (str)
+        @param svg: SVG image (str)
+        @param metadata: optional dict of extra data
+        @param input_hash: hash of the inputs this result was made from
+        """
+        sql = """INSERT OR REPLACE INTO results
+                     (variant_unit, connectivity, reading, suffix, name, dot, svg, metadata, created, input_hash)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        self.cursor.execute(sql, (variant_unit, connectivity, reading or '', suffix, name, dot, svg,
+                                  json.dumps(metadata or {}), time.time(), input_hash))
+        self.conn.commit()
+
+    def get(self, variant_unit, connectivity, reading=None, suffix=''):
+        """
+        Return the result as a dict, or None if there isn't one.
+        """
+        sql = """SELECT variant_unit, connectivity, reading, suffix, name, dot, svg, metadata, input_hash
+                 FROM results
+                 WHERE variant_unit = ? AND connectivity = ? AND reading = ? AND suffix = ?"""
+        self.cursor.execute(sql, (variant_unit, connectivity, reading or '', suffix))
+        row = self.cursor.fetchone()
+        return self._row_dict(row) if row else None
+
+    def get_svg(self, connectivity, name):
+        """
+        Return the SVG of the result with this name (see put), or None if there isn't one.
+        """
+        sql = "SELECT svg FROM results WHERE connectivity = ? AND name = ?"
+        self.cursor.execute(sql, (connectivity, name))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def connectivity_values(self):
+        """
+        All the connectivity values in this store
+        """
+        return [x[0] for x in self.cursor.execute("SELECT DISTINCT connectivity FROM results")]
+
+    def iter_results(self, connectivity=None, *, with_data=True):
+        """
+        Yield a dict for each result (optionally for just one connectivity value).
+
+        @param with_data: include the (large) dot and svg data
+        """
+        cols = "variant_unit, connectivity, reading, suffix, name, {}, metadata, input_hash".format(
+            "dot, svg" if with_data else "NULL, NULL")
+        sql = "SELECT {} FROM results".format(cols)
+        args = ()
+        if connectivity is not None:
+            sql += " WHERE connectivity = ?"
+            args = (connectivity, )
+        sql += " ORDER BY connectivity, name"
+
+        # Use a separate cursor, so callers can use the store while iterating
+        cursor = self.conn.cursor()
+        for row in cursor.execute(sql, args):
+            yield self._row_dict(row)
+
+    @staticmethod
+    def _row_dict(row):
+        vu, conn_value, reading, suffix, name, dot, svg, metadata, input_hash = row
+        return {'variant_unit': vu, 'connectivity': conn_value, 'reading': reading or None,
+                'suffix': suffix, 'name': name, 'dot': dot, 'svg': svg,
+                'metadata': json.loads(metadata) if metadata else {}, 'input_hash': input_hash}
+
+    def export(self, path, connectivity=None):
+        """
+        Recreate the old directory layout (cNNN/name.dot, cNNN/name.svg and
+        cNNN/name.inputs) under path.
+
+        @return: the number of diagrams exported
+        """
+        count = 0
+        for res in self.iter_results(connectivity):
+            dirname = os.path.join(path, conn_dirname(res['connectivity']))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            base = os.path.join(dirname, res['name'])
+            with open(base + '.dot', 'w') as f:
+                f.write(res['dot'])
+            with open(base + '.svg', 'w') as f:
+                f.write(res['svg'])
+            if res['input_hash']:
+                # So textual flow runs against this folder know it's up to date
+                with open(base + '.inputs', 'w') as f:
+                    f.write(res['input_hash'])
+            count += 1
+
+        logger.info("Exported %s diagrams from %s to %s", count, self.filename, path)
+        return count
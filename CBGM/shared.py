@@ -1,8 +1,13 @@
 # encoding: utf-8
 
 import re
+import os
+import json
 import string
+import sqlite3
+import hashlib
 import logging
+from . import mpisupport
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +45,34 @@ def memoize(f):
     return helper
 
 
+@memoize
+def _db_fingerprint(db_file, mtime, size):
+    h = hashlib.sha256()
+    conn = sqlite3.connect(db_file)
+    sql = "SELECT witness, variant_unit, label, parent FROM cbgm ORDER BY witness, variant_unit"
+    for row in conn.execute(sql):
+        h.update(json.dumps(row).encode('utf-8'))
+    conn.close()
+    return h.hexdigest()
+
+
+def coherence_fingerprint(db_file):
+    """
+    A hash of all the data that genealogical coherence is calculated from.
+    This is only recalculated if the database file changes (which includes
+    bin/cbgm's VACUUM, so its stat isn't enough).
+
+    MPI children use the one the parent shared (see
+    pre_genealogical_coherence.share_attestations), as they might not have
+    the database file.
+    """
+    shared = mpisupport.shared_data.get(('coherence_fingerprint', db_file))
+    if shared is not None:
+        return shared
+    st = os.stat(db_file)
+    return _db_fingerprint(os.path.abspath(db_file), st.st_mtime, st.st_size)
+
+
 def witintify(x):
     # return a sortable tuple representing this witness
     num_match = re.search('([0-9]+)', x)
@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+"""
+A single-file (SQLite) journal of the tasks an MpiParent hands out.
+
+Each task is recorded when it's queued, when it's sent to a child, and when
+its result comes back - along with the result. So if the parent dies, and
+is started again with the same journal, the results of the tasks that were
+done are just handed to mpi_handle_result again (see MpiParent.mpi_replay),
+and only the rest are sent to the children.
+"""
+
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+DISPATCHED = 'dispatched'
+DONE = 'done'
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS tasks (args BLOB PRIMARY KEY, state TEXT, result BLOB,
+                                           dispatched INTEGER DEFAULT 0, updated REAL);""",
+          "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"]
+
+
+class TaskJournal(object):
+    """
+    Class representing a task journal file. It's used by the parent's
+    threads, so each method takes a lock.
+
+    Tasks are identified by their (pickled) args, so they must be the same
+    when the work is queued again.
+    """
+    def __init__(self, filename, context=None):
+        """
+        @param filename: the SQLite file to use (created if required)
+        @param context: anything (JSON-able) the results depend on other than
+                        the tasks' args - e.g. the database's stat. If it's
+                        changed since the journal was written, the journal
+                        is started again.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        # We commit each change - but there's no need to wait for the disk
+        # each time. A crash of the machine loses the last few at worst.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for s in SCHEMA:
+            self.conn.execute(s)
+
+        context = json.dumps(context, sort_keys=True)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'context'").fetchone()
+        if row and row[0] != context:
+            logger.warning("Task journal %s is for different data - starting again", filename)
+            self.conn.execute("DELETE FROM tasks")
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('context', ?)", (context,))
+        self.conn.commit()
+
+        done = self.conn.execute("SELECT COUNT(*) FROM tasks WHERE state = ?", (DONE, )).fetchone()[0]
+        if done:
+            logger.info("Task journal %s has the results of %s tasks", filename, done)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def _key(args):
+        return pickle.dumps(args, protocol=4)
+
+    def queued(self, args):
+        """
+        Record that a task has been queued (or returned to the queue) - unless
+        it's done already
+        """
+        sql = """INSERT INTO tasks (args, state, updated) VALUES (?, ?, ?)
+                 ON CONFLICT (args) DO UPDATE SET state = excluded.state, updated = excluded.updated
+                 WHERE state != ?"""
+        with self.lock:
+            self.conn.execute(sql, (self._key(args), QUEUED, time.time(), DONE))
+            self.conn.commit()
+
+    def dispatched(self, chunk):
+        """
+        Record that these tasks have been sent to a child
+        """
+        sql = """UPDATE tasks SET state = ?, dispatched = dispatched + 1, updated = ?
+                 WHERE args = ? AND state != ?"""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(sql, [(DISPATCHED, now, self._key(args), DONE) for args in chunk])
+            self.conn.commit()
+
+    def done(self, args, ret):
+        """
+        Record the result of a task
+        """
+        sql = "INSERT OR REPLACE INTO tasks (args, state, result, updated) VALUES (?, ?, ?, ?)"
+        with self.lock:
+            self.conn.execute(sql, (self._key(args), DONE, pickle.dumps(ret, protocol=4), time.time()))
+            self.conn.commit()
+
+    def result(self, args):
+        """
+        Return (True, result) if the task is done, or (False, None)
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM tasks WHERE args = ? AND state = ?",
+                                    (self._key(args), DONE)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def counts(self):
+        """
+        The number of tasks in each state
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
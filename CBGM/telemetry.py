@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+"""
+Performance telemetry for the MPI (or local) children.
+
+With a telemetry file, the MpiParent writes a JSON record (one per line)
+for each task a child does:
+
+    time: when the parent got the result (seconds since the epoch)
+    start: roughly when the child started it (by the parent's clock)
+    rank: the child
+    kind: the task's kind (see mpisupport.task_kind)
+    task: the task's args (repr)
+    chunk: how many tasks were sent to the child with it
+    queue_wait: seconds from being queued to being sent to the child
+    run_time: seconds the child took to do it
+    result_bytes: the size of the (pickled) result
+    peak_rss: the child's peak resident set size so far, in bytes
+
+summarise turns these into a report of throughput, stragglers and
+utilisation per rank (see bin/cbgm_telemetry).
+"""
+
+import json
+import math
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# A task is a straggler if it takes this many times the median for its kind
+STRAGGLER_FACTOR = 3
+
+
+class TelemetryWriter(object):
+    """
+    Appends telemetry records to a JSON-lines file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.f = open(filename, 'a')
+
+    def record(self, **fields):
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.f.write(line + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def read_telemetry(filename):
+    """
+    Return the records in a telemetry file - skipping a partly written last
+    line, as the run might have been killed
+    """
+    records = []
+    with open(filename) as f:
+        for i, line in enumerate(f):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping bad telemetry record on line %s of %s", i + 1, filename)
+    return records
+
+
+def percentile(values, perc):
+    """
+    The perc'th percentile of some (sorted) values - nearest rank
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(perc / 100 * len(values)) - 1)]
+
+
+def fmt_bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+def summarise(records, *, top=10):
+    """
+    Return a text report on these telemetry records: throughput and run
+    times for each kind of task, the stragglers, and how busy each rank was.
+
+    @param top: how many of the slowest tasks to show
+    """
+    if not records:
+        return "No telemetry records"
+
+    first = min(r['start'] for r in records)
+    last = max(r['time'] for r in records)
+    span = max(last - first, 1e-9)
+    busy = sum(r['run_time'] for r in records)
+    ranks = sorted(set(r['rank'] for r in records))
+    lines = ["{} tasks in {:.1f}s on {} ranks: {:.2f} tasks/s, {:.1f}% utilisation".format(
+        len(records), span, len(ranks), len(records) / span, 100.0 * busy / (span * len(ranks)))]
+
+    # Each kind of task
+    by_kind = defaultdict(list)
+    for r in records:
+        by_kind[r['kind']].append(r)
+    lines.append("")
+    lines.append("{:<16} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        'Kind', 'Tasks', 'Tasks/s', 'Median s', 'p95 s', 'Max s', 'Queue wait s', 'Result size'))
+    medians = {}
+    for kind in sorted(by_kind, key=str):
+        recs = by_kind[kind]
+        times = sorted(r['run_time'] for r in recs)
+        medians[kind] = percentile(times, 50)
+        kind_span = max(max(r['time'] for r in recs) - min(r['start'] for r in recs), 1e-9)
+        lines.append("{:<16} {:>8} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.3f} {:>12}".format(
+            str(kind), len(recs), len(recs) / kind_span, medians[kind], percentile(times, 95), times[-1],
+            sum(r['queue_wait'] for r in recs) / len(recs),
+            fmt_bytes(sum(r['result_bytes'] for r in recs) / len(recs))))
+
+    # Stragglers - the slowest tasks, if they're well behind their kind
+    stragglers = [r for r in records
+                  if r['run_time'] > STRAGGLER_FACTOR * medians[r['kind']] and r['run_time'] > 0]
+    stragglers.sort(key=lambda r: -r['run_time'])
+    lines.append("")
+    lines.append("{} stragglers (more than {} times the median for their kind){}".format(
+        len(stragglers), STRAGGLER_FACTOR, ", the slowest:" if stragglers else ""))
+    for r in stragglers[:top]:
+        lines.append("  {:.3f}s on rank {}: {}".format(r['run_time'], r['rank'], r['task']))
+
+    # Each rank
+    by_rank = defaultdict(list)
+    for r in records:
+        by_rank[r['rank']].append(r)
+    lines.append("")
+    lines.append("{:<6} {:>8} {:>10} {:>12} {:>12} {:>12}".format(
+        'Rank', 'Tasks', 'Busy s', 'Utilisation', 'Last result', 'Peak RSS'))
+    for rank in ranks:
+        recs = by_rank[rank]
+        rank_busy = sum(r['run_time'] for r in recs)
+        lines.append("{:<6} {:>8} {:>10.1f} {:>11.1f}% {:>11.1f}s {:>12}".format(
+            rank, len(recs), rank_busy, 100.0 * rank_busy / span, max(r['time'] for r in recs) - first,
+            fmt_bytes(max(r['peak_rss'] for r in recs))))
+
+    return '\n'.join(lines)
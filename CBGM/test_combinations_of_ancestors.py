@@ -0,0 +1,388 @@
+from unittest import TestCase
+import logging
+import os
+import csv
+import tempfile
+import shutil
+import numpy as np
+from unittest import mock
+from CBGM import test_db
+from itertools import combinations
+import sqlite3
+from CBGM.combinations_of_ancestors import (combinations_of_ancestors, combination_batches, ExplanationMasks,
+                                            SpillSorter, Result, unrank_combination, powerset_ranges, Checkpoint,
+                                            prune_dominated, Substemma, SubstemmaReducer, write_optimal_substemmata,
+                                            combanc_for_all_witnesses_mpi, MpiHandler,
+                                            DEFAULT_CHECKPOINT_INTERVAL)
+from CBGM.mpisupport import MpiFailure
+from CBGM.global_stemma import load
+from CBGM.genealogical_coherence import ParentCombination
+from CBGM.pre_genealogical_coherence import Coherence
+from CBGM.test_logging import default_logging
+
+default_logging()
+logger = logging.getLogger(__name__)
+
+
+class TestCombinationsOfAncestors(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_db = test_db.TestDatabase()
+        cls.tmpdir = tempfile.mkdtemp(__name__)
+        Coherence.CACHE_BASEDIR = cls.tmpdir
+        # The output files go in the current directory
+        cls.orig_dir = os.getcwd()
+        os.chdir(cls.tmpdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.orig_dir)
+        cls.test_db.cleanup()
+        shutil.rmtree(cls.tmpdir)
+
+    def load(self, csv_file):
+        with open(csv_file) as f:
+            return list(csv.DictReader(f))
+
+    def test_combinations_of_ancestors(self):
+        """
+        Check the combinations of ancestors for 032 - which has 5 potential ancestors
+        """
+        combinations_of_ancestors(self.test_db.db_file, '032', -1)
+        rows = self.load('032.csv')
+        self.assertEqual(31, len(rows))
+        self.assertEqual({'Vorf': '03', 'Vorfanz': '1', 'Stellen': '14', 'Post': '1', 'Fragl': '21', 'Offen': '0',
+                          'Hinweis': '<<', 'sum_rank': '1', 'ranks': '1', 'vus_post': '23/3'}, rows[0])
+        self.assertEqual(29, len([x for x in rows if x['Hinweis'] == '<<']))
+        self.assertEqual({'Vorf': '091', 'Vorfanz': '1', 'Stellen': '7', 'Post': '1', 'Fragl': '21', 'Offen': '7',
+                          'Hinweis': '', 'sum_rank': '5', 'ranks': '5', 'vus_post': '23/3'}, rows[-1])
+
+    def test_only_complete(self):
+        """
+        Check incomplete combinations can be excluded
+        """
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, allow_incomplete=False, debug=True,
+                                  suffix='_complete')
+        rows = self.load('032_complete.csv')
+        self.assertEqual(30, len(rows))
+        self.assertNotIn('091', [x['Vorf'] for x in rows])
+        self.assertEqual('22/62-66, 23/3', rows[-1]['vus_post'])
+        self.assertEqual('', rows[-1]['vus_offen'])
+        self.assertTrue(rows[-1]['vus_fragl'].startswith('21/6-8, 21/20-24, 21/28-30, 22/10'))
+
+    def test_exact(self):
+        """
+        Check the exact engine finds just the optimal rows - here, single
+        ancestors explain as much by agreement as any combination can
+        """
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_exact', engine='exact')
+        rows = self.load('032_exact.csv')
+        self.assertEqual(['03', '019', '𝔓75'], [x['Vorf'] for x in rows])
+        self.assertEqual({'<<'}, set(x['Hinweis'] for x in rows))
+        self.assertEqual({'14'}, set(x['Stellen'] for x in rows))
+
+        # 05 has too many potential ancestors to check them all
+        combinations_of_ancestors(self.test_db.db_file, '05', -1, suffix='_exact', engine='exact')
+        rows = self.load('05_exact.csv')
+        self.assertEqual(18, len(rows))
+        self.assertEqual({'Vorf': 'A, 0211', 'Vorfanz': '2', 'Stellen': '14', 'Post': '2', 'Fragl': '18',
+                          'Offen': '0', 'Hinweis': '<<', 'sum_rank': '13', 'ranks': '2, 11',
+                          'vus_post': '22/52, 22/80'}, rows[0])
+
+    def test_gray(self):
+        """
+        Check the gray engine gives the same rows as the powerset engine
+        """
+        for allow_incomplete in (True, False):
+            suffix = '_{}'.format(allow_incomplete)
+            combinations_of_ancestors(self.test_db.db_file, '032', -1, allow_incomplete=allow_incomplete,
+                                      debug=True, suffix=suffix + '_powerset')
+            combinations_of_ancestors(self.test_db.db_file, '032', -1, allow_incomplete=allow_incomplete,
+                                      debug=True, suffix=suffix + '_gray', engine='gray')
+            key = lambda x: x['Vorf']
+            self.assertEqual(sorted(self.load('032{}_powerset.csv'.format(suffix)), key=key),
+                             sorted(self.load('032{}_gray.csv'.format(suffix)), key=key))
+
+    def test_frontier(self):
+        """
+        Check the frontier keeps just the rows no other row beats
+        """
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_all')
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_frontier', frontier=True)
+        all_rows = self.load('032_all.csv')
+        rows = self.load('032_frontier.csv')
+        # 03, 019 and P75 are equally good, except that 03 is the closest
+        self.assertEqual([all_rows[0]], rows)
+
+    def test_spill(self):
+        """
+        Check the rows come out the same when they're sorted in lots of runs
+        """
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_memory')
+        combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_spill', sort_memory=0.001)
+        self.assertEqual(self.load('032_memory.csv'), self.load('032_spill.csv'))
+
+    def test_spill_sorter(self):
+        """
+        Check the runs are merged in order, and removed afterwards
+        """
+        results = [Result(-(x % 7), -(x % 3), x % 5, 1, x, (x,), b'', b'') for x in range(100)]
+        with SpillSorter(0.001) as sorter:
+            for result in results:
+                sorter.add(result)
+            self.assertGreater(sorter.n_runs, 10)
+            tmpdir = sorter.tmpdir.name
+            self.assertEqual(sorted(results), list(sorter.sorted_results()))
+        self.assertFalse(os.path.exists(tmpdir))
+
+    def test_combination_batches(self):
+        """
+        Check the batches follow the powerset, and stop at the total
+        """
+        batches = list(combination_batches(4, 9, 3))
+        self.assertEqual([[()], [(0,), (1,), (2,)], [(3,)], [(0, 1), (0, 2), (0, 3)], [(1, 2)]],
+                         [[tuple(x) for x in batch] for batch in batches])
+
+    def test_checkpoint_opt_in(self):
+        """
+        Check checkpoints are only saved if asked for
+        """
+        with mock.patch('CBGM.combinations_of_ancestors.Checkpoint', wraps=Checkpoint) as checkpoint:
+            combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_unchecked')
+            self.assertFalse(checkpoint.called)
+
+            combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_resumed', resume=True)
+            self.assertEqual(DEFAULT_CHECKPOINT_INTERVAL, checkpoint.call_args[0][3])
+
+    def test_resume(self):
+        """
+        Check a run that's killed part way through can be resumed from its
+        checkpoint
+        """
+        combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_whole')
+
+        save = Checkpoint.batch_done
+
+        def killed(checkpoint, position, numrows):
+            save(checkpoint, position, numrows)
+            if position > 1000:
+                raise KeyboardInterrupt
+
+        for frontier in (False, True):
+            suffix = '_resumed_{}'.format(frontier)
+            with mock.patch.object(Checkpoint, 'batch_done', killed):
+                with self.assertRaises(KeyboardInterrupt):
+                    combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix=suffix, frontier=frontier,
+                                              sort_memory=0.01, checkpoint_interval=1e-9)
+            self.assertFalse(os.path.exists('05{}.csv'.format(suffix)))
+            self.assertTrue(os.path.exists('.05{}.combanc/checkpoint.json'.format(suffix)))
+
+            with mock.patch('CBGM.combinations_of_ancestors.combination_batches') as batches:
+                batches.side_effect = combination_batches
+                combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix=suffix, frontier=frontier,
+                                          checkpoint_interval=1e-9, resume=True)
+                # It carried on from where it got to
+                self.assertGreater(batches.call_args[0][3], 1000)
+            self.assertFalse(os.path.exists('.05{}.combanc'.format(suffix)))
+
+            if frontier:
+                combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_whole_frontier', frontier=True)
+                self.assertEqual(self.load('05_whole_frontier.csv'), self.load('05{}.csv'.format(suffix)))
+            else:
+                self.assertEqual(self.load('05_whole.csv'), self.load('05{}.csv'.format(suffix)))
+
+    def test_prune_dominated(self):
+        """
+        Check potential ancestors are only pruned if a better ranked one can
+        always stand in for them
+        """
+        explanations = {
+            '1/1': [(['A'], 1), (['B'], 1)],
+            # A can't explain this by posterity
+            '1/2': [(['B'], 2), (['C'], 1)],
+            # C explains this by itself, so D doesn't help
+            '1/3': [(['C', 'D'], 1), (['C'], 1), (['A'], 2)],
+        }
+        vu_map = {}
+        for vu, expl in explanations.items():
+            vu_combs = [[ParentCombination(w, 1, 50.0, gen) for w in wits] for wits, gen in expl]
+            vu_map[vu] = (vu_combs, [set(x.parent for x in a) for a in vu_combs])
+
+        kept, dropped = prune_dominated(['A', 'B', 'C', 'D', 'E'], vu_map, {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5})
+        self.assertEqual(['A', 'B', 'C'], kept)
+        # E doesn't explain anything
+        self.assertEqual({'D': 'A', 'E': 'A'}, dropped)
+
+        # The best combinations of each size are just as good
+        combinations_of_ancestors(self.test_db.db_file, '05', -1, suffix='_unpruned', engine='exact')
+        combinations_of_ancestors(self.test_db.db_file, '05', -1, suffix='_pruned', prune=True)
+        best = {x['Vorfanz']: x['Stellen'] for x in self.load('05_unpruned.csv')}
+        pruned_best = {x['Vorfanz']: x['Stellen'] for x in self.load('05_pruned.csv') if x['Hinweis'] == '<<'}
+        self.assertEqual(best, {k: pruned_best[k] for k in best})
+
+    def test_time_budget(self):
+        """
+        Check the anytime search finds the same best combinations as the exact
+        engine, and knows they're optimal
+        """
+        combinations_of_ancestors(self.test_db.db_file, '05', -1, suffix='_anytime', time_budget=2)
+        rows = self.load('05_anytime.csv')
+        self.assertEqual({'Vorf': 'A, 0211', 'Vorfanz': '2', 'Stellen': '14', 'Post': '2', 'Fragl': '18',
+                          'Offen': '0', 'Hinweis': '<<', 'sum_rank': '13', 'ranks': '2, 11',
+                          'vus_post': '22/52, 22/80', 'Gap': '0'}, rows[0])
+        # The best of each size
+        self.assertEqual(len(rows), len(set(x['Vorfanz'] for x in rows)))
+
+    def test_substemma(self):
+        """
+        Check the recommended optimal substemma comes out as the CSV file is
+        written, and can be loaded for the global stemma
+        """
+        substemma = combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_optsub')
+        self.assertEqual(Substemma('032', ['03'], 'simple'), substemma)
+        # The same from the existing file
+        self.assertEqual(substemma, combinations_of_ancestors(self.test_db.db_file, '032', -1, suffix='_optsub'))
+
+        write_optimal_substemmata([substemma, Substemma('A', [], None), Substemma('05', ['A', '03, 07'], 'UNKNOWN')],
+                                  'optsub_test.py')
+        self.assertEqual({'032': [{'03'}], '05': [{'A'}, {'03', '07'}]}, load('optsub_test.py'))
+
+    def test_substemma_reducer(self):
+        """
+        Check the SubstemmaReducer's choices
+        """
+        def row(vorf, post, offen, hinweis, sum_rank=1):
+            return {'Vorf': vorf, 'Vorfanz': len(vorf.split(',')), 'Post': post, 'Offen': offen,
+                    'Hinweis': '<<' if hinweis else '', 'sum_rank': sum_rank, 'vus_post': ''}
+
+        reducer = SubstemmaReducer()
+        for x in [row('B', 3, 1, False), row('A, B', 2, 0, True, 3), row('A, C', 2, 0, True, 2),
+                  row('A, B, C', 1, 0, True), row('C', 5, 0, False)]:
+            reducer.add(x)
+        # The smaller one is as good, but it's too close to call by posterity
+        self.assertEqual(Substemma('X', ['A, B, C', 'A, C'], 'UNKNOWN'), reducer.substemma('X'))
+        self.assertEqual(Substemma('X', ['A, B, C'], 'simple, in the end'),
+                         reducer.substemma('X', max_by_posterity=0))
+
+        # The Hinweis rows don't have the minimum Offen
+        reducer = SubstemmaReducer()
+        for x in [row('A', 1, 1, True), row('B', 1, 0, False)]:
+            reducer.add(x)
+        self.assertEqual(Substemma('X', [], None), reducer.substemma('X'))
+
+    def test_combination_ranges(self):
+        """
+        Check the ranges of the powerset join up - whatever size of combination
+        they start in the middle of
+        """
+        self.assertEqual(list(combinations(range(7), 3)),
+                         [unrank_combination(7, 3, i) for i in range(35)])
+
+        whole = [tuple(x) for batch in combination_batches(7, 100, 8) for x in batch]
+        ranges = powerset_ranges(100, 6)
+        self.assertEqual(6, len(ranges))
+        split = [tuple(x) for start, stop in ranges for batch in combination_batches(7, stop, 8, start)
+                 for x in batch]
+        self.assertEqual(whole, split)
+
+    def test_processes(self):
+        """
+        Check splitting the work between processes gives the same rows
+        """
+        combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_serial')
+        combinations_of_ancestors(self.test_db.db_file, '05', 5000, suffix='_parallel', processes=3)
+        self.assertEqual(self.load('05_serial.csv'), self.load('05_parallel.csv'))
+
+    def test_journal(self):
+        """
+        Check a run that's interrupted can be resumed through its journal -
+        and that what's needed for any output that's gone since is done again
+        """
+        conn = sqlite3.connect(self.test_db.db_file)
+        witnesses = [x[0] for x in conn.execute("SELECT DISTINCT(witness) FROM cbgm")]
+        conn.close()
+        journal_file = os.path.join(self.tmpdir, 'journal.db')
+        save = MpiHandler.merge_ranges
+        merged = []
+
+        def interrupted(handler, w1, details):
+            if merged:
+                raise KeyboardInterrupt
+            save(handler, w1, details)
+            merged.append(w1)
+
+        with mock.patch('CBGM.combinations_of_ancestors.MPI_RANGE_SIZE', 1000):
+            combanc_for_all_witnesses_mpi(self.test_db.db_file, 5000, suffix='_unjournalled', processes=2)
+            with mock.patch.object(MpiHandler, 'merge_ranges', interrupted):
+                with self.assertRaises(MpiFailure):
+                    combanc_for_all_witnesses_mpi(self.test_db.db_file, 5000, suffix='_journalled', processes=2,
+                                                  journal_file=journal_file)
+            self.assertEqual(1, len(merged))
+            merged_file = '{}_journalled.csv'.format(merged[0])
+            merged_time = os.stat(merged_file).st_mtime_ns
+
+            # Resume it - and then do it again, with all the output removed
+            for _ in range(2):
+                combanc_for_all_witnesses_mpi(self.test_db.db_file, 5000, suffix='_journalled', processes=2,
+                                              journal_file=journal_file)
+                if merged_time:
+                    # It wasn't done again
+                    self.assertEqual(merged_time, os.stat(merged_file).st_mtime_ns)
+                    merged_time = None
+                for w1 in witnesses:
+                    self.assertEqual(self.load('{}_unjournalled.csv'.format(w1)),
+                                     self.load('{}_journalled.csv'.format(w1)))
+                    self.assertFalse(os.path.exists('.{}_journalled.combanc'.format(w1)))
+                    os.remove('{}_journalled.csv'.format(w1))
+
+    def test_explanation_masks(self):
+        """
+        Check the bitmasks give the same answer as sets - with enough potential
+        ancestors to need more than one word
+        """
+        pot_an = ['W{}'.format(i) for i in range(70)]
+        my_vus = [('1/{}'.format(i), 'a', 'b') for i in range(5)] + [('2/1', 'a', 'UNCL')]
+        vu_map = {}
+        explanations = {
+            '1/0': [(['W1'], 1), (['W65'], 2)],
+            '1/1': [(['W2', 'W66'], 2), (['W3'], 3)],
+            '1/2': [(['W69'], 1), (['W1', 'W2'], 1)],
+            '1/3': [(['W4'], 3)],
+            '1/4': [],
+        }
+        for vu, expl in explanations.items():
+            vu_combs = [[ParentCombination(w, 1, 50.0, gen) for w in wits] for wits, gen in expl]
+            vu_map[vu] = (vu_combs, [set(x.parent for x in a) for a in vu_combs])
+
+        masks = ExplanationMasks(pot_an, my_vus, vu_map)
+        self.assertEqual(2, masks.n_words)
+        self.assertEqual(['2/1'], masks.vus_fragl)
+
+        comb_idx = np.array([[1, 2], [65, 66], [2, 66], [3, 69]])
+        agreement, posterity, explained = masks.evaluate(masks.combination_masks(comb_idx))
+        self.assertEqual([[True, False, True, False, False],
+                          [False, False, False, False, False],
+                          [False, False, False, False, False],
+                          [False, False, True, False, False]], agreement.tolist())
+        self.assertEqual([[False, False, False, False, False],
+                          [True, False, False, False, False],
+                          [False, True, False, False, False],
+                          [False, False, False, False, False]], posterity.tolist())
+        self.assertEqual([[True, False, True, False, False],
+                          [True, False, False, False, False],
+                          [False, True, False, False, False],
+                          [False, True, True, False, False]], explained.tolist())
+
+        result = masks.result(comb_idx[3], agreement[3], posterity[3], {'W3': 4, 'W69': 7})
+        self.assertEqual((-1, 0, 4, 2, 11, (3, 69)), result[:6])
+        row = masks.make_row(result, {'W3': 4, 'W69': 7})
+        self.assertEqual('W3, W69', row['Vorf'])
+        self.assertEqual((1, 0, 1, 4, 11), (row['Stellen'], row['Post'], row['Fragl'], row['Offen'], row['sum_rank']))
+        self.assertEqual('1/0, 1/1, 1/3, 1/4', row['vus_offen'])
+
+        # The same thing from bitsets, as the gray engine makes it
+        packed = masks.packed_result((1 << 3) | (1 << 69), 2, 11, 1, 0, masks.vu_bit(2), 0)
+        self.assertEqual(result, packed)
+        result = masks.result(comb_idx[2], agreement[2], posterity[2], {'W2': 1, 'W66': 2})
+        packed = masks.packed_result((1 << 2) | (1 << 66), 2, 3, 0, 1, 0, masks.vu_bit(1))
+        self.assertEqual(result, packed)
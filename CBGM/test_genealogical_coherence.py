@@ -2,7 +2,7 @@ from unittest import TestCase
 import logging
 import tempfile
 import shutil
-from CBGM.genealogical_coherence import GenealogicalCoherence
+from CBGM.genealogical_coherence import GenealogicalCoherence, ExplanationTemplates
 from CBGM.pre_genealogical_coherence import Coherence
 from CBGM import test_db
 from CBGM.test_logging import default_logging
@@ -163,3 +163,49 @@ class TestGenealogicalCoherence(TestCase):
         self.assertEqual(comb[1][0].prior, 1)
         self.assertEqual(comb[1][0].posterior, 0)
         self.assertEqual(comb[1][0].strength, 1)
+
+
+class TestExplanationTemplates(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The default data has a split parentage (a&b) reading
+        cls.test_db = test_db.TestDatabase()
+        cls.tmpdir = tempfile.mkdtemp(__name__)
+        Coherence.CACHE_BASEDIR = cls.tmpdir
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.test_db.cleanup()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_parent_combinations(self):
+        """
+        Check the templates give the same parent combinations as
+        GenealogicalCoherence, for every reading of every witness
+        """
+        def key(combinations):
+            return sorted(sorted((x.parent, x.rank, x.perc, x.gen, x.prior, x.posterior) for x in comb)
+                          for comb in combinations)
+
+        templates = ExplanationTemplates(self.test_db.db_file)
+        checked = 0
+        for w1 in ['05', '01', '032', 'A']:
+            coh = GenealogicalCoherence(self.test_db.db_file, w1, pretty_p=False)
+            for vu, attestations in sorted(templates.attestations.items()):
+                reading = attestations.get(w1)
+                if reading is None:
+                    # Lacuna
+                    continue
+                parent = templates.get_parent_reading(vu, reading)
+                if parent == 'UNCL':
+                    continue
+                coh.set_variant_unit(vu)
+                self.assertEqual(key(coh.parent_combinations(reading, parent)),
+                                 key(templates.parent_combinations(coh, vu, reading, parent)),
+                                 (w1, vu, reading, parent))
+                checked += 1
+
+        self.assertGreater(checked, 50)
+        # 05's reading in 22/52 is explained by a combination of a and b (or
+        # of a and b's parent, which is also a)
+        self.assertEqual([(('a', 1), ('b', 1)), (('a', 1), ('a', 2))], templates.templates('22/52', 'c', 'a&b'))
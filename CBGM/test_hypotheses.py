@@ -0,0 +1,97 @@
+from unittest import TestCase
+import logging
+import os
+import tempfile
+import shutil
+import json
+from CBGM import test_db
+from CBGM.test_textual_flow import TEST_DATA
+from CBGM.hypotheses import HypothesisEngine
+from CBGM.populate_db import create_database, parse_input_file
+from CBGM.textual_flow import get_parents
+from CBGM.graph_data import GraphDataWriter
+from CBGM.genealogical_coherence import CyclicDependency
+from CBGM.pre_genealogical_coherence import Coherence
+from CBGM.shared import INIT
+from CBGM.test_logging import default_logging
+
+default_logging()
+logger = logging.getLogger(__name__)
+
+# The readings in 21/20-24 all have UNCL parents in TEST_DATA
+VU = '21/20-24'
+HYPOTHESES = [{'a': INIT, 'b': 'a', 'c': 'b'},
+              {'a': 'c', 'b': 'c', 'c': INIT}]
+CONNECTIVITY = ['499', '3', '80%']
+
+
+def key(parent_map):
+    """
+    A parent map, to compare - ignoring the order of the parents
+    """
+    return {conn: sorted((x.parent, x.rank, x.perc, x.gen, x.prior, x.posterior, x.undirected) for x in parents)
+            for conn, parents in parent_map.items()}
+
+
+class TestHypothesisEngine(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_db = test_db.TestDatabase(TEST_DATA)
+        cls.tmpdir = tempfile.mkdtemp(__name__)
+        Coherence.CACHE_BASEDIR = cls.tmpdir
+        cls.engine = HypothesisEngine(cls.test_db.db_file, VU)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.test_db.cleanup()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_evaluate(self):
+        """
+        Check the best parents are the same as for a database made with each
+        hypothesis
+        """
+        v, u = VU.split('/')
+        for i, hypothesis in enumerate(HYPOTHESES):
+            struct, all_mss = parse_input_file(self.test_db.py_file)
+            for reading in struct[v][u]:
+                if not reading.lacuna:
+                    reading.parent = hypothesis[reading.label]
+            db_file = os.path.join(self.tmpdir, 'hypothesis_{}.db'.format(i))
+            create_database(struct, all_mss, db_file)
+
+            parent_maps = self.engine.evaluate(hypothesis, CONNECTIVITY)
+            reading_data = self.engine.reading_data(self.engine.local_stemma(hypothesis))
+            self.assertEqual(sorted(x[0] for x in reading_data), sorted(parent_maps))
+            self.assertIn(('A', [k for k, x in hypothesis.items() if x == INIT][0], INIT), reading_data)
+            for w1, w1_reading, w1_parent in reading_data:
+                exp = get_parents(VU, w1, w1_reading, w1_parent, CONNECTIVITY, db_file, None)
+                self.assertEqual(key(exp), key(parent_maps[w1]), (hypothesis, w1))
+
+    def test_bad_hypotheses(self):
+        """
+        Check loops and multiple INIT readings are rejected
+        """
+        with self.assertRaises(CyclicDependency):
+            self.engine.evaluate({'a': INIT, 'b': 'c', 'c': 'b'}, CONNECTIVITY)
+        with self.assertRaises(ValueError):
+            self.engine.evaluate({'a': INIT, 'b': INIT, 'c': 'a'}, CONNECTIVITY)
+
+    def test_textual_flow(self):
+        """
+        Check the textual flow diagram for a hypothesis uses its parents
+        """
+        hypothesis = HYPOTHESES[1]
+        graph_file = os.path.join(self.tmpdir, 'graphs.jsonl')
+        with GraphDataWriter(graph_file) as writer:
+            self.engine.textual_flow(hypothesis, ['499'], graph_writer=writer, path=self.tmpdir)
+
+        with open(graph_file) as f:
+            graphs = [json.loads(line) for line in f]
+        self.assertEqual([VU], [x['variant_unit'] for x in graphs])
+        node_A = [x for x in graphs[0]['nodes'] if x['id'] == 'A'][0]
+        self.assertEqual('c', node_A['reading'])
+
+        parent_maps = self.engine.evaluate(hypothesis, ['499'])
+        self.assertEqual(sorted((p.parent, w1) for w1, x in parent_maps.items() for p in x['499']),
+                         sorted((x['source'], x['target']) for x in graphs[0]['edges']))
@@ -2,8 +2,10 @@ from unittest import TestCase
 import logging
 import tempfile
 import os
+import json
 import shutil
 from CBGM.local_stemma import local_stemma
+from CBGM.graph_data import GraphDataWriter
 from CBGM import test_db
 from CBGM.test_logging import default_logging
 
@@ -124,3 +126,22 @@ d	ειδως	E"""
             data = f.read().strip()
 
         self.assertEqual(data, SVG)
+
+    def test_local_stemma_graph_data(self):
+        """
+        Test the local stemma can be written as graph data instead of SVG
+        """
+        graph_file = os.path.join(self.tmpdir, 'local.json')
+        with GraphDataWriter(graph_file) as writer:
+            local_stemma(self.test_db.db_file, ['22/20'], path=self.tmpdir, suffix='_gd', graph_writer=writer)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, '22_20_gd.svg')))
+        with open(graph_file) as f:
+            graphs = json.load(f)['graphs']
+
+        self.assertEqual(1, len(graphs))
+        self.assertEqual('local_stemma', graphs[0]['type'])
+        self.assertEqual('22/20', graphs[0]['variant_unit'])
+        self.assertEqual(['a', 'b', 'c', 'd'], sorted(x['id'] for x in graphs[0]['nodes']))
+        self.assertEqual([('b', 'a'), ('c', 'b'), ('c', 'd')],
+                         sorted((x['source'], x['target']) for x in graphs[0]['edges']))
@@ -0,0 +1,227 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from CBGM import mpisupport
+from CBGM.task_journal import TaskJournal
+from CBGM.telemetry import TelemetryWriter, read_telemetry, summarise
+
+
+def double(x):
+    return x * 2
+
+
+def triple(x):
+    return x * 3
+
+
+def explode(x):
+    if x == 5:
+        raise ValueError("Can't do {}".format(x))
+    return x * 2
+
+
+def lookup(key):
+    return mpisupport.shared_data.get(key)
+
+
+class Doubler(mpisupport.MpiParent):
+    def __init__(self, processes, child_function=double, journal=None, telemetry=None):
+        self.results = {}
+        super().__init__(child_function=child_function, processes=processes, journal=journal,
+                         telemetry=telemetry)
+
+    def mpi_handle_result(self, args, ret):
+        self.results[args[0]] = ret
+
+
+class Failer(Doubler):
+    def mpi_handle_result(self, args, ret):
+        if args[0] == 5:
+            raise ValueError("Can't handle {}".format(ret))
+        super().mpi_handle_result(args, ret)
+
+
+class Sizer(Doubler):
+    def mpi_task_size(self, args):
+        return args[1]
+
+
+class TestMpiSupport(TestCase):
+    def test_task_queue(self):
+        """
+        Check the biggest tasks come out of the queue first - or the longest,
+        once we know how long each kind takes
+        """
+        q = mpisupport.TaskQueue()
+        sizes = {('A', 1): 1, ('A', 2): 5, ('B', 1): 3, ('B', 2): 3}
+        q.cost = sizes.get
+        for args in [None, ('A', 1), ('B', 1), ('A', 2), ('B', 2)]:
+            q.put(args)
+        self.assertEqual([('A', 2), ('B', 1), ('B', 2), ('A', 1), None], [q.get() for _ in range(5)])
+
+        sizer = Sizer(1)
+        sizer.mpi_wait(stop=True)
+        sizer.record_task_time(('A', 10), 1.0)
+        sizer.record_task_time(('B', 10), 100.0)
+        self.assertEqual(0.1, sizer.task_cost(('A', 1)))
+        self.assertEqual(10.0, sizer.task_cost(('B', 1)))
+        self.assertEqual(3, sizer.task_cost(('C', 3)))
+
+    def test_local_processes(self):
+        """
+        Check the work is done by local processes when not run under MPI -
+        and that they can be started again once they've been stopped
+        """
+        self.assertFalse(mpisupport.mpi_launched())
+        self.assertTrue(mpisupport.is_parent())
+
+        doubler = Doubler(2)
+        for i in range(100):
+            doubler.mpi_queue.put((i, ))
+        doubler.mpi_wait(stop=False)
+        self.assertEqual({i: i * 2 for i in range(100)}, doubler.results)
+
+        for i in range(100, 110):
+            doubler.mpi_queue.put((i, ))
+        doubler.mpi_wait(stop=True)
+        self.assertEqual(110, len(doubler.results))
+        self.assertIsNone(doubler.mpicomm)
+
+        doubler = Doubler(1)
+        doubler.mpi_queue.put((5, ))
+        doubler.mpi_wait(stop=True)
+        self.assertEqual({5: 10}, doubler.results)
+
+    def test_share(self):
+        """
+        Check the children get the data that's shared - whether it was shared
+        before or after they started - and that it's forgotten at the end
+        """
+        looker = Doubler(2, child_function=lookup)
+        looker.mpi_share('before', 1)
+        looker.mpi_wait(stop=True)
+        self.assertEqual({}, mpisupport.shared_data)
+
+        looker = Doubler(2, child_function=lookup)
+        looker.mpi_share('before', 1)
+        looker.mpi_queue.put(('before', ))
+        looker.mpi_wait(stop=False)
+        looker.mpi_share('after', [2])
+        for _ in range(5):
+            looker.mpi_queue.put(('after', ))
+            looker.mpi_queue.put(('before', ))
+        looker.mpi_queue.put(('other', ))
+        looker.mpi_wait(stop=True)
+        self.assertEqual({'before': 1, 'after': [2], 'other': None}, looker.results)
+        self.assertEqual({}, mpisupport.shared_data)
+
+    def test_journal(self):
+        """
+        Check that the tasks done last time aren't done again, but their
+        results are still handled
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            journal_file = os.path.join(tmpdir, 'journal.db')
+            doubler = Doubler(2, journal=TaskJournal(journal_file, context='test'))
+            for i in range(10):
+                doubler.mpi_queue.put((i, ))
+            doubler.mpi_wait(stop=True)
+
+            journal = TaskJournal(journal_file, context='test')
+            self.assertEqual({'done': 10}, journal.counts())
+            self.assertEqual((True, 8), journal.result((4, )))
+            self.assertEqual((False, None), journal.result((10, )))
+            journal.queued((10, ))
+            journal.dispatched([(10, )])
+            self.assertEqual({'done': 10, 'dispatched': 1}, journal.counts())
+
+            # (A different function, so we can see what was done again)
+            tripler = Doubler(2, child_function=triple, journal=journal)
+            for i in range(12):
+                tripler.mpi_queue.put((i, ))
+            tripler.mpi_wait(stop=True)
+            self.assertEqual({i: i * (2 if i < 10 else 3) for i in range(12)}, tripler.results)
+            self.assertEqual(10, tripler.mpi_replayed)
+
+            # A journal for different data starts again
+            journal = TaskJournal(journal_file, context='other')
+            self.assertEqual({}, journal.counts())
+            journal.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_failure(self):
+        """
+        Check mpi_wait fails, rather than waiting forever, if a result can't
+        be handled or a child fails - and that the work can be started again
+        afterwards
+        """
+        failer = Failer(2)
+        for i in range(10):
+            failer.mpi_queue.put((i, ))
+        with self.assertRaises(mpisupport.MpiFailure) as cm:
+            failer.mpi_wait(stop=True)
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+        self.assertIsNone(failer.mpicomm)
+        self.assertEqual(0, failer.mpi_queue.qsize())
+
+        # And if a child fails
+        exploder = Doubler(2, child_function=explode)
+        for i in range(10):
+            exploder.mpi_queue.put((i, ))
+        with self.assertRaises(mpisupport.MpiFailure):
+            exploder.mpi_wait(stop=True)
+        self.assertIsNone(exploder.mpicomm)
+
+        doubler = Doubler(2)
+        for i in range(10):
+            doubler.mpi_queue.put((i, ))
+        doubler.mpi_wait(stop=True)
+        self.assertEqual({i: i * 2 for i in range(10)}, doubler.results)
+
+    def test_telemetry(self):
+        """
+        Check there's a telemetry record for each task, and they can be
+        summarised
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            telemetry_file = os.path.join(tmpdir, 'telemetry.jsonl')
+            doubler = Doubler(2, telemetry=TelemetryWriter(telemetry_file))
+            for i in range(20):
+                doubler.mpi_queue.put((i, ))
+            doubler.mpi_wait(stop=True)
+
+            records = read_telemetry(telemetry_file)
+            self.assertEqual(20, len(records))
+            self.assertEqual(set(repr((i, )) for i in range(20)), set(x['task'] for x in records))
+            for record in records:
+                self.assertIsNone(record['kind'])
+                self.assertIn(record['rank'], (1, 2))
+                self.assertGreaterEqual(record['queue_wait'], 0)
+                self.assertGreaterEqual(record['time'], record['start'] + record['run_time'])
+                # Anything less than 1 MB must be in the wrong units
+                self.assertGreater(record['peak_rss'], 1024 ** 2)
+
+            summary = summarise(records)
+            self.assertTrue(summary.startswith("20 tasks in "), summary)
+            self.assertIn("\nNone ", summary)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_local_processes_setting(self):
+        """
+        Check the number of local processes can be set in the environment
+        """
+        orig = os.environ.get('CBGM_PROCESSES')
+        try:
+            os.environ['CBGM_PROCESSES'] = '3'
+            self.assertEqual(3, mpisupport.local_processes())
+            del os.environ['CBGM_PROCESSES']
+            self.assertEqual(os.cpu_count(), mpisupport.local_processes())
+        finally:
+            if orig is not None:
+                os.environ['CBGM_PROCESSES'] = orig
@@ -1,14 +1,23 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+import os
 import shutil
 import logging
 import tempfile
-from CBGM.pre_genealogical_coherence import Coherence
-from CBGM import test_db
+from CBGM.pre_genealogical_coherence import Coherence, share_attestations
+from CBGM import test_db, mpisupport
 from CBGM.test_logging import default_logging
 
 default_logging()
 logger = logging.getLogger(__name__)
 
+
+class Sharer(object):
+    """
+    Just shares things, like an mpisupport.MpiParent
+    """
+    def mpi_share(self, key, value):
+        mpisupport.shared_data[key] = value
+
 TEST_DATA = """# -*- coding: utf-8 -*-
 # This is a made up data set, purely for testing.
 
@@ -109,6 +118,46 @@ class TestCoherence(TestCase):
         coh4 = Coherence(self.test_db.db_file, 'C', pretty_p=False, use_cache=True)
         self.assertFalse(coh4._check_cache())
 
+    def test_shared(self):
+        """
+        Check that shared data (see mpisupport.MpiParent.mpi_share) is used
+        instead of the database and the file cache
+        """
+        coh1 = Coherence(self.test_db.db_file, 'D', pretty_p=False, use_cache=True)
+        self.assertFalse(coh1._check_cache())
+        try:
+            mpisupport.shared_data[coh1._shared_key()] = B_ROWS
+            mpisupport.shared_data[('attestations', self.test_db.db_file)] = {'B': {'21/2': 'z'}}
+            coh2 = Coherence(self.test_db.db_file, 'D', pretty_p=False, use_cache=True)
+            self.assertTrue(coh2._check_cache())
+            coh2.generate()
+            self.assertEqual(B_ROWS, coh2.rows)
+            self.assertIsNot(B_ROWS[0], coh2.rows[0])
+            self.assertEqual('z', coh2.get_attestation('B', '21/2'))
+        finally:
+            mpisupport.shared_data.clear()
+
+    def test_shared_database(self):
+        """
+        Check that an MPI child doesn't need the database file once the
+        parent has shared it
+        """
+        db_file = self.test_db.db_file
+        exp = Coherence(db_file, 'C', pretty_p=False)
+        exp.set_variant_unit('22/20')
+        moved = db_file + '.moved'
+        try:
+            share_attestations(Sharer(), db_file)
+            os.rename(db_file, moved)
+            with mock.patch('CBGM.mpisupport._in_child', True):
+                coh = Coherence(db_file, 'C', pretty_p=False)
+                coh.set_variant_unit('22/20')
+            self.assertEqual(exp.rows, coh.rows)
+            self.assertFalse(os.path.exists(db_file))
+        finally:
+            mpisupport.shared_data.clear()
+            os.rename(moved, db_file)
+
     def test_generate(self):
         """
         Test that the generate function produces rows, and they
@@ -3,7 +3,11 @@ import logging
 import os
 import tempfile
 import shutil
-from CBGM import textual_flow
+import json
+from unittest import mock
+from CBGM import textual_flow, mpisupport
+from CBGM.graph_data import GraphDataWriter
+from CBGM.results_store import ResultsStore
 from CBGM import test_db
 from CBGM.shared import INIT
 from CBGM.genealogical_coherence import ParentCombination
@@ -282,4 +286,112 @@ class TestTextualFlow(TestCase):
         edge_044_0141 = '044 -> 0141\t\t [color="#b43f3f",\n\t\t\tlabel="1 (89.2)",\n\t\t\tstyle=dotted];'
         self.assertIn(edge_044_0141, dotdata)
 
-        self.assertIn("subgraph cluster_reading {", dotdata)
\ No newline at end of file
+        self.assertIn("subgraph cluster_reading {", dotdata)
+
+    def test_graph_data(self):
+        """
+        Check the textual flow can be written as graph data (JSON lines) instead of DOT and SVG
+        """
+        graph_file = os.path.join(self.tmpdir, 'graphs.jsonl')
+        path = os.path.join(self.tmpdir, 'graph_data')
+        os.mkdir(path)
+        with GraphDataWriter(graph_file) as writer:
+            textual_flow.textual_flow(self.test_db.db_file, variant_units=['22/3', '21/2'], connectivity=["499"],
+                                      path=path, graph_writer=writer)
+
+        # Nothing drawn
+        self.assertEqual([], os.listdir(path))
+
+        with open(graph_file) as f:
+            graphs = [json.loads(line) for line in f]
+        self.assertEqual(['22/3', '21/2'], [x['variant_unit'] for x in graphs])
+
+        graph = graphs[0]
+        self.assertEqual('textual_flow', graph['type'])
+        self.assertEqual('499', graph['connectivity'])
+        node_044 = [x for x in graph['nodes'] if x['id'] == '044'][0]
+        self.assertEqual({'id': '044', 'reading': 'a', 'label': '044 (a)', 'color': '#b43f3f',
+                          'fillcolor': '#FF8A8A', 'in_group': False}, node_044)
+        edge_044_0141 = [x for x in graph['edges'] if x['source'] == '044' and x['target'] == '0141'][0]
+        self.assertEqual({'source': '044', 'target': '0141', 'rank': 1, 'perc': 89.1891891891892,
+                          'prior': 1, 'posterior': 0, 'strength': 1, 'undirected': False,
+                          'label': '1 (89.2)', 'style': 'dotted', 'color': '#b43f3f'}, edge_044_0141)
+
+    def test_results_store(self):
+        """
+        Check the textual flow can be written to a results store, and exported again
+        """
+        store_file = os.path.join(self.tmpdir, 'results.db')
+        path = os.path.join(self.tmpdir, 'results_store')
+        os.mkdir(path)
+        store = ResultsStore(store_file)
+        textual_flow.textual_flow(self.test_db.db_file, variant_units=['21/2'], connectivity=["499"],
+                                  path=path, results_store=store)
+
+        # Nothing written to the folder
+        self.assertEqual([], os.listdir(path))
+
+        self.assertEqual(['499'], store.connectivity_values())
+        self.assertTrue(store.has('21/2', '499'))
+        self.assertFalse(store.has('21/2', '5'))
+        res = store.get('21/2', '499')
+        self.assertEqual('textual_flow_21_2_c499', res['name'])
+        self.assertTrue(res['dot'].startswith('strict digraph'))
+        self.assertIn('<svg', res['svg'])
+        self.assertEqual(res['svg'], store.get_svg('499', 'textual_flow_21_2_c499'))
+        self.assertIsNone(store.get_svg('5', 'textual_flow_21_2_c499'))
+
+        self.assertEqual(1, store.export(path))
+        self.assertEqual(['textual_flow_21_2_c499.dot', 'textual_flow_21_2_c499.inputs',
+                          'textual_flow_21_2_c499.svg'],
+                         sorted(os.listdir(os.path.join(path, 'c499'))))
+        store.close()
+
+    def test_incremental_rebuild(self):
+        """
+        Check outputs are only rebuilt when their inputs change
+        """
+        store = ResultsStore(os.path.join(self.tmpdir, 'incremental.db'))
+        kwargs = dict(variant_units=['21/2', '22/3'], connectivity=["499"], path=self.tmpdir, results_store=store)
+        textual_flow.textual_flow(self.test_db.db_file, **kwargs)
+        created = {x['variant_unit']: x['input_hash'] for x in store.iter_results(with_data=False)}
+        self.assertEqual(2, len(created))
+
+        # Same again - nothing to do
+        t = textual_flow.TextualFlow(self.test_db.db_file, variant_unit='21/2', connectivity=["499"],
+                                     results_store=store)
+        self.assertEqual((1, 0), (t.reused, t.rebuilt))
+        self.assertEqual({}, t.output_files)
+
+        # Change a parameter - rebuilt
+        t = textual_flow.TextualFlow(self.test_db.db_file, variant_unit='21/2', connectivity=["499"],
+                                     results_store=store, min_strength=5)
+        self.assertEqual((0, 1), (t.reused, t.rebuilt))
+        t.calculate_textual_flow()
+        self.assertNotEqual(created['21/2'], store.get('21/2', '499')['input_hash'])
+        self.assertEqual(created['22/3'], store.get('22/3', '499')['input_hash'])
+        store.close()
+
+    def test_failed_parents(self):
+        """
+        Check a variant unit with parents that couldn't be calculated by the
+        local processes isn't drawn, and the run fails naming it - rather
+        than waiting for it forever
+        """
+        get_parents = textual_flow.get_parents
+
+        def failing(variant_unit, w1, *args, **kwargs):
+            if variant_unit == '21/2' and w1 == '05':
+                return None
+            return get_parents(variant_unit, w1, *args, **kwargs)
+
+        graph_file = os.path.join(self.tmpdir, 'failed.jsonl')
+        with mock.patch('CBGM.textual_flow.get_parents', failing):
+            with GraphDataWriter(graph_file) as writer:
+                with self.assertRaisesRegex(mpisupport.MpiFailure, r'variant unit\(s\) 21/2$'):
+                    textual_flow.textual_flow(self.test_db.db_file, variant_units=['22/3', '21/2'],
+                                              connectivity=["499"], path=self.tmpdir, graph_writer=writer,
+                                              processes=2)
+
+        with open(graph_file) as f:
+            self.assertEqual(['22/3'], [json.loads(line)['variant_unit'] for line in f])
@@ -6,8 +6,16 @@ import logging
 import pygraphviz
 import string
 import os
-from .shared import OL_PARENT
-from .genealogical_coherence import GenealogicalCoherence, ParentCombination, generate_genealogical_coherence_cache
+import json
+import hashlib
+import queue
+import threading
+from .shared import OL_PARENT, memoize, coherence_fingerprint
+from .genealogical_coherence import (GenealogicalCoherence, ParentCombination, generate_genealogical_coherence_cache,
+                                     queue_genealogical_coherence, genealogical_coherence_done)
+from .results_store import conn_dirname
+from .task_journal import TaskJournal
+from .telemetry import TelemetryWriter
 from . import mpisupport
 
 # Colours from http://www.hitmill.com/html/pastels.html
@@ -53,6 +61,23 @@ class ForestError(Exception):
     pass
 
 
+# The modules whose code affects what a textual flow diagram looks like
+FINGERPRINT_MODULES = ('textual_flow', 'genealogical_coherence', 'pre_genealogical_coherence', 'shared')
+
+
+@memoize
+def code_fingerprint():
+    """
+    A hash of the code used to make textual flow diagrams - so we know to
+    rebuild them if it changes.
+    """
+    h = hashlib.sha256()
+    for mod in FINGERPRINT_MODULES:
+        with open(os.path.join(os.path.dirname(__file__), '{}.py'.format(mod)), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
 def mpi_child_wrapper(*args):
     """
     Wraps MPI child calls and executes the appropriate function.
@@ -68,31 +93,135 @@ def mpi_child_wrapper(*args):
 
 class MpiHandler(mpisupport.MpiParent):
     mpi_child_timeout = 3600 * 4  # 4 hours
+    # How often (in seconds) draw_textual_flows checks the work hasn't
+    # failed while it's waiting
+    draw_check_interval = 60
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, processes=None, journal=None, telemetry=None):
+        super().__init__(child_function=mpi_child_wrapper, processes=processes, journal=journal,
+                         telemetry=telemetry)
         self.textual_flow_objects = {}
+        self.reused = 0
+        self.rebuilt = 0
+        # mpi_handle_result is called from the child manager threads
+        self.lock = threading.Lock()
+        # TextualFlow objects with all their parents calculated, ready to draw
+        self.ready = queue.Queue()
+        # Variant units whose parents couldn't all be calculated
+        self.failed = []
 
     def queue_textual_flow(self, vu, **kwargs):
         """
         Make a TextualFlow object, and get it to queue up all its MPI work.
+        This doesn't wait for the work to be done - see draw_textual_flows.
         """
         print(kwargs)
         try:
             tf = TextualFlow(variant_unit=vu, **kwargs, mpihandler=self)
-            self.textual_flow_objects[vu] = tf
+            self.reused += tf.reused
+            self.rebuilt += tf.rebuilt
+            if not tf.output_files:
+                logger.info("Nothing to do - skipping variant unit {}".format(vu))
+                return
+            with self.lock:
+                self.textual_flow_objects[vu] = tf
             tf.calculate_textual_flow()
         except Exception:
             logger.exception("Fatal error")
             self.mpi_wait(stop=True)
             raise
 
+    def parents_done(self, tf):
+        """
+        All the parents for this TextualFlow object have been calculated
+        """
+        self.ready.put(tf)
+
+    def draw_textual_flows(self):
+        """
+        Draw the diagrams for each queued variant unit as soon as its own
+        parents have been calculated - while the children carry on with the
+        other variant units.
+
+        Variant units with parents that couldn't be calculated aren't drawn,
+        and once the rest have been, a MpiFailure names them. It's raised
+        straight away if the MPI work fails, or ends with variant units
+        still waiting for their parents.
+        """
+        while True:
+            with self.lock:
+                remaining = len(self.textual_flow_objects)
+            if not remaining:
+                break
+
+            self.update_parent_stats("Waiting to draw ({} variant units remaining)".format(remaining))
+            tf = self.next_ready()
+            if tf.failed_witnesses:
+                logger.error("Couldn't calculate the parents of %s at %s - not drawing it",
+                             ', '.join(tf.failed_witnesses), tf.variant_unit)
+                self.failed.append(tf.variant_unit)
+                self.done(tf.variant_unit)
+                continue
+            try:
+                tf.draw_diagrams()
+            except Exception:
+                logger.exception("Fatal error")
+                self.mpi_wait(stop=True)
+                raise
+            self.done(tf.variant_unit)
+
+        if self.failed:
+            self.mpi_wait(stop=True)
+            raise mpisupport.MpiFailure("Couldn't calculate the parents for variant unit(s) {}"
+                                        .format(', '.join(self.failed)))
+
+    def next_ready(self):
+        """
+        Wait for the next TextualFlow object that's ready to draw - checking
+        every draw_check_interval seconds that it's still coming
+        """
+        while True:
+            try:
+                return self.ready.get(timeout=self.draw_check_interval)
+            except queue.Empty:
+                pass
+
+            if self.mpi_queue.error is not None:
+                # This raises the error
+                self.mpi_wait(stop=True)
+            with self.mpi_lock:
+                children = self.mpi_running - self.mpi_lost
+            if self.mpi_queue.all_done() or not children:
+                # (Each result is handled before its task is done, so if
+                # they're all done, they're all in self.ready)
+                try:
+                    return self.ready.get_nowait()
+                except queue.Empty:
+                    pass
+                with self.lock:
+                    waiting = sorted(self.textual_flow_objects)
+                if children:
+                    self.mpi_wait(stop=True)
+                raise mpisupport.MpiFailure("{} - still waiting for the parents for variant unit(s) {}".format(
+                    "No work left" if children else "All the children were lost", ', '.join(waiting)))
+
     def done(self, vu):
         """
         Finished with this VU - so lose the reference and let python free
         up some memory.
         """
-        del self.textual_flow_objects[vu]
+        with self.lock:
+            del self.textual_flow_objects[vu]
+
+    def mpi_task_size(self, args):
+        """
+        How big a PARENTS task is (see TextualFlow.parents_task_size)
+        """
+        if args[0] == "PARENTS":
+            tf = self.textual_flow_objects.get(args[1])
+            if tf is not None:
+                return tf.parents_task_size(args[3])
+        return 1
 
     def mpi_handle_result(self, args, ret):
         """
@@ -100,15 +229,15 @@ class MpiHandler(mpisupport.MpiParent):
         @param args: original args sent to the child
         @param ret: response from the child
         """
-        key = ret[0]
+        key = args[0]
         if key == "GENCOH":
-            # There's nothing to do for genealogical coherence, since the point
-            # is just to store it in a cache - and the child did that.
-            assert ret[1] is True, ret
+            genealogical_coherence_done(self, args, ret[1])
         elif key == "PARENTS":
             # WARNING: We assume the first argument to get_parents is variant_unit
-            tf = self.textual_flow_objects[args[1]]
-            tf.mpi_result(args[1:], ret[1])
+            with self.lock:
+                tf = self.textual_flow_objects[args[1]]
+                # (None means the child aborted the task)
+                tf.mpi_result(args[1:], None if ret is None else ret[1])
         else:
             raise KeyError("Unknown MPI child key: {}".format(key))
 
@@ -135,6 +264,19 @@ def get_parents(variant_unit, w1, w1_reading, w1_parent, connectivity, db_file,
     coh = GenealogicalCoherence(db_file, w1, pretty_p=False, use_cache=True, min_strength=min_strength)
     coh.set_variant_unit(variant_unit)
 
+    return best_parents(coh, w1_reading, w1_parent, connectivity, min_strength, include_undirected)
+
+
+def best_parents(coh, w1_reading, w1_parent, connectivity, min_strength, include_undirected=False):
+    """
+    Choose the best parents for W1 from its parent combinations at coh's
+    variant unit
+
+    Return a map of connectivity value to parent map.
+
+    @param coh: GenealogicalCoherence object for W1, with the variant unit set
+    """
+    w1 = coh.w1
     logger.debug("Searching parent combinations")
     max_acceptable_gen = 2  # only allow my reading or my parent's
     parent_maps = {}
@@ -227,18 +369,35 @@ def textual_flow(db_file, *, variant_units, connectivity, perfect_only=False,
                  ranks_on_edges=True, include_perc_in_label=True, show_strengths=True,
                  weak_strength_threshold=25, very_weak_strength_threshold=5,
                  show_strength_values=False, suffix='', box_readings=False, force_serial=False,
-                 min_strength=None, include_undirected=False, path='.'):
+                 min_strength=None, include_undirected=False, path='.', graph_writer=None, results_store=None,
+                 processes=1, journal_file=None, telemetry_file=None):
     """
     Create a textual flow diagram for the specified variant units. This will
-    work out if we're using MPI and act accordingly...
+    work out if we're using MPI and act accordingly... If not, and processes
+    is more than 1, the work is shared between that many local processes in
+    the same way (see mpisupport.LocalComm).
+
+    If you specify a single variant unit, and don't use MPI or local
+    processes... then the output files dict will be returned. Otherwise None.
+
+    Existing outputs are only rebuilt if their inputs (the variant unit's
+    data, the coherence data, the parameters or the code) have changed.
 
-    If you specify a single variant unit, and don't use MPI... then the output
-    files dict will be returned. Otherwise None.
+    If graph_writer (a graph_data.GraphDataWriter) is supplied then the graphs
+    are written to that instead of as DOT and SVG files. Likewise, if
+    results_store (a results_store.ResultsStore) is supplied then the DOT and
+    SVG data are stored in that rather than in files.
+
+    If journal_file is supplied (with MPI or local processes) then the tasks
+    and their results are recorded in it, so that if this is interrupted and
+    run again, only the unfinished tasks are done again (see
+    task_journal.TaskJournal). Likewise, if telemetry_file is supplied then
+    the performance of each task is recorded in it (see telemetry.py).
 
     See TextualFlow class for a description of the arguments here.
     """
-    if 'OMPI_COMM_WORLD_SIZE' in os.environ and not force_serial:
-        # We have been run with mpiexec
+    if (mpisupport.mpi_launched() or processes > 1) and not force_serial:
+        # We have been run with mpiexec, or want local processes
         mpi_parent = mpisupport.is_parent()
         mpi_mode = True
     else:
@@ -246,7 +405,11 @@ def textual_flow(db_file, *, variant_units, connectivity, perfect_only=False,
 
     if mpi_mode:
         if mpi_parent:
-            mpihandler = MpiHandler()
+            journal = None
+            if journal_file:
+                journal = TaskJournal(journal_file, context=[coherence_fingerprint(db_file), code_fingerprint()])
+            telemetry = TelemetryWriter(telemetry_file) if telemetry_file else None
+            mpihandler = MpiHandler(processes, journal=journal, telemetry=telemetry)
         else:
             # MPI child
             mpisupport.mpi_child(mpi_child_wrapper)
@@ -257,10 +420,11 @@ def textual_flow(db_file, *, variant_units, connectivity, perfect_only=False,
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
     witnesses = [x[0] for x in list(cursor.execute(sql))]
-    for i, w1 in enumerate(witnesses):
-        if mpi_mode:
-            mpihandler.mpi_queue.put(("GENCOH", w1, db_file, min_strength))
-        else:
+    if mpi_mode:
+        # The children are sent the coherence data, rather than each loading it
+        queue_genealogical_coherence(mpihandler, db_file, witnesses, min_strength)
+    else:
+        for i, w1 in enumerate(witnesses):
             logger.debug("Generating genealogical coherence for W1={} ({}/{})".format(w1, i, len(witnesses)))
             generate_genealogical_coherence_cache(w1, db_file, min_strength)
 
@@ -280,14 +444,20 @@ def textual_flow(db_file, *, variant_units, connectivity, perfect_only=False,
                     show_strengths=show_strengths, weak_strength_threshold=weak_strength_threshold,
                     very_weak_strength_threshold=very_weak_strength_threshold,
                     show_strength_values=show_strength_values, suffix=suffix, box_readings=box_readings,
-                    min_strength=min_strength, include_undirected=include_undirected, path=path)
-
-            return mpihandler.mpi_wait(stop=True)
+                    min_strength=min_strength, include_undirected=include_undirected, path=path,
+                    graph_writer=graph_writer, results_store=results_store)
+
+            # Everything is queued - draw each variant unit as its parents arrive
+            mpihandler.draw_textual_flows()
+            ret = mpihandler.mpi_wait(stop=True)
+            logger.info("Textual flow outputs: %s up to date, %s rebuilt", mpihandler.reused, mpihandler.rebuilt)
+            return ret
         else:
             # MPI child - nothing to do as the children are already running
             pass
 
     else:
+        reused = rebuilt = 0
         for i, vu in enumerate(variant_units):
             logger.debug("Running for variant unit {} ({} of {})"
                          .format(vu, i + 1, len(variant_units)))
@@ -296,9 +466,13 @@ def textual_flow(db_file, *, variant_units, connectivity, perfect_only=False,
                             show_strengths=show_strengths, weak_strength_threshold=weak_strength_threshold,
                             very_weak_strength_threshold=very_weak_strength_threshold,
                             show_strength_values=show_strength_values, suffix=suffix, box_readings=box_readings,
-                            min_strength=min_strength, include_undirected=include_undirected, path=path)
+                            min_strength=min_strength, include_undirected=include_undirected, path=path,
+                            graph_writer=graph_writer, results_store=results_store)
             t.calculate_textual_flow()
+            reused += t.reused
+            rebuilt += t.rebuilt
 
+        logger.info("Textual flow outputs: %s up to date, %s rebuilt", reused, rebuilt)
         if len(variant_units) == 1:
             return t.output_files
 
@@ -310,7 +484,8 @@ class TextualFlow(object):
                  ranks_on_edges=True, include_perc_in_label=True, show_strengths=True,
                  weak_strength_threshold=25, very_weak_strength_threshold=5,
                  show_strength_values=False, suffix='', box_readings=False,
-                 min_strength=None, include_undirected=None, path='.', mpihandler=None):
+                 min_strength=None, include_undirected=None, path='.', mpihandler=None, graph_writer=None,
+                 results_store=None, reading_data=None):
         """
         @param db_file: sqlite database
         @param variant_unit: draw the textual flow of this variant unit
@@ -328,53 +503,16 @@ class TextualFlow(object):
         @param include_undirected: Include undirected relationships (as a group)
         @param path: the path under which to write the output files
         @param mpihandler: optional MpiHandler instance
+        @param graph_writer: optional graph_data.GraphDataWriter - write graph data there instead of DOT/SVG files
+        @param results_store: optional results_store.ResultsStore - store DOT/SVG data there instead of in files
+        @param reading_data: optional list of (witness, reading, parent) for the variant unit - used instead of
+                             the database's (see hypotheses.HypothesisEngine, which then supplies the parent maps)
         """
         assert type(connectivity) == list, "Connectivity must be a list (was %s)" % connectivity
-        # Fast abort if it already exists
         self.output_files = {}
         self.output_path = path
         self.connectivity = []
 
-        # Fetch reading info
-        sql = """SELECT witness, label, parent
-                    FROM cbgm
-                    WHERE variant_unit = \"{}\"
-                    """.format(variant_unit)
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        self.reading_data = list(cursor.execute(sql))  # (witness, label, parent) combinations
-        self.readings = set(x[1] for x in self.reading_data)  # just the unique reading labels
-
-        # Work out if we can quickly abort, and calculate the output filenames
-        for conn_value in connectivity:
-            assert type(conn_value) == str, "Connectivity values must be strings (was %s:%s)" % (conn_value, type(conn_value))
-            dirname = os.path.join(self.output_path, "c{}".format(conn_value.replace('%', 'perc')))
-            if not os.path.exists(dirname):
-                os.mkdir(dirname)
-            output_file = os.path.join(dirname, "textual_flow_{}_c{}{}".format(
-                variant_unit.replace('/', '_'), conn_value.replace('%', 'perc'), suffix))
-
-            if box_readings:
-                already_done = 0
-                for reading in self.readings:
-                    dotfile = "{}_{}.dot".format(output_file, reading[0].replace('/', '_'))
-                    if os.path.exists(dotfile):
-                        already_done += 1
-
-                if already_done == len(self.readings):
-                    logger.info("Textual flow diagrams (for {} readings) for {} already exists ({}) - skipping"
-                                .format(already_done, variant_unit, output_file))
-                    continue
-
-            else:
-                if os.path.exists(output_file + '.dot'):
-                    logger.info("Textual flow diagram for {} already exists ({}) - skipping"
-                                .format(variant_unit, output_file))
-                    continue
-
-            self.output_files[conn_value] = output_file
-            self.connectivity.append(conn_value)
-
         self.mpihandler = mpihandler
         self.db_file = db_file
         self.variant_unit = variant_unit
@@ -388,8 +526,129 @@ class TextualFlow(object):
         self.suffix = suffix
         self.box_readings = box_readings
         self.parent_maps = {}
+        self._pending = 0  # MPI tasks still to come back
+        self.failed_witnesses = []  # ones the MPI tasks couldn't calculate the parents of
         self.min_strength = min_strength
         self.include_undirected = include_undirected
+        self.graph_writer = graph_writer
+        self.results_store = results_store
+
+        # Fetch reading info
+        if reading_data is None:
+            sql = """SELECT witness, label, parent
+                        FROM cbgm
+                        WHERE variant_unit = \"{}\"
+                        """.format(variant_unit)
+            conn = sqlite3.connect(db_file)
+            cursor = conn.cursor()
+            reading_data = list(cursor.execute(sql))
+        self.reading_data = reading_data  # (witness, label, parent) combinations
+        self.readings = set(x[1] for x in self.reading_data)  # just the unique reading labels
+        self._parent_of = {label: parent for _, label, parent in self.reading_data}  # the local stemma
+        self._depths = {}  # reading -> its depth in the local stemma (see parents_task_size)
+
+        # Work out which outputs are already up to date, and calculate the output filenames.
+        # self.stale maps connectivity value to the set of group readings (or {None} for the
+        # whole variant unit) to draw - or None to draw everything.
+        self.input_hashes = {}
+        self.stale = {}
+        self.reused = 0
+        self.rebuilt = 0
+        for conn_value in connectivity:
+            assert type(conn_value) == str, "Connectivity values must be strings (was %s:%s)" % (conn_value, type(conn_value))
+            dirname = os.path.join(self.output_path, conn_dirname(conn_value))
+            output_file = os.path.join(dirname, "textual_flow_{}_{}{}".format(
+                variant_unit.replace('/', '_'), conn_dirname(conn_value), suffix))
+            self.output_files[conn_value] = output_file
+
+            if graph_writer is not None:
+                # Nothing to compare against - we're writing graph data instead
+                self.stale[conn_value] = None
+            else:
+                targets = self.readings if box_readings else {None}
+                existing = self._existing_input_hashes(conn_value)
+                stale = set()
+                for reading in targets:
+                    self.input_hashes[(conn_value, reading)] = self._input_hash(conn_value, reading)
+                    if existing.get(reading) != self.input_hashes[(conn_value, reading)]:
+                        stale.add(reading)
+
+                self.reused += len(targets) - len(stale)
+                self.rebuilt += len(stale)
+                if not stale:
+                    logger.info("Textual flow diagram(s) for {} at connectivity {} are up to date - skipping"
+                                .format(variant_unit, conn_value))
+                    del self.output_files[conn_value]
+                    continue
+
+                if existing:
+                    logger.info("Rebuilding {} of {} textual flow diagram(s) for {} at connectivity {}"
+                                .format(len(stale), len(targets), variant_unit, conn_value))
+                self.stale[conn_value] = stale
+
+            if graph_writer is None and results_store is None and not os.path.exists(dirname):
+                os.mkdir(dirname)
+
+            self.connectivity.append(conn_value)
+
+    def parents_task_size(self, reading):
+        """
+        Roughly how long it takes to find the parents of a witness with this
+        reading, as they're searched for up the local stemma: the number of
+        witnesses times the depth of the reading
+        """
+        if reading not in self._depths:
+            self._depths[reading] = self._depth(reading, frozenset())
+        return len(self.reading_data) * self._depths[reading]
+
+    def _depth(self, label, seen):
+        parent = self._parent_of.get(label)
+        if parent is None or label in seen:
+            return 1
+        return 1 + max(self._depth(x, seen | {label}) for x in parent.split('&'))
+
+    def _output_base(self, conn_value, reading=None):
+        """
+        The output filename (without extension) for this connectivity value and group reading
+        """
+        if reading:
+            return "{}_{}".format(self.output_files[conn_value], reading.replace('/', '_'))
+        return self.output_files[conn_value]
+
+    def _input_hash(self, conn_value, reading=None):
+        """
+        A hash of everything that goes into the diagram for this connectivity
+        value and group reading.
+        """
+        inputs = {'variant_unit': self.variant_unit,
+                  'reading_data': sorted(self.reading_data, key=lambda x: x[0]),
+                  'coherence': coherence_fingerprint(self.db_file),
+                  'code': code_fingerprint(),
+                  'connectivity': conn_value,
+                  'reading': reading,
+                  'params': [self.perfect_only, self.ranks_on_edges, self.include_perc_in_label,
+                             self.show_strengths, self.weak_strength_threshold,
+                             self.very_weak_strength_threshold, self.show_strength_values,
+                             self.box_readings, self.min_strength, bool(self.include_undirected)]}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _existing_input_hashes(self, conn_value):
+        """
+        Return a dict of group reading (or None) to input hash for the existing
+        outputs for this connectivity value.
+        """
+        if self.results_store is not None:
+            return self.results_store.input_hashes(self.variant_unit, conn_value, self.suffix)
+
+        ret = {}
+        for reading in (self.readings if self.box_readings else {None}):
+            hashfile = self._output_base(conn_value, reading) + '.inputs'
+            if os.path.exists(hashfile):
+                with open(hashfile) as f:
+                    ret[reading] = f.read().strip()
+            elif os.path.exists(self._output_base(conn_value, reading) + '.dot'):
+                logger.debug("No input hash for existing output %s", self._output_base(conn_value, reading))
+        return ret
 
     def calculate_textual_flow(self):
         """
@@ -412,6 +671,8 @@ class TextualFlow(object):
             logger.info("Setting min strength = %s", self.min_strength)
 
         # 1. Calculate the best parent for each witness
+        # Set this up front, as results can come back while we're still queueing
+        self._pending = len(self.reading_data)
         for i, (w1, w1_reading, w1_parent) in enumerate(self.reading_data):
             if self.mpihandler:
                 self.mpihandler.mpi_queue.put(("PARENTS", self.variant_unit, w1,
@@ -427,30 +688,36 @@ class TextualFlow(object):
                 self.parent_maps[w1] = parent_maps  # a parent map per connectivity setting
 
         if self.mpihandler:
-            # Wait a little for stabilisation
-            logger.debug("Waiting for remote tasks")
-            self.mpihandler.mpi_wait(stop=False)
-            logger.debug("Remote tasks complete")
-
-        # Now self.parent_maps should be complete
-        logger.debug("Parent maps are: {}".format(self.parent_maps))
+            # The MpiHandler will call draw_diagrams once mpi_result has had
+            # all the results.
+            if not self.reading_data:
+                self.mpihandler.parents_done(self)
+            return
 
         # 2. Draw the diagrams
+        self.draw_diagrams()
+
+    def draw_diagrams(self):
+        """
+        Draw the diagrams, once self.parent_maps is complete
+        """
+        logger.debug("Parent maps are: {}".format(self.parent_maps))
         for conn_value in self.connectivity:
             if self.box_readings:
                 self._draw_box_diagrams(conn_value)
             else:
                 self._draw_diagram(conn_value)
 
-        if self.mpihandler:
-            self.mpihandler.done(self.variant_unit)
-
     def _draw_box_diagrams(self, conn_value):
         """
         Make a diagram for each reading, showing those witnesses attesting the reading in a box, and their direct
         ancestors (attesting a different reading) outside the box.
         """
         for reading in self.readings:
+            if self.stale[conn_value] is not None and reading not in self.stale[conn_value]:
+                logger.debug("Diagram for reading %s is up to date", reading)
+                continue
+
             want_witnesses = set()
             for w1, w1_reading, w1_parent in self.reading_data:
                 if w1_reading != reading:
@@ -495,6 +762,7 @@ class TextualFlow(object):
         # Calculate edges and subgraph_members
         node_label_map = {}
         subgraph_members = set()
+        edge_data = []
 
         for i, (w1, w1_reading, w1_parent) in enumerate(my_reading_data):
             if w1_reading == group_reading:
@@ -566,12 +834,28 @@ class TextualFlow(object):
                     kwargs['color'] = 'red'
 
                 G.add_edge(p.parent, w1, **kwargs)
+                edge_data.append({'source': p.parent, 'target': w1, 'rank': p.rank, 'perc': p.perc,
+                                  'prior': p.prior, 'posterior': p.posterior, 'strength': p.strength,
+                                  'undirected': p.undirected, 'label': label, 'style': style,
+                                  'color': kwargs['color']})
 
         # Add the nodes
         for wit, args in witnesses:
             args['label'] = node_label_map[wit]
             G.add_node(wit, **args)
 
+        if self.graph_writer is not None:
+            # Write the graph data rather than drawing anything
+            readings = {x[0]: x[1] for x in my_reading_data}
+            node_data = [{'id': wit, 'reading': readings[wit], 'label': args['label'],
+                          'color': args['color'], 'fillcolor': args['fillcolor'],
+                          'in_group': wit in subgraph_members}
+                         for wit, args in witnesses]
+            self.graph_writer.add_graph('textual_flow', node_data, edge_data,
+                                        variant_unit=self.variant_unit, connectivity=conn_value,
+                                        reading=group_reading)
+            return
+
         # Add legend if needed
         if self.show_strengths:
             G.add_node("leg_s", label="Textual flow strength", shape="plaintext")
@@ -594,18 +878,30 @@ class TextualFlow(object):
         logger.info("Creating graph with %s nodes and %s edges",
                     G.number_of_nodes(), G.number_of_edges())
         # Keep the dotfile so we can change the look and feel later if we want
-        if group_reading:
-            dotfile = "{}_{}.dot".format(self.output_files[conn_value], group_reading.replace('/', '_'))
-            svgfile = "{}_{}.svg".format(self.output_files[conn_value], group_reading.replace('/', '_'))
-        else:
-            dotfile = "{}.dot".format(self.output_files[conn_value])
-            svgfile = "{}.svg".format(self.output_files[conn_value])
+        base = self._output_base(conn_value, group_reading)
+        dotfile = "{}.dot".format(base)
+        svgfile = "{}.svg".format(base)
+        input_hash = self.input_hashes[(conn_value, group_reading)]
+
+        if self.results_store is not None:
+            # Lay it out in-process and keep everything in the store
+            name = os.path.splitext(os.path.basename(dotfile))[0]
+            svg = G.draw(format='svg', prog='dot').decode('utf-8')
+            self.results_store.put(self.variant_unit, conn_value, name, G.string(), svg,
+                                   reading=group_reading, suffix=self.suffix, input_hash=input_hash,
+                                   metadata={'nodes': G.number_of_nodes(), 'edges': G.number_of_edges()})
+            logger.info("Stored {} in {}".format(name, self.results_store.filename))
+            return
 
         G.write(dotfile)
 
         with open(svgfile, 'w') as sf:
             subprocess.check_call(['dot', '-Tsvg', dotfile], stdout=sf)
 
+        # Written last, so an interrupted run leaves this output marked as stale
+        with open(base + '.inputs', 'w') as f:
+            f.write(input_hash)
+
         logger.info("Written to {} and {}".format(dotfile, svgfile))
 
     def mpi_result(self, args, ret):
@@ -616,4 +912,12 @@ class TextualFlow(object):
         """
         # WARNING: We assume the second argument to get_parents is W1
         w1 = args[1]
-        self.parent_maps[w1] = ret  # a parent map per connectivity setting
+        if ret is None:
+            # It still counts as done, so we're not left waiting for it
+            self.failed_witnesses.append(w1)
+        else:
+            self.parent_maps[w1] = ret  # a parent map per connectivity setting
+        self._pending -= 1
+        if self._pending == 0:
+            logger.debug("All parents calculated for {}".format(self.variant_unit))
+            self.mpihandler.parents_done(self)
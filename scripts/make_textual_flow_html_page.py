@@ -14,6 +14,10 @@ folder
  |_c499
 
 Each cXXX folder will contain many .svg files, and they should all contain equivalent listings.
+
+Alternatively, give it a results store file (see "cbgm tf --results-store") with --store. The
+listing is read from the store, and the page is then served (see --port) with each diagram read
+from the store as it's asked for - so no cXXX folders are needed.
 """
 
 
@@ -22,6 +26,7 @@ import sys
 import os
 import shutil
 import re
+import http.server
 
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -107,9 +112,12 @@ HTML_TEMPLATE = """<html>
 """
 
 
-def make_page(folder, overwrite):
+def make_page(folder, overwrite, store=None):
     """
     Takes a path to a folder and creates an HTML summary page at index.html within it.
+
+    If store (a CBGM.results_store.ResultsStore) is supplied then the listing is read from it,
+    rather than from cXXX folders (see serve_page).
     """
     abs_folder = os.path.abspath(folder)
     outfile = os.path.join(abs_folder, 'index.html')
@@ -119,7 +127,14 @@ def make_page(folder, overwrite):
 
     conn_folders = []
     conn_regex = re.compile("c([0-9]+(perc)?)")
-    for f in os.listdir(abs_folder):
+    if store is not None:
+        from CBGM.results_store import conn_dirname
+        # folder name -> connectivity value
+        store_conn_values = {conn_dirname(x): x for x in store.connectivity_values()}
+        folder_names = list(store_conn_values)
+    else:
+        folder_names = os.listdir(abs_folder)
+    for f in folder_names:
         match = conn_regex.match(f)
         if match:
             conn_folders.append(match.group(1))
@@ -144,8 +159,12 @@ def make_page(folder, overwrite):
             <a id="c{}" target="_blank"><img id="c{}" class="image"/></a>
         '''.format(sanitised_f, sanitised_f, sanitised_f)
 
-    svg_files = [x for x in os.listdir(os.path.join(abs_folder, 'c{}'.format(conn_folders[0])))
-                 if os.path.splitext(x)[1] == '.svg']
+    if store is not None:
+        conn_value = store_conn_values['c{}'.format(conn_folders[0])]
+        svg_files = ['{}.svg'.format(x['name']) for x in store.iter_results(conn_value, with_data=False)]
+    else:
+        svg_files = [x for x in os.listdir(os.path.join(abs_folder, 'c{}'.format(conn_folders[0])))
+                     if os.path.splitext(x)[1] == '.svg']
     print("Found {} SVG files in c{}".format(len(svg_files), conn_folders[0]))
     parsed_svg_files = []
     svg_re = re.compile("textual_flow_B([0-9]{2})K([0-9]{2})V([0-9]{2})_([^-,]+)[-,]?(.*?)_c[0-9]+_?(.*)\.svg")
@@ -215,10 +234,60 @@ def make_page(folder, overwrite):
     print("Done - please see {}".format(outfile))
 
 
+def serve_page(folder, store, port):
+    """
+    Serve the page made by make_page(folder, overwrite, store) at http://localhost:port/ - reading
+    each diagram (cXXX/name.svg) from the store as it's asked for.
+    """
+    from CBGM.results_store import conn_dirname
+    conn_values = {conn_dirname(x): x for x in store.connectivity_values()}
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=folder, **kwargs)
+
+        def do_GET(self):
+            dirname, _, filename = self.path.lstrip('/').partition('/')
+            name, ext = os.path.splitext(filename)
+            if dirname not in conn_values or ext != '.svg':
+                return super().do_GET()
+
+            svg = store.get_svg(conn_values[dirname], name)
+            if svg is None:
+                self.send_error(404, "No diagram {} in {}".format(self.path, store.filename))
+                return
+            data = svg.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/svg+xml')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    # (Single-threaded, as the store's connection is)
+    server = http.server.HTTPServer(('localhost', port), Handler)
+    print("Serving on http://localhost:{}/ - press Ctrl-C to stop".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Textual flow HTML summary generator")
     parser.add_argument('folder', help="Folder containing textual flow data (must contain cXXX folders")
     parser.add_argument('--overwrite', action='store_true', help="Overwrite an existing file")
+    parser.add_argument('--store', default=None,
+                        help="Read the diagrams from this results store (see 'cbgm tf --results-store') "
+                             "instead of from cXXX folders, and serve the page")
+    parser.add_argument('--port', default=8000, type=int, help="Port to serve the page on with --store")
     args = parser.parse_args()
-    make_page(args.folder, args.overwrite)
+    if args.store:
+        from CBGM.results_store import ResultsStore
+        store = ResultsStore(args.store)
+        make_page(args.folder, args.overwrite, store)
+        serve_page(os.path.abspath(args.folder), store, args.port)
+        store.close()
+    else:
+        make_page(args.folder, args.overwrite)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Measure the per-task overhead of the MPI scheduler in CBGM/mpisupport.py, by
+sending lots of tasks that take (almost) no time, e.g.:
+
+    mpirun -n 8 python3 scripts/mpi_latency_benchmark.py -n 2000
+
+To compare with another version of the scheduler, run it again with that
+version of mpisupport.py checked out, e.g.:
+
+    git show <commit>:CBGM/mpisupport.py > /tmp/mpisupport_old.py
+    mpirun -n 8 python3 scripts/mpi_latency_benchmark.py -n 200 --mpisupport /tmp/mpisupport_old.py
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def load_mpisupport(path):
+    if path is None:
+        from CBGM import mpisupport
+        return mpisupport
+    spec = importlib.util.spec_from_file_location('mpisupport_under_test', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def task(i, work):
+    """
+    The benchmark task - which just sleeps for the requested time
+    """
+    if work:
+        time.sleep(work)
+    return i
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-task overhead of the MPI scheduler")
+    parser.add_argument('-n', '--tasks', default=1000, type=int, help='Number of tasks (default %(default)s)')
+    parser.add_argument('-w', '--work', default=0.0, type=float,
+                        help='How long (in seconds) each task takes (default %(default)s)')
+    parser.add_argument('--mpisupport', default=None, metavar='FILE',
+                        help='Benchmark this version of mpisupport.py instead')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    mpisupport = load_mpisupport(args.mpisupport)
+
+    if not mpisupport.is_parent():
+        mpisupport.mpi_child(task)
+        return
+
+    class Benchmark(mpisupport.MpiParent):
+        def __init__(self):
+            super().__init__()
+            self.done = 0
+
+        def mpi_handle_result(self, args, ret):
+            assert ret == args[0], (args, ret)
+            self.done += 1
+
+    start = time.time()
+    benchmark = Benchmark()
+    for i in range(args.tasks):
+        benchmark.mpi_queue.put((i, args.work))
+    benchmark.mpi_wait(stop=False)
+    elapsed = time.time() - start
+    benchmark.mpi_wait(stop=True)
+
+    children = benchmark.mpicomm.size - 1
+    # Each child spends elapsed seconds on its share of the tasks
+    per_task = elapsed * children / args.tasks
+    print("{} tasks on {} children in {:.3f}s".format(benchmark.done, children, elapsed))
+    print("Per task: {:.3f} ms, of which overhead: {:.3f} ms".format(per_task * 1000,
+                                                                     (per_task - args.work) * 1000))
+
+
+if __name__ == "__main__":
+    main()
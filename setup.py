@@ -15,6 +15,8 @@ setup(
                                      'cbgm_apparatus',
                                      'cbgm_hypotheses_on_unclear',
                                      'cbgm_stripes',
+                                     'cbgm_export_results',
+                                     'cbgm_telemetry',
                                      'cbgm']
     ],
     install_requires=[
@@ -23,6 +25,7 @@ setup(
         'graphviz',
         'mpi4py',
         'networkx==1.10',
+        'numpy',
         'pydot',
         'pygraphviz',
         'Pympler',